@@ -0,0 +1,162 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# Pluggable FAISS index types for the vector store of the user documents.
+#
+# The default FAISS vector store of langchain is a flat index: every query is compared with every
+# chunk, which is exact and the fastest choice for small corpora such as user_doc.txt, but its cost
+# grows linearly with the number of chunks. The index types are:
+# * flat: exact search.
+# * sq8: exact search over vectors compressed to int8 by a scalar quantizer, 4 times smaller.
+# * hnsw: a graph of the vectors (HNSW), fast approximate search without training.
+# * ivf: the vectors are clustered, and only the clusters closest to the query are searched.
+# * ivfpq: ivf with the vectors compressed by product quantization, for the largest corpora.
+# "auto" chooses the index type by the number of chunks, see choose_index_type().
+#
+# Only the flat and sq8 indexes can delete vectors in place. The vector store of the other types
+# is rebuilt when chunks are removed, see vector_store.py.
+
+import math
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+INDEX_TYPES = ("auto", "flat", "sq8", "hnsw", "ivf", "ivfpq")
+
+# The index types that delete vectors in place, keeping the ids of the other vectors in order
+REMOVABLE_INDEX_TYPES = ("flat", "sq8")
+
+# The number of chunks from which "auto" switches to the next index type
+AUTO_HNSW_MIN_CHUNKS = 10000
+AUTO_IVF_MIN_CHUNKS = 200000
+AUTO_IVFPQ_MIN_CHUNKS = 2000000
+
+# The search parameters of the approximate indexes: the number of neighbors per node of the HNSW
+# graph and the size of its candidate list at search time, and the share of the IVF clusters
+# searched per query
+HNSW_NEIGHBORS = 32
+HNSW_EF_SEARCH = 64
+IVF_NPROBE_RATIO = 1 / 16
+
+# The minimum number of chunks to train the 256 centroids of every sub-quantizer of ivfpq, with
+# the 39 training vectors per centroid that FAISS recommends
+PQ_MIN_CHUNKS = 256 * 39
+
+
+def choose_index_type(chunk_count):
+    """
+    Returns the index type that "auto" uses for a number of chunks.
+    """
+    if chunk_count < AUTO_HNSW_MIN_CHUNKS:
+        return "flat"
+    if chunk_count < AUTO_IVF_MIN_CHUNKS:
+        return "hnsw"
+    if chunk_count < AUTO_IVFPQ_MIN_CHUNKS:
+        return "ivf"
+    return "ivfpq"
+
+
+def resolve_index_type(index_type, chunk_count):
+    """
+    Returns the index type to build for a number of chunks: the given one, or the one chosen by
+    choose_index_type() for "auto".
+
+    Raises:
+        ValueError: If the index type is not supported.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unsupported index type {index_type}. Must be one of {', '.join(INDEX_TYPES)}")
+    return choose_index_type(chunk_count) if index_type == "auto" else index_type
+
+
+def get_nlist(chunk_count):
+    """
+    Returns the number of clusters of an IVF index: about 4 * sqrt(chunk_count), and few enough
+    that every cluster has at least 39 training vectors, as FAISS recommends.
+    """
+    return max(1, min(int(4 * math.sqrt(chunk_count)), chunk_count // 39))
+
+
+def get_pq_subquantizers(dimension):
+    """
+    Returns the number of sub-quantizers of a product-quantized index: the largest divisor of the
+    dimension that gives sub-vectors of at least 8 dimensions, so every vector is compressed to
+    about 1 byte per 8 dimensions.
+    """
+    for count in range(max(dimension // 8, 1), 0, -1):
+        if dimension % count == 0:
+            return count
+    return 1
+
+
+def get_factory_string(index_type, dimension, chunk_count):
+    """
+    Returns the faiss.index_factory() description of an index type.
+    """
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "sq8":
+        return "SQ8"
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_NEIGHBORS}"
+    if index_type == "ivf":
+        return f"IVF{get_nlist(chunk_count)},Flat"
+    if index_type == "ivfpq":
+        return f"IVF{get_nlist(chunk_count)},PQ{get_pq_subquantizers(dimension)}"
+    raise ValueError(f"Unsupported index type {index_type}")
+
+
+def build_index(vectors, index_type):
+    """
+    Builds a FAISS index of an index type, with L2 distance like the default langchain vector store.
+
+    Parameters:
+        vectors (numpy.ndarray): The float32 vectors, one row per chunk.
+        index_type (str): One of INDEX_TYPES other than "auto".
+
+    Returns:
+        faiss.Index: The trained index with the vectors added, ready to search.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    chunk_count, dimension = vectors.shape
+    if index_type == "ivfpq" and chunk_count < PQ_MIN_CHUNKS:
+        raise ValueError(f"The ivfpq index needs at least {PQ_MIN_CHUNKS} chunks to train its quantizers, got {chunk_count}")
+    index = faiss.index_factory(dimension, get_factory_string(index_type, dimension, chunk_count), faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+
+    if index_type == "hnsw":
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif index_type in ("ivf", "ivfpq"):
+        index.nprobe = max(1, int(index.nlist * IVF_NPROBE_RATIO))
+    return index
+
+
+def create_vector_store(docs, embedding_func, index_type="auto", ids=None):
+    """
+    Creates a langchain FAISS vector store of documents on an index type, like
+    FAISS.from_documents() does on a flat index.
+
+    Parameters:
+        docs (list): The documents (langchain Document).
+        embedding_func (Embeddings): The embedding function.
+        index_type (str): One of INDEX_TYPES.
+        ids (list): Optional. The ids of the documents in the docstore.
+
+    Returns:
+        FAISS: The vector store.
+    """
+    index_type = resolve_index_type(index_type, len(docs))
+    vectors = np.asarray(embedding_func.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+    index = build_index(vectors, index_type)
+
+    ids = list(ids) if ids is not None else [str(position) for position in range(len(docs))]
+    docstore = InMemoryDocstore(dict(zip(ids, docs)))
+    return FAISS(embedding_func, index, docstore, dict(enumerate(ids)))
@@ -0,0 +1,165 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# Benchmarks the FAISS index types of ann_index.py on synthetic corpora, to choose the index type
+# of a corpus size.
+#
+# Every corpus is a deterministic set of clustered, normalized vectors of the dimension of the
+# sentence transformer model, like the embeddings of chunks on a few topics. The queries are
+# corpus vectors with noise added. For every corpus size and index type, the benchmark reports:
+# * the build time, including training;
+# * the memory of the index, measured as the size of the serialized index;
+# * the query latency, for one query at a time (median) and for all queries in one batch;
+# * the recall@k: the share of the exact top k neighbors, found by the flat index, that the index
+#   returns in its top k.
+#
+# The results are saved as JSON. A corpus of 1M chunks of 384 dimensions takes about 1.5 GB of memory.
+#
+# Usage: python benchmark_ann.py [--sizes N,N,...] [--types TYPE,TYPE,...] [--dimension N] [--queries N] [--k N] [--seed N]
+#        [--output PATH]
+#
+# Example: python benchmark_ann.py --sizes 1000,10000,100000,1000000 --output ann_results.json
+
+import argparse
+import json
+import statistics
+import sys
+import time
+import faiss
+import numpy as np
+from ann_index import INDEX_TYPES, PQ_MIN_CHUNKS, build_index
+
+# The number of topics of the synthetic corpora, and the spread of the chunks around their topic
+TOPIC_COUNT = 100
+TOPIC_SPREAD = 0.5
+
+# The number of vectors generated at a time, to bound the temporary memory of large corpora
+GENERATE_BATCH_SIZE = 100000
+
+
+def generate_corpus(size, dimension, rng):
+    """
+    Generates a synthetic corpus of clustered, normalized float32 vectors.
+    """
+    topics = rng.standard_normal((TOPIC_COUNT, dimension)).astype(np.float32)
+    corpus = np.empty((size, dimension), dtype=np.float32)
+    for start in range(0, size, GENERATE_BATCH_SIZE):
+        stop = min(start + GENERATE_BATCH_SIZE, size)
+        batch = topics[rng.integers(0, TOPIC_COUNT, stop - start)]
+        batch += TOPIC_SPREAD * rng.standard_normal(batch.shape).astype(np.float32)
+        corpus[start:stop] = batch
+    faiss.normalize_L2(corpus)
+    return corpus
+
+
+def generate_queries(corpus, count, rng):
+    """
+    Generates queries near random vectors of a corpus.
+    """
+    queries = corpus[rng.integers(0, len(corpus), count)].copy()
+    queries += 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    faiss.normalize_L2(queries)
+    return queries
+
+
+def get_recall(found, expected):
+    """
+    Returns the mean share of the expected neighbors of every query that were found.
+    """
+    k = expected.shape[1]
+    return float(np.mean([len(set(found_row) & set(expected_row)) / k for found_row, expected_row in zip(found, expected)]))
+
+
+def benchmark_index(index_type, corpus, queries, expected, k):
+    """
+    Builds an index of the corpus and measures it.
+
+    Returns:
+        dict: The build time, memory, latency and recall of the index.
+    """
+    start_time = time.perf_counter()
+    index = build_index(corpus, index_type)
+    build_seconds = time.perf_counter() - start_time
+
+    single_latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        index.search(query.reshape(1, -1), k)
+        single_latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    _, found = index.search(queries, k)
+    batch_seconds = time.perf_counter() - start_time
+
+    return {
+        "build_seconds": round(build_seconds, 3),
+        "index_mb": round(faiss.serialize_index(index).size / (1024 * 1024), 2),
+        "query_ms": round(statistics.median(single_latencies) * 1000, 3),
+        "batch_query_ms": round(batch_seconds * 1000 / len(queries), 3),
+        "recall": round(get_recall(found, expected), 4)
+    }
+
+
+def run_benchmarks(sizes, index_types, dimension, query_count, k, seed):
+    """
+    Runs the benchmark of every index type on a synthetic corpus of every size.
+
+    Returns:
+        dict: The settings and the results of every index type at every size.
+    """
+    results = {
+        "settings": {"dimension": dimension, "queries": query_count, "k": k, "seed": seed, "threads": faiss.omp_get_max_threads()},
+        "results": []
+    }
+    for size in sizes:
+        rng = np.random.default_rng(seed)
+        corpus = generate_corpus(size, dimension, rng)
+        queries = generate_queries(corpus, query_count, rng)
+
+        # The exact neighbors, found by brute force
+        exact_index = faiss.IndexFlatL2(dimension)
+        exact_index.add(corpus)
+        _, expected = exact_index.search(queries, k)
+
+        for index_type in index_types:
+            if index_type == "ivfpq" and size < PQ_MIN_CHUNKS:
+                continue
+            result = benchmark_index(index_type, corpus, queries, expected, k)
+            result.update({"index_type": index_type, "chunks": size})
+            results["results"].append(result)
+            print(f"{index_type:<6} {size:>8} chunks  recall@{k} {result['recall']:.3f}  {result['query_ms']:>8.3f} ms/query  "
+                  f"{result['batch_query_ms']:>8.3f} ms/query in batch  {result['index_mb']:>9.2f} MB  built in {result['build_seconds']:.2f}s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the FAISS index types of ann_index.py on synthetic corpora.")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="The comma-separated corpus sizes, in chunks.")
+    parser.add_argument("--types", default="flat,sq8,hnsw,ivf,ivfpq", help="The comma-separated index types.")
+    parser.add_argument("--dimension", type=int, default=384, help="The dimension of the vectors. 384 is the dimension of all-MiniLM-L6-v2.")
+    parser.add_argument("--queries", type=int, default=200, help="The number of queries.")
+    parser.add_argument("--k", type=int, default=10, help="The number of neighbors per query.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the synthetic corpora.")
+    parser.add_argument("--output", default="ann_results.json", help="The path of the JSON results.")
+    args = parser.parse_args()
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(",")]
+    except ValueError:
+        print(f"Error: Invalid sizes {args.sizes}. Must be comma-separated numbers")
+        sys.exit(1)
+    index_types = args.types.split(",")
+    for index_type in index_types:
+        if index_type not in INDEX_TYPES or index_type == "auto":
+            print(f"Error: Unsupported index type {index_type}. Must be one of {', '.join(INDEX_TYPES[1:])}")
+            sys.exit(1)
+
+    results = run_benchmarks(sizes, index_types, args.dimension, args.queries, args.k, args.seed)
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results saved to {args.output}")
@@ -0,0 +1,185 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# A compact BM25 inverted index over the chunks of a vector store, for the lexical half of the
+# hybrid retrieval of retrieval.py.
+#
+# The index is stored like a sparse matrix: the sorted vocabulary, and for every term, the
+# positions of the chunks that contain it and the BM25 weight of the term in each of them. The
+# weights are computed when the index is built, so scoring a query only adds up the precomputed
+# weights of its terms, with no per-query term frequency or length normalization.
+#
+# The index is saved as bm25.npz in the directory of the vector store, with the ids of the chunks
+# it covers, and built again when the chunks of the vector store change.
+
+import json
+import math
+import os
+import re
+from collections import Counter
+import numpy as np
+
+BM25_FILENAME = "bm25.npz"
+
+# The BM25 parameters: term frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Words too common to identify a chunk
+STOPWORDS = frozenset((
+    "a", "about", "after", "all", "also", "am", "an", "and", "any", "are", "as", "at", "be", "been", "before", "but",
+    "by", "can", "could", "did", "do", "does", "for", "from", "had", "has", "have", "he", "her", "him", "his", "how",
+    "i", "if", "in", "into", "is", "it", "its", "me", "my", "no", "not", "of", "on", "or", "our", "she", "so", "than",
+    "that", "the", "their", "them", "then", "there", "they", "this", "to", "too", "up", "us", "was", "we", "were",
+    "what", "when", "where", "which", "who", "whose", "will", "with", "would", "you", "your"
+))
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """
+    Splits a text into lowercase word tokens, without the stopwords. Apostrophes are dropped, so
+    "John’s" and "Johns" are the same token.
+    """
+    text = text.lower().replace("'", "").replace("’", "")
+    return [token for token in TOKEN_PATTERN.findall(text) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    A BM25 inverted index with precomputed term weights.
+
+    Parameters:
+        ids (list): The ids of the chunks, in the order of their positions.
+        terms (list): The sorted vocabulary.
+        offsets (numpy.ndarray): The postings of terms[i] are postings[offsets[i]:offsets[i + 1]].
+        postings (numpy.ndarray): The positions of the chunks that contain each term.
+        weights (numpy.ndarray): The BM25 weight of the term in each posting.
+    """
+
+    def __init__(self, ids, terms, offsets, postings, weights):
+        self.ids = ids
+        self.terms = terms
+        self.offsets = offsets
+        self.postings = postings
+        self.weights = weights
+        self.term_positions = {term: position for position, term in enumerate(terms)}
+
+    @classmethod
+    def build(cls, ids, texts):
+        """
+        Builds the index of chunks.
+
+        Parameters:
+            ids (list): The ids of the chunks.
+            texts (list): The texts of the chunks.
+
+        Returns:
+            BM25Index: The index.
+        """
+        counts = [Counter(tokenize(text)) for text in texts]
+        lengths = np.array([sum(count.values()) for count in counts], dtype=np.float32)
+        average_length = float(lengths.mean()) if len(lengths) and lengths.sum() else 1.0
+
+        term_postings = {}
+        for position, count in enumerate(counts):
+            for term, frequency in count.items():
+                term_postings.setdefault(term, []).append((position, frequency))
+
+        terms = sorted(term_postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        postings = []
+        weights = []
+        for term_position, term in enumerate(terms):
+            entries = term_postings[term]
+            idf = math.log(1 + (len(texts) - len(entries) + 0.5) / (len(entries) + 0.5))
+            for position, frequency in entries:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[position] / average_length)
+                postings.append(position)
+                weights.append(idf * frequency * (BM25_K1 + 1) / (frequency + norm))
+            offsets[term_position + 1] = len(postings)
+
+        return cls(list(ids), terms, offsets, np.array(postings, dtype=np.int32), np.array(weights, dtype=np.float32))
+
+    def search(self, query, k):
+        """
+        Returns the chunks with the highest BM25 scores for a query.
+
+        Parameters:
+            query (str): The query.
+            k (int): The maximum number of chunks to return.
+
+        Returns:
+            tuple: The list of (chunk position, score, number of query terms in the chunk) of the top k
+            chunks with a positive score, from the best, and the number of distinct terms of the query.
+        """
+        query_terms = set(tokenize(query))
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        matches = np.zeros(len(self.ids), dtype=np.int32)
+        for term in query_terms:
+            term_position = self.term_positions.get(term)
+            if term_position is None:
+                continue
+            start, stop = self.offsets[term_position], self.offsets[term_position + 1]
+            # A chunk appears once in the postings of a term, so plain fancy indexing adds up correctly
+            scores[self.postings[start:stop]] += self.weights[start:stop]
+            matches[self.postings[start:stop]] += 1
+
+        candidates = np.flatnonzero(scores)
+        top = candidates[np.argsort(-scores[candidates], kind="stable")[:k]]
+        return [(int(position), float(scores[position]), int(matches[position])) for position in top], len(query_terms)
+
+    def save(self, path):
+        """
+        Saves the index to a .npz file.
+        """
+        np.savez(path, ids=json.dumps(self.ids), terms=json.dumps(self.terms), offsets=self.offsets, postings=self.postings,
+                 weights=self.weights)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index saved by save().
+        """
+        with np.load(path) as data:
+            return cls(json.loads(str(data["ids"])), json.loads(str(data["terms"])), data["offsets"], data["postings"], data["weights"])
+
+
+def get_chunk_ids(vectordb):
+    """
+    Returns the ids of the chunks of a FAISS vector store, in the order of their positions in the index.
+    """
+    return [vectordb.index_to_docstore_id[position] for position in range(len(vectordb.index_to_docstore_id))]
+
+
+def load_bm25_index(vectordb, index_dir):
+    """
+    Loads the BM25 index of the chunks of a vector store from its directory, or builds and saves
+    it if it is missing or covers other chunks.
+
+    Parameters:
+        vectordb (FAISS): The vector store.
+        index_dir (str): The directory of the vector store.
+
+    Returns:
+        BM25Index: The index. Its chunk positions are the positions of the chunks in the vector store.
+    """
+    path = os.path.join(index_dir, BM25_FILENAME)
+    ids = get_chunk_ids(vectordb)
+    try:
+        bm25_index = BM25Index.load(path)
+        if bm25_index.ids == ids:
+            return bm25_index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    bm25_index = BM25Index.build(ids, [vectordb.docstore.search(chunk_id).page_content for chunk_id in ids])
+    os.makedirs(index_dir, exist_ok=True)
+    bm25_index.save(path)
+    return bm25_index
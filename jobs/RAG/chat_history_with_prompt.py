@@ -9,10 +9,16 @@
 from langchain_community.chat_models import ChatOllama
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from context_packer import ContextPacker
+from conversion import print_streamed
+from response_cache import ResponseCache, stream_cached_convert
 
 # Define the Ollama model to use
 model = "llama3"
 
+# The database that caches the responses of the language model between runs. See response_cache.py.
+response_cache = "./data/response_cache.sqlite"
+
 # Telegraphic reply to be translated
 message_to_convert = "she love cooking like share recipes"
 
@@ -54,16 +60,29 @@ prompt = ChatPromptTemplate.from_template(prompt_template_with_context)
 # using LangChain Expressive Language (LCEL) chain syntax
 chain = prompt | llm | StrOutputParser()
 
+# Cache the responses, so a message converted before in the same context is not generated again
+cache = ResponseCache(response_cache, f"{model}:chat_history_with_prompt")
+
+# Stream the responses, printing the tokens as they are generated. See conversion.py.
 print("====== Response without chat history ======")
 
-print(chain.invoke({
+timing = {}
+print_streamed(stream_cached_convert(cache, chain, {
     "chat_history": "",
     "message_to_convert": message_to_convert
-}) + "\n")
+}, message_to_convert, "", timing), timing)
 
 print("====== Response with chat history ======")
 
-print(chain.invoke({
-    "chat_history": "\n".join(chat_history),
+# Keep the most recent turns of the chat history that fit in its token budget
+packed_chat_history, packing = ContextPacker().pack_chat_history(chat_history)
+print(f"(chat history: {packing['selected']} of {packing['candidates']} turns, {packing['tokens']} tokens, {packing['tokens_saved']} tokens saved)\n")
+
+timing = {}
+print_streamed(stream_cached_convert(cache, chain, {
+    "chat_history": packed_chat_history,
     "message_to_convert": message_to_convert
-}) + "\n")
+}, message_to_convert, packed_chat_history, timing), timing)
+
+stats = cache.get_stats()
+print(f"====== Response cache: {stats['exact_hits']} hits, {stats['misses']} misses, {stats['entries']} entries ======\n")
@@ -9,10 +9,19 @@
 from langchain_community.chat_models import ChatOllama
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from conversion import print_streamed
+from response_cache import ResponseCache, stream_cached_convert
+from rolling_summary import RollingSummary
 
 # Define the Ollama model to use
 model = "llama3"
 
+# The file where the summary of the earlier chat is saved between runs. See rolling_summary.py.
+summary_state = "./data/chat_summary.json"
+
+# The database that caches the responses of the language model between runs. See response_cache.py.
+response_cache = "./data/response_cache.sqlite"
+
 # Define the number of the most recent chats to be passed in as the most recent chats.
 # The summary of chats before the most recent will be passed in as another context element.
 num_of_recent_chat = 1
@@ -34,28 +43,22 @@ chat_history = [
     "Elaine: Yes, she did. She's so excited about it! She's planning to visit a lot of historical sites.",
     "John: I bet she'll have a great time. Maybe she can bring back some authentic Italian recipes for us to try.",
 ]
-recent_chat_array = []
-earlier_chat_array = []
 
-# 1. Instantiate the chat model and split the chat history
+# 1. Instantiate the chat model and the rolling summary of the earlier chat. The summary and the number of turns it
+# covers are saved in summary_state, so the turns summarized by a previous run are not summarized again.
 llm = ChatOllama(model=model)
-
-if (len(chat_history) > num_of_recent_chat):
-    recent_chat_array = chat_history[-num_of_recent_chat:]
-    earlier_chat_array = chat_history[:-num_of_recent_chat]
-else:
-    recent_chat_array = chat_history
-    earlier_chat_array = []
-
-# 2. Summarize earlier chat
-if (len(earlier_chat_array) > 0):
-    summarizer_prompt = ChatPromptTemplate.from_template("Summarize the following chat history. Provide only the summary, without any additional comments or context. \nChat history: {chat_history}")
-    chain = summarizer_prompt | llm | StrOutputParser()
-    summary = chain.invoke({
-        "chat_history": "\n".join(earlier_chat_array)
-    })
+rolling_summary = RollingSummary(llm, num_of_recent_chat, summary_state)
+
+# 2. Summarize the earlier chat and split the chat history. All the turns not summarized yet are folded into the
+# summary in one call. In an interactive conversation, call rolling_summary.schedule(chat_history) after every new
+# turn instead, so the turns that slide out of the most recent chats are folded in the background before the next
+# message is converted.
+summary, recent_chat_array = rolling_summary.get(chat_history)
+rolling_summary.close()
+stats = rolling_summary.get_stats()
 print("====== Summary ======")
 print(f"{summary}\n")
+print(f"(summary of {stats['watermark']} turns, {stats['folded_turns']} turns folded in {stats['folds']} updates, {stats['mean_fold_ms']} ms per update)\n")
 
 # 3. concetenate recent chat into a string
 recent_chat_string = "\n".join(recent_chat_array)
@@ -83,18 +86,27 @@ prompt = ChatPromptTemplate.from_template(prompt_template_with_context)
 # using LangChain Expressive Language (LCEL) chain syntax
 chain = prompt | llm | StrOutputParser()
 
+# Cache the responses, so a message converted before in the same context is not generated again
+cache = ResponseCache(response_cache, f"{model}:chat_history_with_summary")
+
+# Stream the responses, printing the tokens as they are generated. See conversion.py.
 print("====== Response without chat history ======")
 
-print(chain.invoke({
+timing = {}
+print_streamed(stream_cached_convert(cache, chain, {
     "summary": "",
     "recent_chat": recent_chat_string,
     "message_to_convert": message_to_convert
-}) + "\n")
+}, message_to_convert, recent_chat_string, timing), timing)
 
 print("====== Response with chat history ======")
 
-print(chain.invoke({
+timing = {}
+print_streamed(stream_cached_convert(cache, chain, {
     "summary": summary,
     "recent_chat": recent_chat_string,
     "message_to_convert": message_to_convert
-}) + "\n")
+}, message_to_convert, f"{summary}\n{recent_chat_string}", timing), timing)
+
+stats = cache.get_stats()
+print(f"====== Response cache: {stats['exact_hits']} hits, {stats['misses']} misses, {stats['entries']} entries ======\n")
@@ -0,0 +1,182 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# Packs retrieved chunks and chat history into a token budget, so the prompt of the language model,
+# and the time it takes to read it before generating the first token, stays bounded however many
+# chunks are retrieved or however long the conversation grows.
+#
+# ContextPacker.pack_documents() drops the chunks that repeat text already selected, such as
+# overlapping chunks of the same passage, then takes the remaining chunks from the best ranked
+# while they fit in the budget. ContextPacker.pack_chat_history() keeps the most recent turns of a
+# conversation that fit in the budget. Both report the tokens used, and the tokens saved compared to
+# passing every chunk or turn.
+#
+# The number of tokens of a text is counted by a pluggable function, cached by text so the chunks
+# and turns that come up again in later requests are only tokenized once. estimate_tokens(), the
+# default, approximates the tokenizers of Llama models for English text without loading one. Pass
+# the tokenizer of the model, such as load_tokenizer_counter(model_dir), for exact counts.
+
+import re
+from functools import lru_cache
+
+# The default token budgets of the retrieved context and of the chat history
+CONTEXT_TOKEN_BUDGET = 512
+CHAT_HISTORY_TOKEN_BUDGET = 256
+
+# The number of texts whose token counts are cached
+TOKEN_CACHE_SIZE = 10000
+
+# A chunk is dropped as a duplicate when this share of its word trigrams is already in the selected chunks
+DUPLICATE_OVERLAP = 0.8
+
+# The separator of the chunks in the context, as in conversion.format_context()
+CHUNK_SEPARATOR = "\n\n"
+
+# The number of characters of a word covered by one token, on average, by the tokenizers of Llama models
+CHARACTERS_PER_TOKEN = 6
+
+WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens of a text: one token per punctuation mark, and one per started
+    CHARACTERS_PER_TOKEN characters of every word.
+    """
+    return sum(-(-len(word) // CHARACTERS_PER_TOKEN) for word in WORD_PATTERN.findall(text))
+
+
+def load_tokenizer_counter(model_dir):
+    """
+    Returns a function that counts the tokens of a text with the tokenizer of a Hugging Face model.
+
+    Parameters:
+        model_dir (str): The directory or name of the model.
+
+    Returns:
+        callable: Returns the number of tokens (int) of a text, without special tokens.
+    """
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def get_trigrams(text):
+    """
+    Returns the set of the lowercase word trigrams of a text, or of its words if it has fewer than three.
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < 3:
+        return {tuple(words)} if words else set()
+    return set(zip(words, words[1:], words[2:]))
+
+
+class ContextPacker:
+    """
+    Packs chunks and chat history into token budgets.
+
+    Parameters:
+        count_tokens (callable): Returns the number of tokens of a text. See estimate_tokens().
+        context_budget (int): The default token budget of the retrieved context.
+        chat_history_budget (int): The default token budget of the chat history.
+        cache_size (int): The number of texts whose token counts are cached.
+    """
+
+    def __init__(self, count_tokens=estimate_tokens, context_budget=CONTEXT_TOKEN_BUDGET,
+                 chat_history_budget=CHAT_HISTORY_TOKEN_BUDGET, cache_size=TOKEN_CACHE_SIZE):
+        self.count_tokens = lru_cache(maxsize=cache_size)(count_tokens)
+        self.context_budget = context_budget
+        self.chat_history_budget = chat_history_budget
+        self.separator_tokens = count_tokens(CHUNK_SEPARATOR)
+
+    def pack_documents(self, docs, budget=None):
+        """
+        Packs retrieved chunks into a token budget.
+
+        Parameters:
+            docs (list): The retrieved documents, from the best ranked, either as Document or as
+                (Document, score), as returned by the retrievers of retrieval.py.
+            budget (int): The token budget. Defaults to context_budget.
+
+        Returns:
+            tuple: The context (str), the chunks joined by CHUNK_SEPARATOR from the best ranked, the
+            texts of those chunks (list), and the statistics of the packing (dict). See get_stats().
+        """
+        budget = self.context_budget if budget is None else budget
+        texts = [(doc[0] if isinstance(doc, tuple) else doc).page_content.strip() for doc in docs]
+
+        selected = []
+        selected_trigrams = set()
+        used = 0
+        duplicates = 0
+        for text in texts:
+            trigrams = get_trigrams(text)
+            if not trigrams or len(trigrams & selected_trigrams) >= DUPLICATE_OVERLAP * len(trigrams):
+                duplicates += 1
+                continue
+            tokens = self.count_tokens(text) + (self.separator_tokens if selected else 0)
+            # Skip the chunks that don't fit, as lower ranked, shorter chunks may still fit
+            if used + tokens > budget:
+                continue
+            selected.append(text)
+            selected_trigrams |= trigrams
+            used += tokens
+
+        all_tokens = sum(self.count_tokens(text) for text in texts) + self.separator_tokens * max(len(texts) - 1, 0)
+        return CHUNK_SEPARATOR.join(selected), selected, self.get_stats(len(texts), len(selected), duplicates, used, all_tokens)
+
+    def pack_chat_history(self, turns, budget=None):
+        """
+        Packs the most recent turns of a conversation that fit into a token budget.
+
+        Parameters:
+            turns (list): The turns of the conversation (str), from the oldest.
+            budget (int): The token budget. Defaults to chat_history_budget.
+
+        Returns:
+            tuple: The chat history (str), the turns kept joined by new lines, and its statistics
+            (dict). See get_stats().
+        """
+        budget = self.chat_history_budget if budget is None else budget
+        newline_tokens = self.count_tokens("\n")
+
+        used = 0
+        first_kept = len(turns)
+        for position in range(len(turns) - 1, -1, -1):
+            tokens = self.count_tokens(turns[position]) + (newline_tokens if position < len(turns) - 1 else 0)
+            if used + tokens > budget:
+                break
+            used += tokens
+            first_kept = position
+
+        all_tokens = sum(self.count_tokens(turn) for turn in turns) + newline_tokens * max(len(turns) - 1, 0)
+        return "\n".join(turns[first_kept:]), self.get_stats(len(turns), len(turns) - first_kept, 0, used, all_tokens)
+
+    def get_stats(self, candidates, selected, duplicates, tokens, all_tokens):
+        """
+        Returns the statistics of a packing.
+
+        Returns:
+            dict: The number of candidate texts, of those selected, and of those dropped as duplicates;
+            the tokens of the packed text, of all the candidates, and saved by packing.
+        """
+        return {
+            "candidates": candidates,
+            "selected": selected,
+            "duplicates": duplicates,
+            "tokens": tokens,
+            "all_tokens": all_tokens,
+            "tokens_saved": all_tokens - tokens
+        }
+
+    def get_cache_info(self):
+        """
+        Returns the hits and misses of the token count cache, as functools.lru_cache.cache_info().
+        """
+        return self.count_tokens.cache_info()
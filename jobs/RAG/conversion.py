@@ -0,0 +1,198 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# The conversion of Elaine's telegraphic replies to full sentences with RAG, shared by rag.py and
+# rag_service.py: the prompt, the language model and the LangChain Expressive Language (LCEL)
+# chain that puts them together.
+#
+# A stub language model can replace Ollama, so the chain can be run and tested without it.
+#
+# stream_convert() and astream_convert() stream the response of a chain token by token as the
+# language model generates it, so the converted sentence can be shown before it is complete, and
+# record the time to the first token and the total time of the call.
+
+import asyncio
+import time
+from langchain_community.chat_models import ChatOllama
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.prompts import ChatPromptTemplate
+
+# The Ollama model to use
+OLLAMA_MODEL = "llama3"
+
+# The system prompt of the language model
+SYSTEM_PROMPT = "Elaine is an AAC user who expresses herself telegraphically. She is now in a meeting with Jutta. Below is the conversation in the meeting. Please help to convert what Elaine said to first-person sentences. Only respond with converted sentences."
+
+# The prompt template
+PROMPT_TEMPLATE_WITH_CONTEXT = """
+### [INST] Help to convert Elaine's telegraphic input in the conversation to full sentences in first-person. Only respond with the converted full sentences. Here is context to help:
+
+{context}
+
+### Conversation:
+{chat} [/INST]
+ """
+
+
+class StubChatModel(BaseChatModel):
+    """
+    A stub chat model that responds with the last line of the conversation in the prompt, so the
+    chain can be run and tested without Ollama. The response is streamed word by word, waiting
+    token_delay seconds before every word, like a language model generating tokens.
+    """
+
+    token_delay: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def _respond(self, messages):
+        lines = [line.strip() for line in messages[-1].content.splitlines()]
+        chat_lines = [line for line in lines if line and not line.startswith("###")]
+        last_line = chat_lines[-1].replace("[/INST]", "").strip() if chat_lines else ""
+        words = f"(stub) {last_line}".split(" ")
+        return [word if position == 0 else f" {word}" for position, word in enumerate(words)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._respond(messages)
+        time.sleep(self.token_delay * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for token in self._respond(messages):
+            time.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        for token in self._respond(messages):
+            await asyncio.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+def create_llm(backend="ollama", model=OLLAMA_MODEL, stub_token_delay=0.0):
+    """
+    Creates the language model.
+
+    Parameters:
+        backend (str): "ollama" to use a model served by Ollama, or "stub" to use StubChatModel,
+            which doesn't need Ollama.
+        model (str): The Ollama model.
+        stub_token_delay (float): The time in seconds the stub takes to generate every word.
+
+    Returns:
+        BaseChatModel: The language model.
+    """
+    if backend == "stub":
+        return StubChatModel(token_delay=stub_token_delay)
+    if backend != "ollama":
+        raise ValueError(f"Unsupported language model backend {backend}. Must be ollama or stub")
+    return ChatOllama(model=model, system=SYSTEM_PROMPT)
+
+
+def create_chain(llm):
+    """
+    Returns the chain that converts a telegraphic reply, which takes the "context" and the "chat"
+    as input and returns the response as a string.
+    """
+    prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE_WITH_CONTEXT)
+    return prompt | llm | StrOutputParser()
+
+
+def format_context(docs):
+    """
+    Returns the text of retrieved documents to fill the context of the prompt.
+    """
+    return "\n\n".join(doc.page_content for doc in docs)
+
+
+def stream_convert(chain, inputs, timing=None):
+    """
+    Runs a chain and yields its response token by token as the language model generates it.
+
+    Parameters:
+        chain (Runnable): A chain that ends with a StrOutputParser, such as the one returned by create_chain().
+        inputs (dict): The inputs of the chain.
+        timing (dict): Optional. Filled with "first_token_ms", the time to the first token, "total_ms",
+            the time to the last one, and "tokens", the number of non-empty tokens, when the response
+            is complete.
+
+    Returns:
+        generator: The tokens (str) of the response.
+    """
+    start_time = time.perf_counter()
+    first_token_time = None
+    tokens = 0
+    for token in chain.stream(inputs):
+        # The output parser can end the stream with an empty chunk
+        if not token:
+            continue
+        if first_token_time is None:
+            first_token_time = time.perf_counter()
+        tokens += 1
+        yield token
+    record_timing(timing, start_time, first_token_time, tokens)
+
+
+async def astream_convert(chain, inputs, timing=None):
+    """
+    The async variant of stream_convert(), which doesn't block the event loop while the language
+    model generates the response.
+
+    Returns:
+        async generator: The tokens (str) of the response.
+    """
+    start_time = time.perf_counter()
+    first_token_time = None
+    tokens = 0
+    async for token in chain.astream(inputs):
+        # The output parser can end the stream with an empty chunk
+        if not token:
+            continue
+        if first_token_time is None:
+            first_token_time = time.perf_counter()
+        tokens += 1
+        yield token
+    record_timing(timing, start_time, first_token_time, tokens)
+
+
+def record_timing(timing, start_time, first_token_time, tokens):
+    """
+    Fills the timing of a streamed call. See stream_convert().
+    """
+    if timing is None:
+        return
+    end_time = time.perf_counter()
+    timing["first_token_ms"] = round(((first_token_time or end_time) - start_time) * 1000, 1)
+    timing["total_ms"] = round((end_time - start_time) * 1000, 1)
+    timing["tokens"] = tokens
+
+
+def print_streamed(tokens, timing):
+    """
+    Prints the tokens of a streamed response as they arrive, then its timing.
+
+    Parameters:
+        tokens (iterable): The tokens returned by stream_convert().
+        timing (dict): The timing passed to stream_convert().
+
+    Returns:
+        str: The whole response.
+    """
+    response = []
+    for token in tokens:
+        print(token, end="", flush=True)
+        response.append(token)
+    if timing.get("cache"):
+        print(f"\n(from the {timing['cache']} tier of the response cache in {timing['total_ms']} ms)\n")
+    else:
+        print(f"\n(first token in {timing['first_token_ms']} ms, {timing['tokens']} tokens in {timing['total_ms']} ms)\n")
+    return "".join(response)
@@ -0,0 +1,198 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# A persistent cache of embeddings, so that texts embedded by a previous run, such as the chunks
+# of the user documents and the test queries, are not embedded again by the model.
+#
+# The embeddings are stored in a SQLite database as float32 blobs, keyed by the embedding model,
+# the kind of text (a document or a query, which some models embed differently) and the SHA-256
+# hash of the text. When the cache holds more than max_entries embeddings, the least recently
+# used ones are evicted.
+#
+# CachedEmbeddings wraps the embedding model as a langchain Embeddings, so it can be passed to
+# FAISS.from_documents() and used by the retriever. The model is only loaded on the first cache
+# miss, so a run where every text is cached doesn't load it at all.
+
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# The maximum number of texts looked up in one SQL query, below the default SQLite limit of variables
+LOOKUP_BATCH_SIZE = 500
+
+
+def embed_query_batch(embeddings, texts):
+    """
+    Embeds queries with the query encoding of a model, in one call of the model when it can.
+
+    The HuggingFaceEmbeddings of langchain_huggingface encode queries with query_encode_kwargs,
+    such as the prompt of a model with a query instruction, which embed_query() only applies to one
+    text at a time. The whole batch is encoded with them here. Other embeddings embed the queries
+    one at a time with embed_query().
+
+    Parameters:
+        embeddings (Embeddings): The embeddings, such as HuggingFaceEmbeddings.
+        texts (list): The query strings.
+
+    Returns:
+        list: The embedding of every query.
+    """
+    query_encode_kwargs = getattr(embeddings, "query_encode_kwargs", None)
+    client = getattr(embeddings, "client", None)
+    if query_encode_kwargs is None or client is None or getattr(embeddings, "multi_process", False):
+        return [embeddings.embed_query(text) for text in texts]
+
+    # As HuggingFaceEmbeddings.embed_query(), which falls back to encode_kwargs without query settings
+    encode_kwargs = query_encode_kwargs or embeddings.encode_kwargs
+    texts = [text.replace("\n", " ") for text in texts]
+    return client.encode(texts, show_progress_bar=getattr(embeddings, "show_progress", False), **encode_kwargs).tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings backed by a persistent SQLite cache.
+
+    Parameters:
+        load_embeddings (callable): Returns the embeddings to cache, such as
+            functools.partial(HuggingFaceEmbeddings, model_name=model_dir). Called on the first cache miss.
+        cache_path (str): The path of the SQLite database.
+        model_id (str): Identifies the embedding model, such as the path of the sentence transformer model.
+        max_entries (int): The maximum number of embeddings kept in the cache. None means no limit.
+    """
+
+    def __init__(self, load_embeddings, cache_path, model_id, max_entries=100000):
+        self.load_embeddings = load_embeddings
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._embeddings = None
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, kind TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (model, kind, text_hash))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._connection.commit()
+
+    @property
+    def embeddings(self):
+        """
+        The wrapped embeddings, loaded on first use.
+        """
+        if self._embeddings is None:
+            self._embeddings = self.load_embeddings()
+        return self._embeddings
+
+    def embed_documents(self, texts):
+        """
+        Returns the embeddings of documents, embedding only the texts that are not cached.
+        """
+        return self._embed(texts, "document", lambda missing: self.embeddings.embed_documents(missing))
+
+    def embed_query(self, text):
+        """
+        Returns the embedding of a query, embedding it only if it is not cached.
+        """
+        return self._embed([text], "query", lambda missing: [self.embeddings.embed_query(missing[0])])[0]
+
+    def embed_queries(self, texts):
+        """
+        Returns the embeddings of queries, embedding the texts that are not cached in one batch with
+        the query encoding of the model. See embed_query_batch().
+        """
+        return self._embed(list(texts), "query", lambda missing: embed_query_batch(self.embeddings, missing))
+
+    def get_stats(self):
+        """
+        Returns the hits, misses and hit rate of the cache since it was opened, and the number of
+        embeddings it holds.
+        """
+        with self._lock:
+            (entries,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries
+        }
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        self._connection.close()
+
+    def _embed(self, texts, kind, embed_missing):
+        hashes = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+        with self._lock:
+            vectors = self._lookup(kind, hashes)
+            found = sum(1 for text_hash in hashes if text_hash in vectors)
+            self.hits += found
+            self.misses += len(texts) - found
+
+        # Embed every missing text once, even if it is repeated
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in vectors:
+                missing.setdefault(text_hash, text)
+
+        if missing:
+            embedded = embed_missing(list(missing.values()))
+            now = time.time()
+            rows = []
+            for text_hash, vector in zip(missing, embedded):
+                vector = np.asarray(vector, dtype=np.float32)
+                vectors[text_hash] = vector
+                rows.append((self.model_id, kind, text_hash, vector.tobytes(), now))
+            with self._lock:
+                self._connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+                self._evict()
+                self._connection.commit()
+
+        return [vectors[text_hash].tolist() for text_hash in hashes]
+
+    def _lookup(self, kind, hashes):
+        # Returns the cached vectors of the hashes and marks them as used
+        vectors = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        for start in range(0, len(unique_hashes), LOOKUP_BATCH_SIZE):
+            batch = unique_hashes[start:start + LOOKUP_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            rows = self._connection.execute(
+                f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND kind = ? AND text_hash IN ({placeholders})",
+                [self.model_id, kind] + batch
+            )
+            for text_hash, blob in rows:
+                vectors[text_hash] = np.frombuffer(blob, dtype=np.float32)
+
+        if vectors:
+            now = time.time()
+            self._connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND kind = ? AND text_hash = ?",
+                [(now, self.model_id, kind, text_hash) for text_hash in vectors]
+            )
+            self._connection.commit()
+        return vectors
+
+    def _evict(self):
+        # Deletes the least recently used embeddings beyond max_entries
+        if self.max_entries is None:
+            return
+        (entries,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if entries > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                (entries - self.max_entries,)
+            )
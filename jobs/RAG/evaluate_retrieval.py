@@ -0,0 +1,116 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# Evaluates the retrieval of rag.py over a set of telegraphic test queries.
+#
+# The test queries are read from a tab-separated file with one query per line, followed by a
+# text expected in one of the retrieved chunks, such as "Roy nephew<TAB>nephew whose name is Roy".
+# The script retrieves the top k chunks of every query, one query at a time with the retriever as
+# rag.py used to, all queries in one batch with retrieve_batch(), and all queries with the hybrid
+# BM25 and dense HybridRetriever. It reports the hit rate, the share of the queries with the
+# expected text in their top k chunks, and the time per query of every way. For the hybrid
+# retriever, it also reports how many queries were answered by the lexical index alone.
+#
+# The queries are embedded by the model in every way, so the times compare the model, not the
+# embedding cache: with the cache, the batched way would store the query embeddings and the hybrid
+# way would read them back from SQLite. Pass --cache to use the embedding cache as rag.py does.
+#
+# Usage: python evaluate_retrieval.py <sentence_transformer_model_directory> [--queries PATH] [--k N] [--cache]
+
+import argparse
+import os
+import sys
+import time
+from functools import partial
+from langchain_huggingface import HuggingFaceEmbeddings
+from bm25_index import load_bm25_index
+from embedding_cache import CachedEmbeddings
+from retrieval import HybridRetriever, retrieve_batch
+from vector_store import load_vector_store
+
+# The locations of the user document, its vector database and the embedding cache, as in rag.py
+user_doc = "./data/user_doc.txt"
+index_dir = "./data/faiss_index"
+embedding_cache = "./data/embedding_cache.sqlite"
+
+
+def load_test_queries(queries_path):
+    """
+    Loads the test queries and their expected texts from a tab-separated file. Empty lines and
+    lines starting with # are skipped.
+
+    Returns:
+        list: (query, expected text) of every test query.
+    """
+    test_queries = []
+    with open(queries_path, "r", encoding="utf-8") as queries_file:
+        for line in queries_file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            query, expected = line.split("\t", 1)
+            test_queries.append((query, expected))
+    return test_queries
+
+
+def is_hit(docs, expected):
+    """
+    Returns whether the expected text is in one of the retrieved documents, ignoring case.
+    """
+    return any(expected.lower() in doc.page_content.lower() for doc in docs)
+
+
+def report(name, test_queries, retrieved_docs, elapsed):
+    """
+    Prints the hit rate and the time per query of one way of retrieving.
+    """
+    hits = sum(1 for (_, expected), docs in zip(test_queries, retrieved_docs) if is_hit(docs, expected))
+    print(f"{name:<10} hit rate {hits}/{len(test_queries)} ({hits / len(test_queries):.0%})  "
+          f"{elapsed:.3f}s in total, {elapsed * 1000 / len(test_queries):.2f} ms per query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the retrieval of rag.py over a set of test queries.")
+    parser.add_argument("sentence_transformer_dir", help="The directory of the sentence transformer model.")
+    parser.add_argument("--queries", default="./data/test_queries.tsv", help="The tab-separated file of test queries and expected texts.")
+    parser.add_argument("--k", type=int, default=4, help="The number of chunks retrieved per query.")
+    parser.add_argument("--cache", action="store_true", help="Embed with the embedding cache of rag.py. The times then include cache hits.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.sentence_transformer_dir):
+        print(f"Error: Sentence transformer model directory {args.sentence_transformer_dir} not found")
+        sys.exit(1)
+
+    try:
+        test_queries = load_test_queries(args.queries)
+    except (OSError, ValueError) as e:
+        print(f"Error: Invalid test queries {args.queries}: {e}")
+        sys.exit(1)
+
+    model_id = os.path.abspath(args.sentence_transformer_dir)
+    if args.cache:
+        embedding_func = CachedEmbeddings(partial(HuggingFaceEmbeddings, model_name=args.sentence_transformer_dir), embedding_cache, model_id)
+    else:
+        embedding_func = HuggingFaceEmbeddings(model_name=args.sentence_transformer_dir)
+    vectordb = load_vector_store([user_doc], embedding_func, index_dir, model_id)
+    queries = [query for query, _ in test_queries]
+
+    retriever = vectordb.as_retriever(search_kwargs={"k": args.k})
+    start_time = time.perf_counter()
+    loop_docs = [retriever.invoke(query) for query in queries]
+    report("one by one", test_queries, loop_docs, time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    batch_results = retrieve_batch(vectordb, queries, args.k)
+    report("batched", test_queries, [[doc for doc, _ in results] for results in batch_results], time.perf_counter() - start_time)
+
+    hybrid_retriever = HybridRetriever(vectordb, load_bm25_index(vectordb, index_dir))
+    start_time = time.perf_counter()
+    hybrid_results = hybrid_retriever.retrieve_batch(queries, args.k)
+    report("hybrid", test_queries, [[doc for doc, _ in results] for results in hybrid_results], time.perf_counter() - start_time)
+    print(f"{hybrid_retriever.lexical_only} of {len(queries)} queries answered by the lexical index without the dense pass")
@@ -8,13 +8,15 @@
 
 import sys
 import os
-from langchain_community.document_loaders import TextLoader
-from langchain_text_splitters import CharacterTextSplitter
-from langchain_community.vectorstores import FAISS
+from functools import partial
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.chat_models import ChatOllama
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
+from conversion import OLLAMA_MODEL, create_chain, create_llm, print_streamed
+from bm25_index import load_bm25_index
+from context_packer import ContextPacker
+from embedding_cache import CachedEmbeddings
+from response_cache import ResponseCache, stream_cached_convert
+from retrieval import HybridRetriever
+from vector_store import load_vector_store
 
 
 # A utility function that prints the script usage then exit
@@ -34,59 +36,75 @@ else:
 # The location of the user document
 user_doc = "./data/user_doc.txt"
 
-loader = TextLoader(user_doc)
-documents = loader.load()
+# The directory where the vector database is persisted between runs
+index_dir = "./data/faiss_index"
 
-text_splitter = CharacterTextSplitter(chunk_size=200, chunk_overlap=0)
-splitted_docs = text_splitter.split_documents(documents)
+# The FAISS index type: flat, sq8, hnsw, ivf, ivfpq, or auto to choose it by the number of chunks. See ann_index.py.
+index_type = "flat"
 
-# Instantiate the embedding class
-embedding_func = HuggingFaceEmbeddings(model_name=sentence_transformer_dir)
+# The database that caches the embeddings of the chunks and queries between runs
+embedding_cache = "./data/embedding_cache.sqlite"
 
-# Load into the vector database
-vectordb = FAISS.from_documents(splitted_docs, embedding_func)
+# The database that caches the responses of the language model between runs
+response_cache = "./data/response_cache.sqlite"
 
-# Create a vector store retriever
-retriever = vectordb.as_retriever()
+# Instantiate the embedding class. The sentence transformer model is only loaded when a text is not in the cache.
+embedding_func = CachedEmbeddings(partial(HuggingFaceEmbeddings, model_name=sentence_transformer_dir), embedding_cache,
+                                  os.path.abspath(sentence_transformer_dir))
+
+# Load the vector database, only embedding the chunks of the user document that are new since the last run
+vectordb = load_vector_store([user_doc], embedding_func, index_dir, os.path.abspath(sentence_transformer_dir), chunk_size=200, chunk_overlap=0,
+                             index_type=index_type)
+
+# Create a hybrid retriever, which matches the words of telegraphic queries with a BM25 index of the chunks and
+# only searches the vector db for the queries whose words don't identify a chunk
+retriever = HybridRetriever(vectordb, load_bm25_index(vectordb, index_dir))
 
 # query the vector db to test
 queries = [
     "Roy nephew",
     "high school"]
 
-for query in queries:
-    results = retriever.invoke(query)
-    print(f"====== Test: Similarity search for \"{query}\" ======\n{results[0].page_content}\n\n")
-
-# Create prompt template
-prompt_template_with_context = """
-### [INST] Help to convert Elaine's telegraphic input in the conversation to full sentences in first-person. Only respond with the converted full sentences. Here is context to help:
+# Retrieve the chunks of all queries in one batch
+for query, results in zip(queries, retriever.retrieve_batch(queries)):
+    print(f"====== Test: Similarity search for \"{query}\" ======\n{results[0][0].page_content}\n\n")
 
-{context}
+stats = embedding_func.get_stats()
+print(f"====== Embedding cache: {stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.0%}, {stats['entries']} entries ======\n")
 
-### Conversation:
-{chat} [/INST]
- """
+# Create the language model and the conversion chain. See conversion.py for the prompt.
+llm = create_llm("ollama")
+chain = create_chain(llm)
 
-llm = ChatOllama(model="llama3", system="Elaine is an AAC user who expresses herself telegraphically. She is now in a meeting with Jutta. Below is the conversation in the meeting. Please help to convert what Elaine said to first-person sentences. Only respond with converted sentences.")
-prompt = ChatPromptTemplate.from_template(prompt_template_with_context)
+# Cache the responses, so a reply converted before in the same or a similar context is not generated again.
+# The cache matches the replies and contexts with the embeddings of the vector db. See response_cache.py.
+cache = ResponseCache(response_cache, f"{OLLAMA_MODEL}:rag", embedding_func)
 
+jutta_question = "Jutta: Elaine, who would you like to invite to your birthday party?"
 elaine_reply = "Roy nephew"
-full_chat = f"Jutta: Elaine, who would you like to invite to your birthday party?\n Elaine: {elaine_reply}."
-
-# using LangChain Expressive Language (LCEL) chain syntax
-chain = prompt | llm | StrOutputParser()
+full_chat = f"{jutta_question}\n Elaine: {elaine_reply}."
 
+# Stream the responses, printing the tokens as they are generated
 print("====== Response without RAG ======")
 
-print(chain.invoke({
+timing = {}
+print_streamed(stream_cached_convert(cache, chain, {
     "context": "",
     "chat": full_chat
-}) + "\n")
+}, elaine_reply, jutta_question, timing), timing)
 
 print("====== Response with RAG ======")
 
-print(chain.invoke({
-    "context": retriever.invoke(elaine_reply),
+# Retrieve more chunks than fit, and pack the best ranked ones without duplicates into the token budget of the context
+context, _, packing = ContextPacker().pack_documents(retriever.retrieve_batch([elaine_reply], k=8)[0])
+print(f"(context: {packing['selected']} of {packing['candidates']} chunks, {packing['tokens']} tokens, {packing['tokens_saved']} tokens saved)\n")
+
+timing = {}
+print_streamed(stream_cached_convert(cache, chain, {
+    "context": context,
     "chat": full_chat
-}) + "\n")
+}, elaine_reply, f"{context}\n{jutta_question}", timing), timing)
+
+stats = cache.get_stats()
+print(f"====== Response cache: {stats['exact_hits']} exact hits, {stats['semantic_hits']} semantic hits, {stats['misses']} misses, "
+      f"{stats['entries']} entries ======\n")
@@ -0,0 +1,327 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# A long-running local HTTP service for retrieval and conversion.
+#
+# rag.py is a one-shot script: every run imports langchain, loads the sentence transformer model,
+# loads the vector database and connects to Ollama before it converts anything. This service does
+# all of that once at startup, builds or loads the BM25 index of the chunks, and keeps them warm, so
+# a request only pays for the retrieval and the generation. It is built on asyncio with no other
+# dependency. Requests are served concurrently: the retrieval runs in a thread pool and the language
+# model is called with the async API of the chain. Chunks are retrieved with the hybrid retriever of
+# rag.py (see retrieval.py), so the service and rag.py return the same chunks, and the queries with
+# confident lexical hits are not embedded.
+#
+# Endpoints (JSON in and out):
+# * GET /health: {"status": "ok", "chunks": number of chunks in the vector database, "retrieval": {"lexical_only": ...,
+#   "fused": ...}}, the number of queries answered by the BM25 index alone and with the dense pass, with the
+#   statistics of the response cache as "response_cache"
+# * POST /retrieve {"queries": ["Roy nephew", ...], "k": 4}: the top k chunks of every query,
+#   retrieved in one batch, as {"results": [[{"content": ..., "score": ...}, ...], ...]}. Higher scores are better,
+#   see HybridRetriever.retrieve_batch()
+# * POST /convert {"message": "Roy nephew", "chat": "Jutta: Who would you like to invite?", "use_rag": true}:
+#   converts Elaine's telegraphic message, which continues the chat, to full sentences, as
+#   {"response": ..., "cached": ..., "context": [...], "prompt_tokens": {...}}. "chat" and "use_rag" are optional. The retrieved
+#   chunks and the chat are packed into token budgets (see context_packer.py). "context" is the chunks in the prompt,
+#   without the ones dropped as duplicates or over the budget, and "prompt_tokens" reports the
+#   tokens of both in the prompt and the tokens saved by packing. Responses are cached (see response_cache.py), and
+#   "cached" is the tier of the cache that returned the response, "exact" or "semantic", or null if it was generated.
+#
+# Every response has a "timing_ms" member with the time spent in each step, and every request is
+# logged with its total time. The response of the language model is streamed, and /convert also
+# reports "llm_first_token", the time the language model took to generate its first token.
+#
+# Usage: python rag_service.py <sentence_transformer_model_directory> [--host HOST] [--port N] [--llm ollama|stub]
+#        [--ollama-model MODEL] [--stub-token-delay SECONDS] [--k N] [--no-response-cache] [--context-budget N] [--chat-budget N]
+#
+# Example: curl -X POST localhost:8000/convert -d '{"message": "Roy nephew", "chat": "Jutta: Elaine, who would you like to invite to your birthday party?"}'
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from functools import partial
+from langchain_huggingface import HuggingFaceEmbeddings
+from context_packer import CHAT_HISTORY_TOKEN_BUDGET, CONTEXT_TOKEN_BUDGET, ContextPacker
+from conversion import OLLAMA_MODEL, create_chain, create_llm
+from bm25_index import load_bm25_index
+from embedding_cache import CachedEmbeddings
+from response_cache import ResponseCache, astream_cached_convert
+from retrieval import HybridRetriever
+from vector_store import load_vector_store
+
+# The locations of the user document, its vector database and the embedding cache, as in rag.py
+user_doc = "./data/user_doc.txt"
+index_dir = "./data/faiss_index"
+embedding_cache = "./data/embedding_cache.sqlite"
+response_cache = "./data/response_cache.sqlite"
+
+# The maximum size of a request body
+MAX_BODY_BYTES = 1 << 20
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+                500: "Internal Server Error"}
+
+
+class RequestError(Exception):
+    """
+    An error in a request, returned to the client with an HTTP status.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RagService:
+    """
+    The retrieval and conversion service, which holds the warm retriever and chain.
+
+    Parameters:
+        retriever (HybridRetriever): The retriever of the vector database and BM25 index of the user documents.
+        chain (Runnable): The conversion chain returned by conversion.create_chain().
+        k (int): The default number of chunks retrieved per query.
+        packer (ContextPacker): Packs the retrieved chunks and the chat into the prompt. Defaults to a
+            ContextPacker with the default token budgets.
+        response_cache (ResponseCache): Caches the responses of the conversions. None disables the cache.
+    """
+
+    def __init__(self, retriever, chain, k=4, packer=None, response_cache=None):
+        self.retriever = retriever
+        self.chain = chain
+        self.k = k
+        self.packer = packer or ContextPacker()
+        self.response_cache = response_cache
+
+    def health(self, body):
+        payload = {
+            "status": "ok",
+            "chunks": self.retriever.vectordb.index.ntotal,
+            "retrieval": {"lexical_only": self.retriever.lexical_only, "fused": self.retriever.fused}
+        }
+        if self.response_cache is not None:
+            payload["response_cache"] = self.response_cache.get_stats()
+        return payload, {}
+
+    async def retrieve(self, body):
+        queries = body.get("queries")
+        if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+            raise RequestError(400, "\"queries\" must be a list of strings")
+        k = get_int(body, "k", self.k)
+
+        start_time = time.perf_counter()
+        results = await asyncio.get_running_loop().run_in_executor(None, self.retriever.retrieve_batch, queries, k)
+        timing = {"retrieve": elapsed_ms(start_time)}
+        return {"results": [[{"content": doc.page_content, "score": score} for doc, score in query_results] for query_results in results]}, timing
+
+    async def convert(self, body):
+        message = body.get("message")
+        chat = body.get("chat", "")
+        if not isinstance(message, str) or not message.strip() or not isinstance(chat, str):
+            raise RequestError(400, "\"message\" must be a non-empty string and \"chat\" a string")
+        use_rag = body.get("use_rag", True)
+        if not isinstance(use_rag, bool):
+            raise RequestError(400, "\"use_rag\" must be a boolean")
+
+        timing = {}
+        docs = []
+        if use_rag:
+            start_time = time.perf_counter()
+            results = await asyncio.get_running_loop().run_in_executor(None, self.retriever.retrieve_batch, [message], self.k)
+            docs = [doc for doc, _ in results[0]]
+            timing["retrieve"] = elapsed_ms(start_time)
+
+        # Bound the prompt: the chunks without duplicates and the most recent turns of the chat that fit in their budgets
+        context, context_texts, context_packing = self.packer.pack_documents(docs)
+        chat, chat_packing = self.packer.pack_chat_history(chat.splitlines())
+        full_chat = f"{chat}\n Elaine: {message}." if chat else f"Elaine: {message}."
+
+        llm_timing = {}
+        tokens = [token async for token in astream_cached_convert(self.response_cache, self.chain, {"context": context, "chat": full_chat},
+                                                                  message, f"{context}\n{chat}", llm_timing)]
+        timing["llm_first_token"] = llm_timing["first_token_ms"]
+        timing["llm"] = llm_timing["total_ms"]
+        response = "".join(tokens)
+        return {
+            "response": response,
+            "cached": llm_timing.get("cache"),
+            "context": context_texts,
+            "prompt_tokens": {
+                "context": context_packing["tokens"],
+                "chat": chat_packing["tokens"],
+                "saved": context_packing["tokens_saved"] + chat_packing["tokens_saved"]
+            }
+        }, timing
+
+    async def handle(self, method, path, body):
+        """
+        Dispatches a request to its endpoint.
+
+        Returns:
+            tuple: The response payload (dict) and the time spent in each step (dict).
+        """
+        routes = {"/health": ("GET", self.health), "/retrieve": ("POST", self.retrieve), "/convert": ("POST", self.convert)}
+        if path not in routes:
+            raise RequestError(404, f"Unknown endpoint {path}")
+        route_method, handler = routes[path]
+        if method != route_method:
+            raise RequestError(405, f"{path} only accepts {route_method}")
+        result = handler(body)
+        return await result if asyncio.iscoroutine(result) else result
+
+
+def get_int(body, name, default):
+    """
+    Returns a positive integer member of a request body, or a default if it is missing.
+    """
+    value = body.get(name, default)
+    # bool is a subclass of int, but true is not a valid count
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise RequestError(400, f"\"{name}\" must be a positive integer")
+    return value
+
+
+def elapsed_ms(start_time):
+    """
+    Returns the time in milliseconds since a time.perf_counter() value, rounded to 0.1 ms.
+    """
+    return round((time.perf_counter() - start_time) * 1000, 1)
+
+
+async def read_request(reader):
+    """
+    Reads an HTTP request.
+
+    Returns:
+        tuple: (method, path, headers, body), or None if the client closed the connection.
+    """
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise RequestError(400, "Invalid request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0) or 0)
+    except ValueError:
+        raise RequestError(400, "Invalid Content-Length")
+    if length < 0:
+        raise RequestError(400, "Invalid Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise RequestError(413, f"The request body is larger than {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), path.split("?", 1)[0], headers, body
+
+
+def encode_response(status, payload, keep_alive):
+    """
+    Returns an HTTP response with a JSON payload.
+    """
+    content = json.dumps(payload).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(content)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode("latin-1") + content
+
+
+async def handle_connection(service, reader, writer):
+    """
+    Serves the requests of one client connection until it is closed.
+    """
+    try:
+        while True:
+            start_time = time.perf_counter()
+            keep_alive = False
+            method = path = "-"
+            try:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    body = json.loads(body) if body else {}
+                except ValueError:
+                    raise RequestError(400, "The request body is not valid JSON")
+                if not isinstance(body, dict):
+                    raise RequestError(400, "The request body must be a JSON object")
+                payload, timing = await service.handle(method, path, body)
+                status = 200
+            except RequestError as e:
+                payload, timing, status = {"error": str(e)}, {}, e.status
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            except Exception as e:
+                payload, timing, status = {"error": f"{type(e).__name__}: {e}"}, {}, 500
+
+            timing["total"] = elapsed_ms(start_time)
+            payload["timing_ms"] = timing
+            writer.write(encode_response(status, payload, keep_alive))
+            await writer.drain()
+            print(f"{method} {path} {status} {timing['total']} ms")
+            if not keep_alive:
+                break
+    finally:
+        writer.close()
+
+
+async def serve(service, host, port):
+    """
+    Runs the HTTP service until it is interrupted.
+    """
+    server = await asyncio.start_server(partial(handle_connection, service), host, port)
+    print(f"Serving on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve retrieval and conversion of telegraphic replies over HTTP.")
+    parser.add_argument("sentence_transformer_dir", help="The directory of the sentence transformer model.")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="The port to listen on.")
+    parser.add_argument("--llm", choices=("ollama", "stub"), default="ollama", help="The language model backend. stub doesn't need Ollama.")
+    parser.add_argument("--ollama-model", default=OLLAMA_MODEL, help="The Ollama model to use.")
+    parser.add_argument("--stub-token-delay", type=float, default=0.0, help="The time in seconds the stub language model takes to generate every word.")
+    parser.add_argument("--k", type=int, default=4, help="The number of chunks retrieved per query by default.")
+    parser.add_argument("--no-response-cache", action="store_true", help="Generate every response instead of returning cached ones.")
+    parser.add_argument("--context-budget", type=int, default=CONTEXT_TOKEN_BUDGET, help="The token budget of the retrieved context in the prompt.")
+    parser.add_argument("--chat-budget", type=int, default=CHAT_HISTORY_TOKEN_BUDGET, help="The token budget of the chat in the prompt.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.sentence_transformer_dir):
+        print(f"Error: Sentence transformer model directory {args.sentence_transformer_dir} not found")
+        sys.exit(1)
+
+    # Load everything once, and embed a query so the model is warm before the first request
+    model_id = os.path.abspath(args.sentence_transformer_dir)
+    embedding_func = CachedEmbeddings(partial(HuggingFaceEmbeddings, model_name=args.sentence_transformer_dir), embedding_cache, model_id)
+    vectordb = load_vector_store([user_doc], embedding_func, index_dir, model_id)
+    retriever = HybridRetriever(vectordb, load_bm25_index(vectordb, index_dir))
+    embedding_func.embeddings.embed_query("warm up")
+    packer = ContextPacker(context_budget=args.context_budget, chat_history_budget=args.chat_budget)
+    cache = None if args.no_response_cache else ResponseCache(response_cache, f"{args.ollama_model if args.llm == 'ollama' else 'stub'}:rag", embedding_func)
+    service = RagService(retriever, create_chain(create_llm(args.llm, args.ollama_model, args.stub_token_delay)), args.k, packer, cache)
+
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
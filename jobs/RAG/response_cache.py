@@ -0,0 +1,333 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# A persistent cache of the responses of the conversion chains, so the telegraphic replies that come
+# up again and again, such as "yes want" or "Roy nephew", don't cost a generation of the language
+# model every time.
+#
+# A response is cached with its telegraphic message and its context, the text of every other input
+# of the prompt, such as the retrieved chunks and the chat. A lookup has two tiers:
+# 1. Exact: the normalized message (lowercase, without punctuation or extra spaces) and the SHA-256
+#    digest of the context are the same as a cached response.
+# 2. Semantic: the embeddings of both the message and the context are at least similarity_threshold
+#    similar (cosine) to those of a cached response. The most similar message wins. This tier needs
+#    an embedding function, and is skipped without one.
+#
+# The responses are stored in a SQLite database with the embeddings as float32 blobs, and the
+# embeddings of the cached responses are also kept in memory as matrices for the semantic tier.
+# Responses older than ttl seconds expire, and when the cache holds more than max_entries
+# responses, the least recently used ones are evicted. The responses are cached per namespace,
+# which identifies the language model and the prompt, as a response is only valid for the prompt
+# that generated it.
+
+import asyncio
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+from conversion import astream_convert, stream_convert
+
+# The default cosine similarity of the message and the context for a semantic hit
+SIMILARITY_THRESHOLD = 0.95
+
+# The default lifetime of a cached response: 30 days
+RESPONSE_TTL = 30 * 24 * 60 * 60
+
+NORMALIZE_PATTERN = re.compile(r"[^\w\s']+")
+
+
+def normalize_message(message):
+    """
+    Normalizes a telegraphic message for the exact tier: lowercase, with punctuation replaced by
+    spaces and runs of spaces collapsed, so "Roy nephew." and "roy  nephew" are the same.
+    """
+    return " ".join(NORMALIZE_PATTERN.sub(" ", message.lower()).split())
+
+
+def get_context_digest(context):
+    """
+    Returns the SHA-256 digest of a context, ignoring the differences of spaces.
+    """
+    return hashlib.sha256(" ".join(context.split()).encode("utf-8")).hexdigest()
+
+
+def normalize_vector(vector):
+    """
+    Returns a vector as float32 with a norm of 1, so dot products are cosine similarities.
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class ResponseCache:
+    """
+    A two-tier response cache backed by SQLite.
+
+    Parameters:
+        cache_path (str): The path of the SQLite database.
+        namespace (str): Identifies the language model and the prompt of the responses, such as "llama3:rag".
+        embedding_func (Embeddings): Embeds the messages and contexts for the semantic tier, such as
+            the CachedEmbeddings of the vector store. None disables the semantic tier.
+        similarity_threshold (float): The minimum cosine similarity of both the message and the context
+            for a semantic hit.
+        max_entries (int): The maximum number of responses kept in the namespace. None means no limit.
+        ttl (float): The number of seconds a response stays valid. None means it never expires.
+    """
+
+    def __init__(self, cache_path, namespace, embedding_func=None, similarity_threshold=SIMILARITY_THRESHOLD, max_entries=10000,
+                 ttl=RESPONSE_TTL):
+        self.namespace = namespace
+        self.embedding_func = embedding_func
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, response TEXT NOT NULL, message_vector BLOB, context_vector BLOB, "
+            "created REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (namespace, key))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (namespace, last_used)")
+        with self._lock:
+            self._expire()
+            self._connection.commit()
+            self._load_vectors()
+
+    def get_key(self, message, context):
+        """
+        Returns the exact key of a message and its context.
+        """
+        return hashlib.sha256(f"{normalize_message(message)}\0{get_context_digest(context)}".encode("utf-8")).hexdigest()
+
+    def embed(self, message, context):
+        """
+        Returns the normalized embeddings of a message and its context, or None without an embedding function.
+        """
+        if self.embedding_func is None:
+            return None
+        message_vector, context_vector = self.embedding_func.embed_documents([normalize_message(message), context])
+        return normalize_vector(message_vector), normalize_vector(context_vector)
+
+    def lookup(self, message, context):
+        """
+        Looks up the cached response of a message in a context.
+
+        Parameters:
+            message (str): The telegraphic message.
+            context (str): The text of the other inputs of the prompt.
+
+        Returns:
+            tuple: The cached response (str) or None, the tier of the hit, "exact", "semantic" or None,
+            and the embeddings of the message and context, to pass to store() on a miss. They are None
+            unless the semantic tier was searched.
+        """
+        key = self.get_key(message, context)
+        with self._lock:
+            response = self._get(key)
+            if response is not None:
+                self.exact_hits += 1
+                return response, "exact", None
+
+        vectors = self.embed(message, context)
+        with self._lock:
+            if vectors is not None and self._keys:
+                message_scores = self._message_vectors @ vectors[0]
+                context_scores = self._context_vectors @ vectors[1]
+                candidates = np.flatnonzero((message_scores >= self.similarity_threshold) & (context_scores >= self.similarity_threshold))
+                for position in candidates[np.argsort(-message_scores[candidates], kind="stable")]:
+                    response = self._get(self._keys[position])
+                    if response is not None:
+                        self.semantic_hits += 1
+                        return response, "semantic", vectors
+            self.misses += 1
+        return None, None, vectors
+
+    def store(self, message, context, response, vectors=None):
+        """
+        Caches the response of a message in a context.
+
+        Parameters:
+            message (str): The telegraphic message.
+            context (str): The text of the other inputs of the prompt.
+            response (str): The response of the language model.
+            vectors (tuple): The embeddings returned by lookup(), so they are not computed again.
+        """
+        if vectors is None:
+            vectors = self.embed(message, context)
+        key = self.get_key(message, context)
+        message_blob, context_blob = (vectors[0].tobytes(), vectors[1].tobytes()) if vectors is not None else (None, None)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.namespace, key, response, message_blob, context_blob, now, now)
+            )
+            evicted = self._expire() + self._evict()
+            self._connection.commit()
+            if evicted:
+                self._load_vectors()
+            elif vectors is not None:
+                self._add_vectors([key], [vectors[0]], [vectors[1]])
+
+    def get_stats(self):
+        """
+        Returns the exact hits, semantic hits, misses and hit rate of the cache since it was opened,
+        and the number of responses it holds in the namespace.
+        """
+        with self._lock:
+            (entries,) = self._connection.execute("SELECT COUNT(*) FROM responses WHERE namespace = ?", (self.namespace,)).fetchone()
+        hits = self.exact_hits + self.semantic_hits
+        lookups = hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries
+        }
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        self._connection.close()
+
+    def _get(self, key):
+        # Returns the response of a key if it has not expired, and marks it as used
+        now = time.time()
+        row = self._connection.execute(
+            "SELECT response, created FROM responses WHERE namespace = ? AND key = ?", (self.namespace, key)
+        ).fetchone()
+        if row is None or (self.ttl is not None and row[1] < now - self.ttl):
+            return None
+        self._connection.execute("UPDATE responses SET last_used = ? WHERE namespace = ? AND key = ?", (now, self.namespace, key))
+        self._connection.commit()
+        return row[0]
+
+    def _expire(self):
+        # Deletes the responses older than ttl, and returns how many were deleted
+        if self.ttl is None:
+            return 0
+        cursor = self._connection.execute("DELETE FROM responses WHERE namespace = ? AND created < ?", (self.namespace, time.time() - self.ttl))
+        return cursor.rowcount
+
+    def _evict(self):
+        # Deletes the least recently used responses beyond max_entries, and returns how many were deleted
+        if self.max_entries is None:
+            return 0
+        (entries,) = self._connection.execute("SELECT COUNT(*) FROM responses WHERE namespace = ?", (self.namespace,)).fetchone()
+        if entries <= self.max_entries:
+            return 0
+        cursor = self._connection.execute(
+            "DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses WHERE namespace = ? ORDER BY last_used LIMIT ?)",
+            (self.namespace, entries - self.max_entries)
+        )
+        return cursor.rowcount
+
+    def _load_vectors(self):
+        # Loads the embeddings of the cached responses of the namespace for the semantic tier
+        self._keys = []
+        self._message_vectors = None
+        self._context_vectors = None
+        rows = self._connection.execute(
+            "SELECT key, message_vector, context_vector FROM responses WHERE namespace = ? AND message_vector IS NOT NULL",
+            (self.namespace,)
+        ).fetchall()
+        if rows:
+            self._add_vectors([key for key, _, _ in rows], [np.frombuffer(blob, dtype=np.float32) for _, blob, _ in rows],
+                              [np.frombuffer(blob, dtype=np.float32) for _, _, blob in rows])
+
+    def _add_vectors(self, keys, message_vectors, context_vectors):
+        # Appends embeddings to the matrices of the semantic tier. A key stored again keeps its old row, which
+        # points to the same response.
+        if self._message_vectors is None:
+            self._message_vectors = np.vstack(message_vectors)
+            self._context_vectors = np.vstack(context_vectors)
+        else:
+            self._message_vectors = np.vstack([self._message_vectors] + message_vectors)
+            self._context_vectors = np.vstack([self._context_vectors] + context_vectors)
+        self._keys.extend(keys)
+
+
+def stream_cached_convert(cache, chain, inputs, message, context, timing=None):
+    """
+    Streams the response of a chain like conversion.stream_convert(), returning the cached response
+    as a single token when there is one, and caching the response otherwise.
+
+    Parameters:
+        cache (ResponseCache): The response cache. None streams the chain without a cache.
+        chain (Runnable): The conversion chain.
+        inputs (dict): The inputs of the chain.
+        message (str): The telegraphic message in the inputs.
+        context (str): The text of the other inputs of the chain.
+        timing (dict): Optional. Filled like stream_convert(), and with "cache", the tier of the hit or None.
+
+    Returns:
+        generator: The tokens (str) of the response.
+    """
+    if cache is None:
+        yield from stream_convert(chain, inputs, timing)
+        return
+
+    start_time = time.perf_counter()
+    response, tier, vectors = cache.lookup(message, context)
+    if response is not None:
+        yield response
+        fill_hit_timing(timing, start_time, tier)
+        return
+
+    tokens = []
+    for token in stream_convert(chain, inputs, timing):
+        tokens.append(token)
+        yield token
+    cache.store(message, context, "".join(tokens), vectors)
+    if timing is not None:
+        timing["cache"] = None
+
+
+async def astream_cached_convert(cache, chain, inputs, message, context, timing=None):
+    """
+    The async variant of stream_cached_convert(). The lookup and the store, which may embed the
+    message and context, run in a thread pool so they don't block the event loop.
+
+    Returns:
+        async generator: The tokens (str) of the response.
+    """
+    loop = asyncio.get_running_loop()
+    start_time = time.perf_counter()
+    response, tier, vectors = (None, None, None) if cache is None else await loop.run_in_executor(None, cache.lookup, message, context)
+    if response is not None:
+        yield response
+        fill_hit_timing(timing, start_time, tier)
+        return
+
+    tokens = []
+    async for token in astream_convert(chain, inputs, timing):
+        tokens.append(token)
+        yield token
+    if cache is not None:
+        await loop.run_in_executor(None, cache.store, message, context, "".join(tokens), vectors)
+    if timing is not None:
+        timing["cache"] = None
+
+
+def fill_hit_timing(timing, start_time, tier):
+    """
+    Fills the timing of a response returned from the cache. See stream_cached_convert().
+    """
+    if timing is None:
+        return
+    elapsed = round((time.perf_counter() - start_time) * 1000, 1)
+    timing.update({"first_token_ms": elapsed, "total_ms": elapsed, "tokens": 1, "cache": tier})
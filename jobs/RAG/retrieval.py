@@ -0,0 +1,211 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# Batched retrieval from a FAISS vector store.
+#
+# retriever.invoke() embeds one query and searches the index for it. retrieve_batch() embeds all
+# the queries in one call of the embedding model and searches the index once for the whole matrix
+# of query vectors, which FAISS runs as a single vectorized search. The results are the same as
+# FAISS.similarity_search_with_score() for every query.
+#
+# HybridRetriever combines it with a BM25 index of the chunks (see bm25_index.py). Telegraphic
+# queries such as "Roy nephew" are a few content words, often names, that a lexical index matches
+# exactly. When the lexical hits of a query are confident, its top chunk contains every term of
+# the query and clearly outscores the next one, the lexical results are returned without the dense
+# pass. The other queries are embedded and searched in one batch, and the lexical and dense rankings
+# are fused with reciprocal rank fusion.
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from embedding_cache import embed_query_batch
+
+# The rank offset of reciprocal rank fusion, which dampens the weight of the first ranks
+RRF_K = 60
+
+# How much the top lexical score must exceed the next one for the lexical hits to be confident
+LEXICAL_CONFIDENCE_MARGIN = 1.5
+
+# How many more candidates than k each ranking contributes to the fusion
+CANDIDATE_MULTIPLIER = 4
+
+
+def embed_queries(embedding_func, queries):
+    """
+    Embeds queries in one call of the embedding model, with its query encoding, so models with a
+    query instruction get the same vectors as embed_query(). CachedEmbeddings cache them as queries,
+    apart from the chunks of the documents.
+
+    Parameters:
+        embedding_func (Embeddings): The embedding function of the vector store.
+        queries (list): The query strings.
+
+    Returns:
+        numpy.ndarray: The float32 matrix of the query vectors, one row per query.
+    """
+    if hasattr(embedding_func, "embed_queries"):
+        return np.asarray(embedding_func.embed_queries(list(queries)), dtype=np.float32)
+    return np.asarray(embed_query_batch(embedding_func, list(queries)), dtype=np.float32)
+
+
+def search_batch(vectordb, query_vectors, k=4):
+    """
+    Searches a FAISS vector store for a matrix of query vectors in one call.
+
+    Parameters:
+        vectordb (FAISS): The vector store.
+        query_vectors (numpy.ndarray): The float32 query vectors, one row per query.
+        k (int): The number of documents to return per query.
+
+    Returns:
+        list: For every query, the list of (Document, score) of its top k documents, from the
+        closest. The score is the distance of the index, as returned by similarity_search_with_score().
+    """
+    return [get_documents(vectordb, query_hits) for query_hits in search_positions(vectordb, query_vectors, k)]
+
+
+def search_positions(vectordb, query_vectors, k):
+    """
+    Searches a FAISS vector store for a matrix of query vectors in one call, like search_batch(),
+    and returns the positions of the chunks in the index instead of the documents.
+
+    Returns:
+        list: For every query, the list of (position, score) of its top k chunks, from the closest.
+    """
+    query_vectors = np.array(query_vectors, dtype=np.float32)
+    if getattr(vectordb, "_normalize_L2", False):
+        faiss.normalize_L2(query_vectors)
+    scores, indices = vectordb.index.search(query_vectors, k)
+
+    # FAISS returns -1 when the index has fewer than k vectors
+    return [
+        [(int(position), float(score)) for score, position in zip(query_scores, query_indices) if position != -1]
+        for query_scores, query_indices in zip(scores, indices)
+    ]
+
+
+def get_documents(vectordb, hits):
+    """
+    Returns the documents of chunks found at positions of the index of a FAISS vector store.
+
+    Parameters:
+        vectordb (FAISS): The vector store.
+        hits (list): (position, score) of the chunks.
+
+    Returns:
+        list: (Document, score) of the chunks. Chunks missing from the docstore are left out.
+    """
+    results = []
+    for position, score in hits:
+        doc = vectordb.docstore.search(vectordb.index_to_docstore_id[position])
+        if isinstance(doc, Document):
+            results.append((doc, score))
+    return results
+
+
+def retrieve_batch(vectordb, queries, k=4):
+    """
+    Retrieves the top k documents of every query with one embedding call and one FAISS search.
+
+    Parameters:
+        vectordb (FAISS): The vector store.
+        queries (list): The query strings.
+        k (int): The number of documents to return per query.
+
+    Returns:
+        list: For every query, the list of (Document, score) of its top k documents. See search_batch().
+    """
+    if not queries:
+        return []
+    return search_batch(vectordb, embed_queries(vectordb.embedding_function, queries), k)
+
+
+class HybridRetriever:
+    """
+    Retrieves chunks with a BM25 index and a FAISS vector store, skipping the dense pass for the
+    queries whose lexical hits are confident.
+
+    Parameters:
+        vectordb (FAISS): The vector store.
+        bm25_index (BM25Index): The BM25 index of the chunks of the vector store, returned by
+            bm25_index.load_bm25_index().
+        lexical_weight (float): The weight of the lexical ranking in the fusion.
+        dense_weight (float): The weight of the dense ranking in the fusion.
+        confidence_margin (float): How much the top lexical score must exceed the next one for the
+            lexical hits to be confident. None never skips the dense pass.
+    """
+
+    def __init__(self, vectordb, bm25_index, lexical_weight=1.0, dense_weight=1.0, confidence_margin=LEXICAL_CONFIDENCE_MARGIN):
+        self.vectordb = vectordb
+        self.bm25_index = bm25_index
+        self.lexical_weight = lexical_weight
+        self.dense_weight = dense_weight
+        self.confidence_margin = confidence_margin
+        self.lexical_only = 0
+        self.fused = 0
+
+    def is_confident(self, lexical_hits, query_term_count):
+        """
+        Returns whether the lexical hits of a query are enough: the top chunk contains every term of
+        the query, and its score is at least confidence_margin times the score of the next chunk.
+        """
+        if self.confidence_margin is None or not lexical_hits or query_term_count == 0:
+            return False
+        _, top_score, top_matches = lexical_hits[0]
+        if top_matches < query_term_count:
+            return False
+        return len(lexical_hits) == 1 or top_score >= self.confidence_margin * lexical_hits[1][1]
+
+    def retrieve_batch(self, queries, k=4):
+        """
+        Retrieves the top k chunks of every query.
+
+        Parameters:
+            queries (list): The query strings.
+            k (int): The number of documents to return per query.
+
+        Returns:
+            list: For every query, the list of (Document, score) of its top k documents. The score is
+            the BM25 score for the queries answered by the lexical index alone, and the fused
+            reciprocal rank score otherwise. Higher is better for both.
+        """
+        candidate_count = k * CANDIDATE_MULTIPLIER
+        lexical = [self.bm25_index.search(query, candidate_count) for query in queries]
+        confident = [self.is_confident(hits, term_count) for hits, term_count in lexical]
+
+        # Embed and search all the queries that need the dense pass in one batch
+        dense_positions = [position for position, is_confident in enumerate(confident) if not is_confident]
+        dense_hits = {}
+        if dense_positions:
+            query_vectors = embed_queries(self.vectordb.embedding_function, [queries[position] for position in dense_positions])
+            dense_hits = dict(zip(dense_positions, search_positions(self.vectordb, query_vectors, candidate_count)))
+
+        results = []
+        for position, (lexical_hits, _) in enumerate(lexical):
+            if confident[position]:
+                self.lexical_only += 1
+                ranked = [(chunk, score) for chunk, score, _ in lexical_hits[:k]]
+            else:
+                self.fused += 1
+                ranked = self.fuse(lexical_hits, dense_hits[position])[:k]
+            results.append(get_documents(self.vectordb, ranked))
+        return results
+
+    def fuse(self, lexical_hits, dense_hits):
+        """
+        Fuses the lexical and dense rankings of a query with weighted reciprocal rank fusion.
+
+        Returns:
+            list: (chunk position, fused score) of the chunks of both rankings, from the best.
+        """
+        scores = {}
+        for rank, (chunk, _, _) in enumerate(lexical_hits):
+            scores[chunk] = scores.get(chunk, 0.0) + self.lexical_weight / (RRF_K + rank + 1)
+        for rank, (chunk, _) in enumerate(dense_hits):
+            scores[chunk] = scores.get(chunk, 0.0) + self.dense_weight / (RRF_K + rank + 1)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,171 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# An incremental summary of the earlier turns of a conversation, for chat_history_with_summary.py.
+#
+# The prompt of a conversion includes the most recent turns of the chat as they are, and a summary
+# of the turns before them. Summarizing all the earlier turns for every conversion costs more and
+# more as the conversation grows. RollingSummary keeps the current summary and a watermark, the
+# number of turns it covers. When turns slide out of the window of recent turns, only those turns
+# are folded into the summary, with one call of the language model on the previous summary and the
+# new turns. The cost of a turn stays the same however long the conversation is.
+#
+# schedule() folds the turns in a background thread, so the summary can be updated while the user
+# types the next message, and get() waits for it before returning the summary and the recent turns.
+# The summary and the watermark can be saved to a JSON file, so a conversation is not summarized
+# again from the start when the script runs again. The digest of the summarized turns is saved with
+# them, and the summary starts over if those turns changed.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+# The prompt of the first summary, as chat_history_with_summary.py used to summarize the whole history
+SUMMARIZE_TEMPLATE = "Summarize the following chat history. Provide only the summary, without any additional comments or context. \nChat history: {chat_history}"
+
+# The prompt that folds new turns into the summary
+UPDATE_SUMMARY_TEMPLATE = """Here is the summary of a chat history, followed by new lines of the chat. Update the summary with the new lines, keeping it short. Provide only the updated summary, without any additional comments or context.
+Summary: {summary}
+New lines: {chat_history}"""
+
+
+def get_turns_digest(turns):
+    """
+    Returns the SHA-256 digest of the turns of a conversation.
+    """
+    digest = hashlib.sha256()
+    for turn in turns:
+        digest.update(turn.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class RollingSummary:
+    """
+    A summary of the turns of a conversation before its most recent ones, updated incrementally.
+
+    Parameters:
+        llm (BaseChatModel): The language model that summarizes.
+        num_of_recent_chat (int): The number of the most recent turns left out of the summary.
+        state_path (str): Optional. The JSON file where the summary and the watermark are saved.
+    """
+
+    def __init__(self, llm, num_of_recent_chat, state_path=None):
+        self.summarize_chain = ChatPromptTemplate.from_template(SUMMARIZE_TEMPLATE) | llm | StrOutputParser()
+        self.update_chain = ChatPromptTemplate.from_template(UPDATE_SUMMARY_TEMPLATE) | llm | StrOutputParser()
+        self.num_of_recent_chat = num_of_recent_chat
+        self.state_path = state_path
+        self.summary = ""
+        self.watermark = 0
+        self.digest = get_turns_digest([])
+        self.folds = 0
+        self.folded_turns = 0
+        self.fold_seconds = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        if state_path and os.path.exists(state_path):
+            with open(state_path, "r", encoding="utf-8") as state_file:
+                state = json.load(state_file)
+            self.summary, self.watermark, self.digest = state["summary"], state["watermark"], state["digest"]
+
+    def get_split(self, chat_history):
+        """
+        Returns the number of turns of a conversation that belong to the summary, all but the most recent ones.
+        """
+        return max(len(chat_history) - self.num_of_recent_chat, 0)
+
+    def update(self, chat_history):
+        """
+        Folds the turns of a conversation that slid out of the window of recent turns into the summary.
+
+        Parameters:
+            chat_history (list): The turns of the conversation (str), from the oldest.
+
+        Returns:
+            int: The number of turns folded.
+        """
+        with self._lock:
+            split = self.get_split(chat_history)
+            # Start over if the summarized turns are not the beginning of this conversation
+            if self.watermark > split or get_turns_digest(chat_history[:self.watermark]) != self.digest:
+                self.summary, self.watermark, self.digest = "", 0, get_turns_digest([])
+            if split == self.watermark:
+                return 0
+
+            start_time = time.perf_counter()
+            new_turns = "\n".join(chat_history[self.watermark:split])
+            if self.summary:
+                self.summary = self.update_chain.invoke({"summary": self.summary, "chat_history": new_turns})
+            else:
+                self.summary = self.summarize_chain.invoke({"chat_history": new_turns})
+            folded = split - self.watermark
+            self.watermark = split
+            self.digest = get_turns_digest(chat_history[:split])
+            self.folds += 1
+            self.folded_turns += folded
+            self.fold_seconds += time.perf_counter() - start_time
+            self.save()
+            return folded
+
+    def schedule(self, chat_history):
+        """
+        Starts updating the summary in the background, such as after a turn is added to the conversation.
+
+        Returns:
+            Future: The result of update().
+        """
+        self._pending = self._executor.submit(self.update, list(chat_history))
+        return self._pending
+
+    def get(self, chat_history):
+        """
+        Returns the summary and the most recent turns of a conversation, waiting for the scheduled update
+        and folding the turns it didn't cover.
+
+        Returns:
+            tuple: The summary (str), empty if there are no earlier turns, and the list of the most recent turns.
+        """
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+        self.update(chat_history)
+        return self.summary, list(chat_history[self.get_split(chat_history):])
+
+    def save(self):
+        """
+        Saves the summary and the watermark to state_path, if any.
+        """
+        if not self.state_path:
+            return
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as state_file:
+            json.dump({"summary": self.summary, "watermark": self.watermark, "digest": self.digest}, state_file, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def get_stats(self):
+        """
+        Returns the number of updates of the summary, the turns they folded, their mean time and the watermark.
+        """
+        return {
+            "folds": self.folds,
+            "folded_turns": self.folded_turns,
+            "mean_fold_ms": round(self.fold_seconds * 1000 / self.folds, 1) if self.folds else 0.0,
+            "watermark": self.watermark
+        }
+
+    def close(self):
+        """
+        Waits for the scheduled update and stops the background thread.
+        """
+        self._executor.shutdown(wait=True)
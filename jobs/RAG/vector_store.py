@@ -0,0 +1,173 @@
+# Copyright (c) 2024, Inclusive Design Institute
+#
+# Licensed under the BSD 3-Clause License. You may not use this file except
+# in compliance with this License.
+#
+# You may obtain a copy of the BSD 3-Clause License at
+# https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+
+# A FAISS vector store persisted on disk, so the user documents are not split and embedded
+# again on every run.
+#
+# The index directory holds the FAISS index saved by FAISS.save_local() and a manifest
+# (manifest.json) that records, for every user document, its size, modification time and the
+# SHA-256 hashes of its chunks. The hash of a chunk is also its id in the vector store.
+#
+# On a later run:
+# * documents whose size and modification time match the manifest are not read at all, so
+#   loading an unchanged index costs one stat per document, whatever the size of the documents;
+# * changed documents are split again, and only the chunks with a new hash are embedded;
+# * chunks that are gone from the documents are deleted from the index.
+#
+# Changing the embedding model, the splitter settings or the index type rebuilds the index. The
+# index type is one of ann_index.INDEX_TYPES. Indexes that can't delete vectors in place, and
+# "auto" indexes whose chunk count crossed to another index type, are rebuilt from the chunks when
+# they are updated; wrap the embedding function with embedding_cache.CachedEmbeddings so the
+# chunks are not embedded again.
+
+import hashlib
+import json
+import os
+from langchain_community.document_loaders import TextLoader
+from langchain_community.vectorstores import FAISS
+from langchain_text_splitters import CharacterTextSplitter
+from ann_index import REMOVABLE_INDEX_TYPES, create_vector_store, resolve_index_type
+
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+def hash_chunk(text):
+    """
+    Returns the SHA-256 hex digest of the text of a chunk, which is its id in the vector store.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def load_manifest(index_dir):
+    """
+    Loads the manifest of an index directory.
+
+    Returns:
+        dict: The manifest, or None if it doesn't exist, can't be read or has another version.
+    """
+    try:
+        with open(os.path.join(index_dir, MANIFEST_FILENAME), "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(index_dir, manifest):
+    """
+    Saves the manifest of an index directory. It is written to a temporary file first and then
+    moved into place, so an interrupted run never leaves a truncated manifest behind.
+    """
+    manifest_path = os.path.join(index_dir, MANIFEST_FILENAME)
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def split_document(doc_path, chunk_size, chunk_overlap):
+    """
+    Loads a user document and splits it into chunks.
+
+    Returns:
+        list: The chunks (langchain Document).
+    """
+    documents = TextLoader(doc_path).load()
+    text_splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return text_splitter.split_documents(documents)
+
+
+def load_vector_store(doc_paths, embedding_func, index_dir, model_id, chunk_size=200, chunk_overlap=0, index_type="flat"):
+    """
+    Loads the vector store of user documents from an index directory, and brings it up to date
+    with the documents by embedding new chunks and deleting removed ones. The index is built
+    when the directory is empty.
+
+    Parameters:
+        doc_paths (list): The paths of the user documents.
+        embedding_func (Embeddings): The embedding function, such as HuggingFaceEmbeddings.
+        index_dir (str): The directory where the index and its manifest are saved.
+        model_id (str): Identifies the embedding model, such as the path of the sentence
+            transformer model. The index is rebuilt when it changes.
+        chunk_size (int): The chunk size of the text splitter.
+        chunk_overlap (int): The chunk overlap of the text splitter.
+        index_type (str): The FAISS index type, one of ann_index.INDEX_TYPES.
+
+    Returns:
+        FAISS: The vector store.
+    """
+    settings = {"model": model_id, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "index_type": index_type}
+    manifest = load_manifest(index_dir)
+    vectordb = None
+    if manifest is not None and manifest["settings"] == settings:
+        try:
+            vectordb = FAISS.load_local(index_dir, embedding_func, allow_dangerous_deserialization=True)
+        except (OSError, RuntimeError):
+            vectordb = None
+    if vectordb is None:
+        manifest = {"version": MANIFEST_VERSION, "settings": settings, "documents": {}, "resolved_index_type": None}
+
+    # Find the chunks of the documents that changed since the manifest was saved. The chunks of
+    # unchanged documents are taken from the manifest without reading the documents.
+    documents = {}
+    new_chunks = {}
+    changed = False
+    for doc_path in doc_paths:
+        stat = os.stat(doc_path)
+        entry = manifest["documents"].get(doc_path)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            documents[doc_path] = entry
+            continue
+
+        changed = True
+        chunk_ids = []
+        for chunk in split_document(doc_path, chunk_size, chunk_overlap):
+            chunk_id = hash_chunk(chunk.page_content)
+            chunk_ids.append(chunk_id)
+            new_chunks.setdefault(chunk_id, chunk)
+        documents[doc_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "chunks": chunk_ids}
+
+    if vectordb is not None and not changed and set(documents) == set(manifest["documents"]):
+        print(f"Loaded the index of {vectordb.index.ntotal} chunks from {index_dir}")
+        return vectordb
+
+    old_ids = {chunk_id for entry in manifest["documents"].values() for chunk_id in entry["chunks"]}
+    new_ids = {chunk_id for entry in documents.values() for chunk_id in entry["chunks"]}
+    to_add = [chunk_id for chunk_id in new_chunks if chunk_id not in old_ids]
+    to_delete = list(old_ids - new_ids)
+
+    if not new_ids:
+        raise ValueError(f"The user documents {', '.join(doc_paths)} have no text to index")
+
+    resolved_index_type = resolve_index_type(index_type, len(new_ids))
+    rebuild = (vectordb is None or resolved_index_type != manifest["resolved_index_type"]
+               or (to_delete and resolved_index_type not in REMOVABLE_INDEX_TYPES))
+    if rebuild:
+        # Keep the chunks of the current index that are still in the documents
+        chunk_ids = sorted(new_ids)
+        if vectordb is not None:
+            for chunk_id in chunk_ids:
+                new_chunks.setdefault(chunk_id, vectordb.docstore.search(chunk_id))
+        vectordb = create_vector_store([new_chunks[chunk_id] for chunk_id in chunk_ids], embedding_func, resolved_index_type, chunk_ids)
+    else:
+        if to_delete:
+            vectordb.delete(to_delete)
+        if to_add:
+            vectordb.add_documents([new_chunks[chunk_id] for chunk_id in to_add], ids=to_add)
+
+    os.makedirs(index_dir, exist_ok=True)
+    vectordb.save_local(index_dir)
+    manifest["documents"] = documents
+    manifest["resolved_index_type"] = resolved_index_type
+    save_manifest(index_dir, manifest)
+    print(f"{'Built' if rebuild else 'Updated'} the {resolved_index_type} index in {index_dir}: {len(to_add)} new chunks, "
+          f"{len(to_delete)} removed chunks, {vectordb.index.ntotal} chunks in total")
+    return vectordb
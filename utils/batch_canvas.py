@@ -0,0 +1,224 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image
+from common_funcs import list_image_files
+from packed_dataset import open_packed_array
+from trim_funcs import trim_image
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+Batched version of pad_image_to_canvas() in image_size_sync.py.
+
+A group of images is loaded into grayscale NumPy arrays. The background color of every image is
+estimated from its border: the pixels of the ring one pixel inside the edge, which contains the
+pixel (1, 1) that the per-image path uses, and which skips the anti-aliased outer edge. The rings of
+the whole group are concatenated into one array and the most frequent color of every ring is
+counted in one vectorized pass. The colors are then broadcast into a preallocated (N, size, size)
+canvas stack in one operation. Each image is then
+copied into the center of its canvas. No PIL canvas is created per image, and the canvas stack
+can be a slice of a packed dataset (see packed_dataset.py) so the canvases are written straight
+into the memory-mapped file.
+
+The output is identical to the per-image path whenever the most frequent border color is the color
+at (1, 1), which holds for the uniform backgrounds of the Bliss symbols. Run this script to benchmark
+the batched path against the per-image path on a directory, check that both produce the same
+pixels, and count the images whose border estimate differs from the pixel (1, 1).
+
+Usage: python batch_canvas.py [image_dir] [--batch-size N]
+Parameters:
+  image_dir: The directory where the original images are located.
+  --batch-size: Optional. The number of images per batch. Defaults to 256.
+Return: None
+
+Example: python batch_canvas.py images/ --batch-size 512
+"""
+
+
+def load_gray_images(image_paths, trim_padding=None):
+    """
+    Loads images and transforms them to grayscale arrays.
+
+    Parameters:
+        image_paths (list): The paths of the images.
+        trim_padding (int): Optional. Crop every image to its ink plus this padding first, see trim_funcs.py.
+
+    Returns:
+        tuple: A tuple containing:
+        * the grayscale uint8 arrays of the images that were loaded (list)
+        * the positions in image_paths of the images that were loaded (list)
+        * the paths of the images that couldn't be loaded, with the error message (list)
+    """
+    grays = []
+    positions = []
+    failures = []
+    for position, image_path in enumerate(image_paths):
+        try:
+            with Image.open(image_path) as img:
+                if trim_padding is not None:
+                    img = trim_image(img, trim_padding)
+                grays.append(np.asarray(img.convert('L')))
+            positions.append(position)
+        except Exception as e:
+            failures.append((image_path, f"{type(e).__name__}: {e}"))
+    return grays, positions, failures
+
+
+def get_border_pixels(gray):
+    """
+    Returns the pixels of the ring one pixel inside the edge of a grayscale image, or all its pixels
+    if it is smaller than 3 pixels in either direction. The ring starts with the pixel (1, 1).
+    """
+    if min(gray.shape) < 3:
+        return gray.ravel()
+    inner = gray[1:-1, 1:-1]
+    return np.concatenate((inner[0], inner[-1], inner[1:-1, 0], inner[1:-1, -1]))
+
+
+def get_background_colors(grays):
+    """
+    Returns the background color of every image, which is the most frequent grayscale color of its
+    border pixels. See get_border_pixels(). Ties go to the darkest color.
+
+    Parameters:
+        grays (list): The grayscale arrays of the images.
+
+    Returns:
+        numpy.ndarray: The uint8 background colors, of shape (N,).
+    """
+    borders = [get_border_pixels(gray) for gray in grays]
+    if not borders:
+        return np.empty(0, dtype=np.uint8)
+
+    # Count the colors of all the borders at once: the color of a pixel of image i is counted in bin i * 256 + color
+    image_ids = np.repeat(np.arange(len(borders)), [len(border) for border in borders])
+    bins = image_ids * 256 + np.concatenate(borders)
+    counts = np.bincount(bins, minlength=len(borders) * 256).reshape(len(borders), 256)
+    return counts.argmax(axis=1).astype(np.uint8)
+
+
+def pad_gray_images_to_canvas(grays, canvas_size, out=None):
+    """
+    Places every grayscale image in the center of a square canvas filled with its background color.
+
+    Parameters:
+        grays (list): The grayscale arrays of the images. None entries leave their canvas untouched.
+        canvas_size (int): The size of the square canvases. Every image must fit in it.
+        out (numpy.ndarray): Optional. A uint8 array of shape (N, canvas_size, canvas_size) to
+            write the canvases into, such as a slice of a packed dataset.
+
+    Returns:
+        numpy.ndarray: The canvas stack of shape (N, canvas_size, canvas_size).
+
+    Raises:
+        ValueError: If an image is larger than the canvas.
+    """
+    if out is None:
+        out = np.empty((len(grays), canvas_size, canvas_size), dtype=np.uint8)
+
+    present = [position for position, gray in enumerate(grays) if gray is not None]
+    if not present:
+        return out
+
+    # Fill every canvas with the background color of its image in one broadcast assignment
+    backgrounds = get_background_colors([grays[position] for position in present])
+    if len(present) == len(grays):
+        out[:] = backgrounds[:, None, None]
+    else:
+        out[present] = backgrounds[:, None, None]
+
+    for position in present:
+        gray = grays[position]
+        height, width = gray.shape
+        if height > canvas_size or width > canvas_size:
+            raise ValueError(f"Image of {width}x{height} doesn't fit in a canvas of {canvas_size}x{canvas_size}")
+
+        # Same rounding as int((canvas_size - width) / 2) in the per-image path
+        x = (canvas_size - width) // 2
+        y = (canvas_size - height) // 2
+        out[position, y:y + height, x:x + width] = gray
+
+    return out
+
+
+def export_image_batch(start_and_filenames, image_dir, array_path, size_to_fit, trim_padding=None):
+    """
+    Fits a batch of images into the square canvas and writes them into consecutive rows of a
+    packed array. This is the per-batch task run by the worker processes. Images that fail to
+    load are left as zero rows.
+
+    Parameters:
+        start_and_filenames (tuple): The position of the first image in the array and the
+            filenames of the images in the batch.
+        image_dir (str): The directory where the original images are located.
+        array_path (str): The path to the packed .npy file.
+        size_to_fit (int): The size of the square canvas.
+        trim_padding (int): Optional. Crop every image to its ink plus this padding first, see trim_funcs.py.
+
+    Returns:
+        list: The filenames of the images that failed, with the error message.
+    """
+    start, filenames = start_and_filenames
+    grays, positions, failures = load_gray_images([os.path.join(image_dir, filename) for filename in filenames], trim_padding)
+
+    batch = [None] * len(filenames)
+    for position, gray in zip(positions, grays):
+        batch[position] = gray
+
+    images = open_packed_array(array_path)
+    pad_gray_images_to_canvas(batch, size_to_fit, out=images[start:start + len(filenames)])
+    return [(os.path.basename(image_path), error) for image_path, error in failures]
+
+
+if __name__ == "__main__":
+    from image_size_sync import get_canvas_size, pad_image_to_canvas
+
+    parser = argparse.ArgumentParser(description="Benchmark the batched canvas padding against the per-image path.")
+    parser.add_argument("image_dir", help="The directory where the original images are located.")
+    parser.add_argument("--batch-size", type=int, default=256, help="The number of images per batch.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.image_dir):
+        print(f"Error: Input directory {args.image_dir} not found")
+        sys.exit(1)
+
+    canvas_size = get_canvas_size(args.image_dir)
+    image_paths = [os.path.join(args.image_dir, filename) for filename in list_image_files(args.image_dir)]
+
+    start_time = time.perf_counter()
+    per_image = np.empty((len(image_paths), canvas_size, canvas_size), dtype=np.uint8)
+    for position, image_path in enumerate(image_paths):
+        with Image.open(image_path) as img:
+            per_image[position] = np.asarray(pad_image_to_canvas(img, canvas_size))
+    per_image_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    batched = np.empty_like(per_image)
+    for start in range(0, len(image_paths), args.batch_size):
+        grays, _, _ = load_gray_images(image_paths[start:start + args.batch_size])
+        pad_gray_images_to_canvas(grays, canvas_size, out=batched[start:start + len(grays)])
+    batched_time = time.perf_counter() - start_time
+
+    # Compare the border estimate with the pixel (1, 1) of the per-image path, outside of the timings
+    differing_backgrounds = 0
+    for start in range(0, len(image_paths), args.batch_size):
+        grays, _, _ = load_gray_images(image_paths[start:start + args.batch_size])
+        differing_backgrounds += int(np.count_nonzero(get_background_colors(grays) != [gray[1, 1] for gray in grays]))
+
+    print(f"{len(image_paths)} images, canvas {canvas_size}x{canvas_size}, batch size {args.batch_size}")
+    print(f"Per-image path: {per_image_time:.3f}s ({len(image_paths) / per_image_time:.1f} images/sec)")
+    print(f"Batched path: {batched_time:.3f}s ({len(image_paths) / batched_time:.1f} images/sec)")
+    print(f"Speedup: {per_image_time / batched_time:.2f}x")
+    print(f"Images whose border background differs from the pixel (1, 1): {differing_backgrounds}")
+    print("Outputs match" if np.array_equal(per_image, batched) else "Error: outputs differ")
@@ -0,0 +1,333 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import time
+from PIL import Image, ImageDraw
+from common_funcs import get_max_dimensions
+from image_pipeline import process_images
+from image_size_sync import sync_image_sizes
+from resize_images_to_same_height import resize_images
+from scale_down_images import scale_down_images, scale_down_pyramid
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak RSS is not reported
+    resource = None
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+This script benchmarks the core functions of the image preparation scripts in this directory on
+synthetic Bliss-like images, so changes to them can be measured.
+
+For every dataset size, a deterministic set of symbol images is generated: black strokes, arcs
+and dots on canvases of varied sizes, with transparent or grey backgrounds, saved as PNG or JPG.
+Then each benchmark case runs in a fresh process, on a fresh copy of the dataset so no case finds
+the index files written by a previous one, and reports:
+* the wall time and the throughput in images/sec;
+* the peak RSS of the case process, and the peak RSS of the largest of its worker processes;
+* the number of bytes written to the output directory.
+A case that fails is reported with its error, and the benchmark goes on with the next case.
+
+Pass --image-scale to multiply the canvas sizes of the images, for example 10 to approach the
+size of the 384dpi exports and compare the decode strategies of decode_funcs.py: the cases
+ending in _full_decode decode every image at native resolution, the others near the target size.
+
+The results are saved as JSON. Pass the JSON of a previous run with --compare to print the
+change in throughput of every case.
+
+Usage: python benchmark_pipeline.py [--sizes N,N,...] [--workers N] [--seed N] [--image-scale N] [--output PATH] [--compare PATH]
+       [--work-dir DIR]
+Parameters:
+  --sizes: Optional. The comma-separated dataset sizes. Defaults to 100,1000.
+  --workers: Optional. The number of worker processes of the scripts. Defaults to the number of CPU cores.
+  --seed: Optional. The seed of the synthetic images. Defaults to 0.
+  --image-scale: Optional. The factor applied to the canvas sizes of the synthetic images, from 60 to 400 pixels
+  per side. Defaults to 1.
+  --output: Optional. The path of the JSON results. Defaults to benchmark_results.json.
+  --compare: Optional. The path of the JSON results of a previous run to compare with.
+  --work-dir: Optional. The directory for the generated images and outputs. Defaults to a temporary directory
+  that is removed at the end.
+Return: None
+
+Example: python benchmark_pipeline.py --sizes 100,1000,5000 --output after.json --compare before.json
+         python benchmark_pipeline.py --sizes 100 --image-scale 10 --workers 4
+"""
+
+
+def generate_symbol_image(rng, image_scale=1):
+    """
+    Draws one synthetic Bliss-like symbol.
+
+    Parameters:
+        rng (random.Random): The random generator, which makes the image deterministic.
+        image_scale (float): The factor applied to the canvas size.
+
+    Returns:
+        tuple: The image (PIL.Image.Image) and the file extension to save it with (str).
+    """
+    width = int(rng.randint(60, 400) * image_scale)
+    height = int(rng.randint(60, 400) * image_scale)
+    transparent = rng.random() < 0.5
+    if transparent:
+        img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        ink = (0, 0, 0, 255)
+    else:
+        grey = rng.randint(200, 255)
+        img = Image.new('RGB', (width, height), (grey, grey, grey))
+        ink = (0, 0, 0)
+
+    draw = ImageDraw.Draw(img)
+    stroke = max(2, min(width, height) // 30)
+    for _ in range(rng.randint(2, 6)):
+        x0, x1 = sorted(rng.randint(5, width - 5) for _ in range(2))
+        y0, y1 = sorted(rng.randint(5, height - 5) for _ in range(2))
+        shape = rng.choice(("line", "arc", "dot"))
+        if shape == "line":
+            draw.line((x0, y0, x1, y1), fill=ink, width=stroke)
+        elif shape == "arc":
+            draw.arc((x0, y0, x1 + 1, y1 + 1), rng.randint(0, 180), rng.randint(180, 360), fill=ink, width=stroke)
+        else:
+            draw.ellipse((x0, y0, x0 + stroke * 2, y0 + stroke * 2), fill=ink)
+
+    extension = ".png" if transparent or rng.random() < 0.7 else ".jpg"
+    return img, extension
+
+
+def generate_dataset(image_dir, count, seed=0, image_scale=1):
+    """
+    Generates a deterministic set of synthetic symbol images, named by their position like BCI IDs.
+
+    Parameters:
+        image_dir (str): The directory to save the images in.
+        count (int): The number of images.
+        seed (int): The seed of the random generator.
+        image_scale (float): The factor applied to the canvas sizes.
+
+    Returns:
+        None.
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    rng = random.Random(seed)
+    for position in range(count):
+        img, extension = generate_symbol_image(rng, image_scale)
+        img.save(os.path.join(image_dir, f"{position:05d}{extension}"))
+
+
+def get_dir_size(folder_path):
+    """
+    Returns the total size in bytes of the files in a folder and its subfolders.
+    """
+    total = 0
+    for root, _, filenames in os.walk(folder_path):
+        total += sum(os.path.getsize(os.path.join(root, filename)) for filename in filenames)
+    return total
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak RSS in MB of the current process, and the peak RSS in MB of the largest of its
+    waited-for child processes, or None for both if they can't be measured on this platform. The
+    peak RSS of the children is that of the single largest child, not the sum of the children.
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    unit = 1 if sys.platform == "darwin" else 1024
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return round(self_rss / (1024 * 1024), 1), round(children_rss / (1024 * 1024), 1)
+
+
+def get_cases(image_dir, output_root, workers):
+    """
+    Returns the benchmark cases as (name, function to run, output directory) tuples.
+    """
+    def out(name):
+        return os.path.join(output_root, name)
+
+    return [
+        ("get_max_dimensions", lambda: get_max_dimensions(image_dir, use_index=False), None),
+        ("image_size_sync", lambda: sync_image_sizes(image_dir, out("image_size_sync"), workers), out("image_size_sync")),
+        ("scale_down_images", lambda: scale_down_images(image_dir, out("scale_down_images"), 128, 128, workers), out("scale_down_images")),
+        ("scale_down_images_full_decode", lambda: scale_down_images(image_dir, out("scale_down_images_full_decode"), 128, 128, workers, decode="full"),
+         out("scale_down_images_full_decode")),
+        ("scale_down_pyramid", lambda: scale_down_pyramid(image_dir, out("scale_down_pyramid"), [(256, 256), (128, 128), (64, 64)], workers),
+         out("scale_down_pyramid")),
+        ("resize_images_to_same_height", lambda: resize_images(image_dir, 128, out("resize_images_to_same_height"), workers), out("resize_images_to_same_height")),
+        ("resize_images_to_same_height_full_decode", lambda: resize_images(image_dir, 128, out("resize_images_to_same_height_full_decode"), workers, decode="full"),
+         out("resize_images_to_same_height_full_decode")),
+        ("resize_images_to_same_height_max_large_2",
+         lambda: resize_images(image_dir, 128, out("resize_images_to_same_height_max_large_2"), workers, max_large_images=2),
+         out("resize_images_to_same_height_max_large_2")),
+        ("image_pipeline", lambda: process_images(image_dir, out("image_pipeline"), ["pad:max", "thumbnail:128x128"], workers), out("image_pipeline")),
+        ("image_pipeline_staged", lambda: process_images(image_dir, out("image_pipeline_staged"), ["pad:max", "thumbnail:128x128"], staged=True),
+         out("image_pipeline_staged")),
+        ("image_size_sync_fast", lambda: sync_image_sizes(image_dir, out("image_size_sync_fast"), workers, encoder_profile="fast"), out("image_size_sync_fast")),
+        ("image_size_sync_trim", lambda: sync_image_sizes(image_dir, out("image_size_sync_trim"), workers, trim_padding=2), out("image_size_sync_trim")),
+        ("image_size_sync_smallest", lambda: sync_image_sizes(image_dir, out("image_size_sync_smallest"), workers, encoder_profile="smallest"),
+         out("image_size_sync_smallest"))
+    ]
+
+
+def _run_case(image_dir, output_root, workers, case_name, result_queue):
+    # Runs in a fresh process so that the peak RSS only covers this case
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        func, output_dir = next((func, output_dir) for name, func, output_dir in get_cases(image_dir, output_root, workers) if name == case_name)
+        start_time = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start_time
+        peak_rss_mb, workers_peak_rss_mb = get_peak_rss_mb()
+        result_queue.put({
+            "seconds": round(elapsed, 4),
+            "peak_rss_mb": peak_rss_mb,
+            "workers_peak_rss_mb": workers_peak_rss_mb,
+            "bytes_written": get_dir_size(output_dir) if output_dir else 0
+        })
+    except Exception as e:
+        result_queue.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def run_case(image_dir, output_root, workers, case_name):
+    """
+    Runs one benchmark case in a fresh process.
+
+    Returns:
+        dict: The wall time, peak RSSs and bytes written of the case, or "error" if it failed.
+    """
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case, args=(image_dir, output_root, workers, case_name, result_queue))
+    process.start()
+    # Poll the queue, so a case process that dies without a result, such as when it is killed for
+    # lack of memory, doesn't block the benchmark
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                try:
+                    result = result_queue.get(timeout=1)
+                except queue.Empty:
+                    result = {"error": f"The case process exited with code {process.exitcode} without a result"}
+                break
+    process.join()
+    return result
+
+
+def run_benchmarks(sizes, workers=None, seed=0, work_dir=None, image_scale=1):
+    """
+    Runs every benchmark case on synthetic datasets of the given sizes.
+
+    Parameters:
+        sizes (list): The dataset sizes.
+        workers (int): The number of worker processes of the scripts. None means one per CPU core.
+        seed (int): The seed of the synthetic images.
+        work_dir (str): The directory for the images and outputs. A temporary directory is used if None.
+        image_scale (float): The factor applied to the canvas sizes of the synthetic images.
+
+    Returns:
+        dict: The environment and the results of every case at every size.
+    """
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "workers": workers,
+            "seed": seed,
+            "image_scale": image_scale
+        },
+        "results": []
+    }
+
+    root = work_dir or tempfile.mkdtemp(prefix="bliss_benchmark_")
+    try:
+        for size in sizes:
+            dataset_dir = os.path.join(root, f"images_{size}")
+            generate_dataset(dataset_dir, size, seed, image_scale)
+            input_bytes = get_dir_size(dataset_dir)
+
+            for case_name, _, _ in get_cases(dataset_dir, "", workers):
+                # Every case gets a fresh copy of the dataset and of the output directory, so it doesn't
+                # reuse the dimension or trim index files written into the image folder by a previous case
+                image_dir = os.path.join(root, f"case_images_{size}")
+                output_root = os.path.join(root, f"output_{size}")
+                shutil.rmtree(image_dir, ignore_errors=True)
+                shutil.rmtree(output_root, ignore_errors=True)
+                shutil.copytree(dataset_dir, image_dir)
+                result = run_case(image_dir, output_root, workers, case_name)
+                result.update({"case": case_name, "images": size, "input_bytes": input_bytes})
+                results["results"].append(result)
+                if "error" in result:
+                    print(f"{case_name:<42} {size:>7} images  failed: {result['error']}")
+                    continue
+                result["images_per_sec"] = round(size / result["seconds"], 1) if result["seconds"] else math.inf
+                print(f"{case_name:<42} {size:>7} images  {result['seconds']:>8.3f}s  {result['images_per_sec']:>9.1f} images/sec"
+                      f"  peak RSS {result['peak_rss_mb']} MB, largest worker {result['workers_peak_rss_mb']} MB"
+                      f"  {result['bytes_written']} bytes written")
+    finally:
+        if work_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return results
+
+
+def compare_results(results, previous):
+    """
+    Prints the change in throughput of every case compared with a previous run.
+    """
+    previous_rates = {(result["case"], result["images"]): result.get("images_per_sec") for result in previous["results"]}
+    print("\nComparison with the previous run:")
+    for result in results["results"]:
+        if "error" in result:
+            continue
+        previous_rate = previous_rates.get((result["case"], result["images"]))
+        if previous_rate:
+            print(f"{result['case']:<42} {result['images']:>7} images  {previous_rate:>9.1f} -> {result['images_per_sec']:>9.1f} images/sec"
+                  f"  ({result['images_per_sec'] / previous_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the image preparation scripts on synthetic Bliss-like images.")
+    parser.add_argument("--sizes", default="100,1000", help="The comma-separated dataset sizes.")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes of the scripts. Defaults to the number of CPU cores.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the synthetic images.")
+    parser.add_argument("--image-scale", type=float, default=1, help="The factor applied to the canvas sizes of the synthetic images.")
+    parser.add_argument("--output", default="benchmark_results.json", help="The path of the JSON results.")
+    parser.add_argument("--compare", default=None, help="The path of the JSON results of a previous run to compare with.")
+    parser.add_argument("--work-dir", default=None, help="The directory for the generated images and outputs.")
+    args = parser.parse_args()
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(',')]
+    except ValueError:
+        print(f"Error: Invalid sizes {args.sizes}. Must be comma-separated numbers")
+        sys.exit(1)
+
+    results = run_benchmarks(sizes, args.workers, args.seed, args.work_dir, args.image_scale)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as previous_file:
+            compare_results(results, json.load(previous_file))
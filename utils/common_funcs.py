@@ -1,16 +1,249 @@
 from PIL import Image
+import heapq
+import io
+import json
 import os
 
+# The extensions of image files processed by the scripts in this directory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
 
-def get_max_dimensions(folder_path):
+# Encoder settings of the output images, by profile and file extension. "balanced" keeps the
+# Pillow defaults, "fast" trades file size for encoding speed and "smallest" the opposite.
+ENCODER_PROFILES = {
+    "fast": {".png": {"compress_level": 1}, ".jpg": {}},
+    "balanced": {".png": {"compress_level": 6}, ".jpg": {}},
+    "smallest": {".png": {"compress_level": 9, "optimize": True}, ".jpg": {"optimize": True}}
+}
+
+# The name of the file that caches the dimensions of the images in a folder
+DIMENSION_INDEX_FILENAME = ".dimension_index.json"
+DIMENSION_INDEX_VERSION = 1
+
+
+def is_image_file(filename):
+    """
+    Returns whether a filename has one of the image extensions processed by the scripts in this directory.
+
+    Parameters:
+        filename (str): The filename to check.
+
+    Return:
+        bool: True if the file is a .jpg, .jpeg or .png file.
+    """
+    return filename.endswith(IMAGE_EXTENSIONS)
+
+
+def list_image_files(folder_path):
+    """
+    Returns the sorted filenames of all images in a folder.
+
+    Parameters:
+        folder_path (str): The path to the folder containing the images.
+
+    Return:
+        list: The image filenames, sorted so that every run processes them in the same order.
+    """
+    return sorted(filename for filename in os.listdir(folder_path) if is_image_file(filename))
+
+
+def save_image(img, output_path, encoder_profile="balanced"):
+    """
+    Saves an image with the encoder settings of a profile.
+
+    Parameters:
+        img (PIL.Image.Image): The image to save.
+        output_path (str): The path of the output image. Its extension selects the format.
+        encoder_profile (str): "fast", "balanced" or "smallest". See ENCODER_PROFILES.
+
+    Return:
+        None.
+    """
+    img.save(output_path, **get_encoder_settings(output_path, encoder_profile))
+
+
+def encode_image(img, filename, encoder_profile="balanced"):
+    """
+    Encodes an image in memory with the encoder settings of a profile, such as for writing it
+    into an archive.
+
+    Parameters:
+        img (PIL.Image.Image): The image to encode.
+        filename (str): The filename the image is stored with. Its extension selects the format.
+        encoder_profile (str): "fast", "balanced" or "smallest". See ENCODER_PROFILES.
+
+    Return:
+        bytes: The encoded image.
+    """
+    buffer = io.BytesIO()
+    extension = os.path.splitext(filename)[1].lower()
+    img_format = "JPEG" if extension in (".jpg", ".jpeg") else extension[1:].upper()
+    img.save(buffer, format=img_format, **get_encoder_settings(filename, encoder_profile))
+    return buffer.getvalue()
+
+
+def get_encoder_settings(filename, encoder_profile="balanced"):
+    """
+    Returns the keyword arguments of Image.save() for the format of a file in an encoder profile.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".jpeg":
+        extension = ".jpg"
+    return ENCODER_PROFILES[encoder_profile].get(extension, {})
+
+
+def iter_image_files(folder_path):
+    """
+    Yields the paths of all images in a folder and its subfolders. The tree is walked with
+    os.scandir, so memory use doesn't grow with the number of files. Symbolic links to
+    folders are not followed.
+
+    Parameters:
+        folder_path (str): The path to the root folder.
+
+    Return:
+        generator: The paths of the image files.
+    """
+    folders = [folder_path]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif is_image_file(entry.name) and entry.is_file():
+                    yield entry.path
+
+
+def load_dimension_index(index_path):
+    """
+    Loads a dimension index saved by save_dimension_index().
+
+    Parameters:
+        index_path (str): The path to the index file.
+
+    Return:
+        dict: Maps image filenames to [file size, modification time in ns, width, height].
+        An empty dict is returned if the index doesn't exist, can't be read or has another version.
+    """
+    try:
+        with open(index_path, 'r') as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(index, dict) or index.get("version") != DIMENSION_INDEX_VERSION:
+        return {}
+    return index.get("entries", {})
+
+
+def save_dimension_index(index_path, entries):
+    """
+    Saves a dimension index. The index is written to a temporary file first and then moved into
+    place so that an interrupted run never leaves a truncated index behind.
+
+    Parameters:
+        index_path (str): The path to the index file.
+        entries (dict): Maps image filenames to [file size, modification time in ns, width, height].
+
+    Return:
+        None.
+    """
+    # The process ID keeps concurrent runs, such as the shards of an array job, from sharing a temporary file
+    temp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w') as index_file:
+            json.dump({"version": DIMENSION_INDEX_VERSION, "entries": entries}, index_file, separators=(',', ':'))
+        os.replace(temp_path, index_path)
+    except OSError as e:
+        # The index is only a cache, so a read-only image folder is not an error
+        print(f"Warning: unable to save the dimension index {index_path}: {e}")
+
+
+def get_image_dimensions(folder_path, use_index=True):
+    """
+    Returns the width and height of all images in a folder.
+
+    The dimensions are cached in a dimension index file (.dimension_index.json) in the folder.
+    Each entry is keyed by the filename and records the file size and modification time, so only
+    the headers of new or changed images are read. Entries of removed images are dropped.
+
+    Parameters:
+        folder_path (str): The path to the folder containing the images.
+        use_index (bool): Whether to read and update the dimension index. If False, the header of
+            every image is read.
+
+    Return:
+        dict: Maps image filenames to (width, height).
+    """
+    index_path = os.path.join(folder_path, DIMENSION_INDEX_FILENAME)
+    index = load_dimension_index(index_path) if use_index else {}
+    index_changed = False
+    dimensions = {}
+
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if not is_image_file(entry.name) or not entry.is_file():
+                continue
+
+            stat = entry.stat()
+            cached = index.get(entry.name)
+            if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+                dimensions[entry.name] = (cached[2], cached[3])
+                continue
+
+            # Opening an image only reads its header, the pixel data is not decoded
+            with Image.open(entry.path) as image:
+                width, height = image.size
+            dimensions[entry.name] = (width, height)
+            index[entry.name] = [stat.st_size, stat.st_mtime_ns, width, height]
+            index_changed = True
+
+    if use_index:
+        for filename in set(index) - set(dimensions):
+            del index[filename]
+            index_changed = True
+        if index_changed:
+            save_dimension_index(index_path, index)
+
+    return dimensions
+
+
+def get_top_dimensions(folder_path, k=2, use_index=True):
+    """
+    Returns the k largest distinct widths and the k largest distinct heights of all images in a
+    folder, along with the filenames of the images that have them.
+
+    Parameters:
+        folder_path (str): The path to the folder containing the images.
+        k (int): The number of distinct widths and heights to return.
+        use_index (bool): Whether to use the dimension index. See get_image_dimensions().
+
+    Return:
+        tuple: A tuple containing:
+        * a list of (width, list of filenames) in descending order of width (list)
+        * a list of (height, list of filenames) in descending order of height (list)
+    """
+    widths = {}
+    heights = {}
+    for filename, (width, height) in sorted(get_image_dimensions(folder_path, use_index).items()):
+        widths.setdefault(width, []).append(filename)
+        heights.setdefault(height, []).append(filename)
+
+    top_widths = [(width, widths[width]) for width in heapq.nlargest(k, widths)]
+    top_heights = [(height, heights[height]) for height in heapq.nlargest(k, heights)]
+    return top_widths, top_heights
+
+
+def get_max_dimensions(folder_path, use_index=True):
     """
     Returns the maximum width and maximum height of all images in a folder,
     along with a list of image filenames that have the maximum width and maximum height.
     Also returns the second maximum width and second maximum height, along with their respective
-    lists of image filenames.
+    lists of image filenames. The dimensions are read through the dimension index, see
+    get_image_dimensions().
 
     Parameters:
         folder_path (str): The path to the folder containing the images.
+        use_index (bool): Whether to use the dimension index.
 
     Return:
         tuple: A tuple containing:
@@ -22,56 +255,13 @@ def get_max_dimensions(folder_path):
         * a list of filenames of images with the second maximum width (list)
         * a list of filenames of images with the second maximum height (list)
     """
+    top_widths, top_heights = get_top_dimensions(folder_path, 2, use_index)
 
-    # Initialize the maximum width, second maximum width, maximum height, and second maximum height to 0
-    max_width = 0
-    max_height = 0
-    second_max_width = 0
-    second_max_height = 0
-
-    # Initialize lists to keep track of filenames of images with maximum width, maximum height,
-    # second maximum width, and second maximum height
-    max_width_files = []
-    max_height_files = []
-    second_max_width_files = []
-    second_max_height_files = []
-
-    # Loop through all files in the folder
-    for filename in os.listdir(folder_path):
-        # Check if the file is an image file (in this case, .jpg, .png, or .jpeg)
-        if filename.endswith('.jpg') or filename.endswith('.png') or filename.endswith('.jpeg'):
-            # Open the image file
-            image = Image.open(os.path.join(folder_path, filename))
-
-            # Get the width and height of the image
-            width, height = image.size
-
-            # Update the maximum and second maximum width and height if necessary
-            if width > max_width:
-                second_max_width = max_width
-                second_max_width_files = max_width_files
-                max_width = width
-                max_width_files = [filename]
-            elif width == max_width:
-                max_width_files.append(filename)
-            elif width > second_max_width:
-                second_max_width = width
-                second_max_width_files = [filename]
-            elif width == second_max_width:
-                second_max_width_files.append(filename)
-
-            if height > max_height:
-                second_max_height = max_height
-                second_max_height_files = max_height_files
-                max_height = height
-                max_height_files = [filename]
-            elif height == max_height:
-                max_height_files.append(filename)
-            elif height > second_max_height:
-                second_max_height = height
-                second_max_height_files = [filename]
-            elif height == second_max_height:
-                second_max_height_files.append(filename)
+    # Pad the results so that a folder with fewer than 2 distinct sizes reports 0 and an empty list
+    top_widths += [(0, [])] * (2 - len(top_widths))
+    top_heights += [(0, [])] * (2 - len(top_heights))
+    (max_width, max_width_files), (second_max_width, second_max_width_files) = top_widths
+    (max_height, max_height_files), (second_max_height, second_max_height_files) = top_heights
 
     # Return the maximum width, maximum height, and lists of filenames of images with maximum width and maximum height,
     # the second maximum width, second maximum height, and lists of filenames of images with the second maximum width and second maximum height
@@ -0,0 +1,138 @@
+import multiprocessing
+from contextlib import contextmanager
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+Decode strategies for the scripts in this directory that scale images down, so that large
+sources, such as the 384dpi exports, are not decoded and resampled at full resolution.
+
+Strategies:
+* reduce: decode near the target size, then resample. JPEG images are decoded at 1/2, 1/4 or
+1/8 scale with the draft mode of the decoder, which saves both memory and CPU. PNG images can
+only be decoded at full resolution, but they are first reduced by an integer factor with
+Image.reduce(), which is much cheaper than resampling the full image. Both steps stop at
+REDUCING_GAP times the target size, so the final resampling still sees enough pixels and the
+result is very close to the full path.
+* full: decode at native resolution and resample to the target size in one step.
+
+The number of large images decoded at the same time by all worker processes can also be capped,
+to bound the peak memory of a run when a few sources are much larger than the others. The cap is
+a semaphore shared with the worker processes by init_large_image_limit().
+"""
+
+DECODE_STRATEGIES = ("reduce", "full")
+
+# How much larger than the target size the image is kept before the final resampling
+REDUCING_GAP = 2.0
+
+# Images with more pixels than this are large, and count against the cap of large images
+LARGE_IMAGE_PIXELS = 2048 * 2048
+
+# The semaphore capping the number of large images in flight, set by init_large_image_limit()
+_large_image_slots = None
+
+
+def get_reducing_gap(strategy):
+    """
+    Returns the reducing_gap argument of Image.resize() and Image.thumbnail() for a strategy.
+    """
+    if strategy not in DECODE_STRATEGIES:
+        raise ValueError(f"Unsupported decode strategy {strategy}. Must be one of {', '.join(DECODE_STRATEGIES)}")
+    return REDUCING_GAP if strategy == "reduce" else None
+
+
+def decode_resize(img, size, strategy="reduce"):
+    """
+    Resizes an image with a decode strategy. When the image is not loaded yet, JPEG images are
+    decoded near the target size.
+
+    Parameters:
+        img (PIL.Image.Image): The image, opened but preferably not loaded yet.
+        size (tuple): (width, height) to resize to.
+        strategy (str): "reduce" or "full". See DECODE_STRATEGIES.
+
+    Returns:
+        PIL.Image.Image: The resized image.
+    """
+    reducing_gap = get_reducing_gap(strategy)
+    box = None
+    if reducing_gap is not None:
+        # Only JPEG images support draft mode, and only before they are loaded. The returned box
+        # is the region of the drafted image that matches the original image.
+        draft = img.draft(None, (int(size[0] * reducing_gap), int(size[1] * reducing_gap)))
+        if draft is not None:
+            box = draft[1]
+    return img.resize(size, box=box, reducing_gap=reducing_gap)
+
+
+def decode_thumbnail(img, size, strategy="reduce"):
+    """
+    Scales down an image in place to fit a size while maintaining its aspect ratio, like
+    Image.thumbnail(), with a decode strategy.
+
+    Parameters:
+        img (PIL.Image.Image): The image, opened but preferably not loaded yet.
+        size (tuple): (width, height) to fit in.
+        strategy (str): "reduce" or "full". See DECODE_STRATEGIES.
+
+    Returns:
+        PIL.Image.Image: The image.
+    """
+    img.thumbnail(size, reducing_gap=get_reducing_gap(strategy))
+    return img
+
+
+def create_large_image_limit(max_large_images):
+    """
+    Returns the semaphore capping the number of large images in flight, to pass to
+    init_large_image_limit() in every worker process.
+
+    Parameters:
+        max_large_images (int): The maximum number of large images in flight. None or 0 means no cap.
+
+    Returns:
+        multiprocessing.BoundedSemaphore: The semaphore, or None for no cap.
+    """
+    return multiprocessing.BoundedSemaphore(max_large_images) if max_large_images else None
+
+
+def init_large_image_limit(slots):
+    """
+    Sets the semaphore capping the number of large images in flight in this process. Passed as
+    the initializer of the worker processes.
+
+    Parameters:
+        slots (multiprocessing.BoundedSemaphore): The semaphore shared by all worker processes, or None for no cap.
+
+    Returns:
+        None.
+    """
+    global _large_image_slots
+    _large_image_slots = slots
+
+
+@contextmanager
+def large_image_slot(img):
+    """
+    Waits for a free slot while a large image is decoded and processed. Images that are not
+    large, or runs without a cap, don't wait.
+
+    Parameters:
+        img (PIL.Image.Image): The opened image. Only its header is needed.
+    """
+    width, height = img.size
+    if _large_image_slots is None or width * height <= LARGE_IMAGE_PIXELS:
+        yield
+        return
+
+    with _large_image_slots:
+        yield
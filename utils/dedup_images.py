@@ -0,0 +1,308 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+from functools import partial
+import numpy as np
+from PIL import Image
+from common_funcs import list_image_files
+from parallel_funcs import process_in_parallel
+from shard_funcs import get_shard_suffix, parse_shard, select_shard
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+This script finds visually identical or near-identical Bliss symbols in a directory, so that
+duplicates under different IDs are not synced, resized and trained on separately. Run it after
+get_bliss_single_chars.py and before image_size_sync.py.
+
+Steps:
+1. Compute a perceptual hash (pHash) of every image in parallel. Transparent backgrounds
+are flattened onto white first, so transparent and opaque exports of a symbol hash the same.
+2. Go through the images in filename order. Each image is looked up in a BK-tree of the canonical
+images found so far. If a canonical image is within the Hamming distance threshold, the image is
+recorded as its duplicate, otherwise it becomes a canonical image. The BK-tree lookup avoids
+comparing every pair of images.
+3. Save the canonical set, the duplicate map and the images that failed to hash as JSON. Optionally, copy the canonical images
+into a directory.
+
+With --shard, only the images of one shard are hashed, and their hashes are saved to
+dedup.shard-INDEX-of-COUNT.json. Duplicates can be in different shards, so the images are compared
+once all shards are done, by merging their hashes with merge_shards.py dedup.
+
+Usage: python dedup_images.py [image_dir] [--threshold N] [--output PATH] [--canonical-dir DIR] [--workers N] [--shard INDEX/COUNT]
+Parameters:
+  image_dir: The directory where the images are located.
+  --threshold: Optional. The maximum Hamming distance between the hashes of duplicates. Defaults to 4.
+  --output: Optional. The path of the JSON result. Defaults to dedup.json in the image directory.
+  --canonical-dir: Optional. The directory to copy the canonical images to.
+  --workers: Optional. The number of worker processes. Defaults to the number of CPU cores.
+  --shard: Optional. Only hash the images of one shard: INDEX/COUNT, such as 0/4, or slurm to read it from the
+  SLURM array task. See shard_funcs.py. Can't be combined with --canonical-dir.
+Return: None
+
+Example: python dedup_images.py ~/Downloads/bliss_single_chars --threshold 2 --canonical-dir ~/Downloads/bliss_single_chars_dedup
+"""
+
+# The size the images are reduced to before the DCT, and the size of the kept low-frequency block
+HASH_IMAGE_SIZE = 32
+HASH_SIZE = 8
+
+
+def _dct_matrix(size):
+    # Orthonormal DCT-II matrix, so the 2D DCT of an image is matrix @ image @ matrix.T
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_MATRIX = _dct_matrix(HASH_IMAGE_SIZE)
+
+
+def perceptual_hash(img):
+    """
+    Returns the perceptual hash (pHash) of an image: one bit per low-frequency DCT coefficient of
+    the reduced grayscale image, set when the coefficient is above their median. The DC coefficient
+    only reflects the average brightness, so it is left out and the hash has 63 bits.
+
+    Parameters:
+        img (PIL.Image.Image): The image.
+
+    Returns:
+        int: The hash.
+    """
+    # Flatten a transparent background onto white so the ink is what gets hashed
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        flattened = Image.new('RGBA', rgba.size, (255, 255, 255, 255))
+        flattened.alpha_composite(rgba)
+        img = flattened
+
+    pixels = np.asarray(img.convert('L').resize((HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), Image.LANCZOS), dtype=np.float64)
+    low_frequencies = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = low_frequencies[1:] > np.median(low_frequencies[1:])
+
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hash_image(filename, image_dir):
+    """
+    Returns the perceptual hash of one image. This is the per-file task run by the worker processes.
+    """
+    with Image.open(os.path.join(image_dir, filename)) as img:
+        return perceptual_hash(img)
+
+
+def hamming_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count('1')
+
+
+def bk_tree_add(tree, hash_value, item):
+    """
+    Adds an item to a BK-tree over Hamming distance. A node is [hash, item, {distance: child node}].
+
+    Parameters:
+        tree (list): The root node, or None for an empty tree.
+        hash_value (int): The hash of the item.
+        item: The item to store, such as a filename.
+
+    Returns:
+        list: The root node.
+    """
+    node = [hash_value, item, {}]
+    if tree is None:
+        return node
+
+    current = tree
+    while True:
+        distance = hamming_distance(hash_value, current[0])
+        child = current[2].get(distance)
+        if child is None:
+            current[2][distance] = node
+            return tree
+        current = child
+
+
+def bk_tree_find_nearest(tree, hash_value, threshold):
+    """
+    Finds the item of a BK-tree closest to a hash, within a maximum Hamming distance. Only the
+    subtrees that can contain a match are visited.
+
+    Parameters:
+        tree (list): The root node, or None for an empty tree.
+        hash_value (int): The hash to look up.
+        threshold (int): The maximum Hamming distance.
+
+    Returns:
+        tuple: (distance, item) of the closest item, or None if no item is within the threshold.
+    """
+    best = None
+    nodes = [tree] if tree is not None else []
+    while nodes:
+        node_hash, item, children = nodes.pop()
+        distance = hamming_distance(hash_value, node_hash)
+        if distance <= threshold and (best is None or distance < best[0]):
+            best = (distance, item)
+        # By the triangle inequality, matches can only be in children whose edge distance is
+        # within threshold of this node's distance
+        for edge_distance, child in children.items():
+            if distance - threshold <= edge_distance <= distance + threshold:
+                nodes.append(child)
+    return best
+
+
+def find_duplicates(hashes, threshold):
+    """
+    Groups images into canonical images and their near-duplicates.
+
+    Parameters:
+        hashes (list): (filename, hash) of every image. Earlier images become the canonical ones.
+        threshold (int): The maximum Hamming distance between the hashes of duplicates.
+
+    Returns:
+        tuple: A tuple containing:
+        * the filenames of the canonical images (list)
+        * a dict that maps the filename of every duplicate to the filename of its canonical image (dict)
+    """
+    tree = None
+    canonical = []
+    duplicates = {}
+    for filename, hash_value in hashes:
+        match = bk_tree_find_nearest(tree, hash_value, threshold)
+        if match is None:
+            tree = bk_tree_add(tree, hash_value, filename)
+            canonical.append(filename)
+        else:
+            duplicates[filename] = match[1]
+    return canonical, duplicates
+
+
+def save_dedup_result(output_path, threshold, hashes, failures):
+    """
+    Groups hashed images into canonical images and their near-duplicates, and saves the result as JSON.
+
+    Parameters:
+        output_path (str): The path of the JSON result.
+        threshold (int): The maximum Hamming distance between the hashes of duplicates.
+        hashes (list): (filename, hash) of every image, in filename order.
+        failures (list): (filename, error message) of the images that failed to hash.
+
+    Returns:
+        tuple: The canonical filenames and the duplicate map returned by find_duplicates().
+    """
+    # Images that can't be hashed can't be compared, so they are reported instead of silently left out
+    if failures:
+        print(f"Warning: {len(failures)} images failed to hash and are left out of the comparison: {', '.join(filename for filename, _ in failures)}")
+    canonical, duplicates = find_duplicates(hashes, threshold)
+
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            "threshold": threshold,
+            "canonical": canonical,
+            "duplicates": duplicates,
+            "hashes": {filename: f"{hash_value:016x}" for filename, hash_value in hashes},
+            "failed": [{"filename": filename, "error": error} for filename, error in failures]
+        }, output_file, indent=2)
+    print(f"{len(canonical)} canonical images, {len(duplicates)} duplicates, {len(failures)} failed to hash. Result saved to {output_path}")
+    return canonical, duplicates
+
+
+def save_shard_hashes(output_path, threshold, shard, hashes, failures):
+    """
+    Saves the hashes of the images of one shard as JSON, to be compared with merge_shards.py dedup.
+
+    Parameters:
+        output_path (str): The path of the JSON file.
+        threshold (int): The maximum Hamming distance between the hashes of duplicates.
+        shard (tuple): (index, count) returned by parse_shard().
+        hashes (list): (filename, hash) of every image of the shard.
+        failures (list): (filename, error message) of the images that failed to hash.
+
+    Returns:
+        None.
+    """
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            "threshold": threshold,
+            "shard": list(shard),
+            "hashes": {filename: f"{hash_value:016x}" for filename, hash_value in hashes},
+            "failed": [{"filename": filename, "error": error} for filename, error in failures]
+        }, output_file, indent=2)
+    print(f"Hashed {len(hashes)} images of shard {shard[0]}/{shard[1]}, {len(failures)} failed. Hashes saved to {output_path}")
+
+
+def dedup_images(image_dir, threshold=4, output_path=None, canonical_dir=None, workers=None, shard=None):
+    """
+    Finds the near-duplicate images in a directory and saves the canonical set and duplicate map.
+
+    Parameters:
+        image_dir (str): The directory where the images are located.
+        threshold (int): The maximum Hamming distance between the hashes of duplicates.
+        output_path (str): The path of the JSON result. Defaults to dedup.json in the image directory,
+            or dedup.shard-INDEX-of-COUNT.json for a shard.
+        canonical_dir (str): Optional. The directory to copy the canonical images to.
+        workers (int): The number of worker processes. None means one per CPU core.
+        shard (tuple): Optional. (index, count) returned by parse_shard() to only hash the images of one shard.
+            Duplicates can be in different shards, so a shard only saves its hashes, and the images are
+            compared once the hashes of all shards are merged with merge_shards.py dedup. Can't be
+            combined with canonical_dir.
+
+    Returns:
+        tuple: The canonical filenames and the duplicate map returned by find_duplicates(), or None for a shard.
+    """
+    if shard is not None and canonical_dir:
+        raise ValueError("The canonical images are only known once the hashes of all shards are merged and can't be copied from a shard")
+
+    if output_path is None:
+        output_path = os.path.join(image_dir, f"dedup{get_shard_suffix(shard)}.json")
+
+    task = partial(hash_image, image_dir=image_dir)
+    hashes, failures = process_in_parallel(task, select_shard(list_image_files(image_dir), shard), workers=workers, verbose=False)
+    if shard is not None:
+        save_shard_hashes(output_path, threshold, shard, hashes, failures)
+        return None
+
+    canonical, duplicates = save_dedup_result(output_path, threshold, hashes, failures)
+
+    if canonical_dir:
+        os.makedirs(canonical_dir, exist_ok=True)
+        for filename in canonical:
+            shutil.copy(os.path.join(image_dir, filename), os.path.join(canonical_dir, filename))
+        print(f"Canonical images copied to {canonical_dir}")
+
+    return canonical, duplicates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find near-duplicate images with perceptual hashes.")
+    parser.add_argument("image_dir", help="The directory where the images are located.")
+    parser.add_argument("--threshold", type=int, default=4, help="The maximum Hamming distance between the hashes of duplicates.")
+    parser.add_argument("--output", default=None, help="The path of the JSON result. Defaults to dedup.json in the image directory.")
+    parser.add_argument("--canonical-dir", default=None, help="The directory to copy the canonical images to.")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes. Defaults to the number of CPU cores.")
+    parser.add_argument("--shard", default=None, help="Only hash the images of one shard: INDEX/COUNT, such as 0/4, or slurm for the SLURM array task.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.image_dir):
+        print(f"Error: Input directory {args.image_dir} not found")
+        sys.exit(1)
+
+    try:
+        dedup_images(args.image_dir, args.threshold, args.output, args.canonical_dir, args.workers, parse_shard(args.shard))
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
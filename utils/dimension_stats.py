@@ -0,0 +1,321 @@
+import argparse
+import heapq
+import json
+import os
+import sys
+from PIL import Image
+from common_funcs import iter_image_files
+from shard_funcs import in_shard, parse_shard
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+This script computes statistics of the dimensions of all PNG and JPG images in a directory and
+its subdirectories in one streaming pass, to help choose a canvas size for image_size_sync.py
+instead of always using the maximum dimension.
+
+Only the header of every image is read. Memory is bounded regardless of the number of files:
+widths, heights and aspect ratios are kept as counts per value, the largest images are kept in
+fixed-size heaps and the outlier list is capped.
+
+The report includes:
+* width, height and aspect ratio (width / height) histograms;
+* percentiles of the width, the height and the larger side of the images;
+* the K largest widths, heights and larger sides with their filenames;
+* outliers, the images whose aspect ratio is more extreme than a threshold.
+
+With --shard, only the images of one shard are read, by their path relative to image_dir. Save
+the statistics of every shard with --json and combine them with merge_shards.py.
+
+Usage: python dimension_stats.py [image_dir] [--top K] [--bin-width N] [--max-aspect R] [--max-outliers N] [--json PATH]
+       [--shard INDEX/COUNT]
+Parameters:
+  image_dir: The root directory of the images.
+  --top: Optional. The number of largest images to report. Defaults to 10.
+  --bin-width: Optional. The bin width in pixels of the width and height histograms. Defaults to 32.
+  --max-aspect: Optional. Images with an aspect ratio above R or below 1/R are outliers. Defaults to 4.
+  --max-outliers: Optional. The maximum number of outliers to list. Defaults to 100.
+  --json: Optional. The path of a JSON file to save the statistics to.
+  --shard: Optional. Only read the images of one shard: INDEX/COUNT, such as 0/4, or slurm to read it from the
+  SLURM array task. See shard_funcs.py.
+Return: None
+
+Example: python dimension_stats.py images/ --top 5 --json stats.json
+"""
+
+# Percentiles included in the report
+PERCENTILES = (50, 90, 95, 99, 99.9, 100)
+
+# The bin width of the aspect ratio histogram
+ASPECT_BIN_WIDTH = 0.25
+
+
+def new_dimension_stats(top_k=10, max_aspect=4.0, max_outliers=100):
+    """
+    Returns empty dimension statistics to accumulate images into with add_image().
+
+    Parameters:
+        top_k (int): The number of largest images to keep.
+        max_aspect (float): Images with an aspect ratio above max_aspect or below 1/max_aspect are outliers.
+        max_outliers (int): The maximum number of outliers to keep.
+
+    Returns:
+        dict: The statistics. It only contains JSON-compatible values once passed through
+        stats_to_json(), so statistics can be saved and merged later with merge_dimension_stats().
+    """
+    return {
+        "settings": {"top_k": top_k, "max_aspect": max_aspect, "max_outliers": max_outliers},
+        "count": 0,
+        "failed": 0,
+        "width_counts": {},
+        "height_counts": {},
+        "side_counts": {},
+        "aspect_counts": {},
+        "top_widths": [],
+        "top_heights": [],
+        "top_sides": [],
+        "outlier_count": 0,
+        "outliers": []
+    }
+
+
+def _push_top(heap, value, filename, top_k):
+    # A min-heap of size top_k keeps the top_k largest values seen so far
+    if len(heap) < top_k:
+        heapq.heappush(heap, (value, filename))
+    elif (value, filename) > heap[0]:
+        heapq.heapreplace(heap, (value, filename))
+
+
+def add_image(stats, filename, width, height):
+    """
+    Adds the dimensions of one image to the statistics.
+
+    Parameters:
+        stats (dict): The statistics returned by new_dimension_stats().
+        filename (str): The filename of the image, reported in the top-k and outlier lists.
+        width (int): The width of the image.
+        height (int): The height of the image.
+
+    Returns:
+        None.
+    """
+    settings = stats["settings"]
+    side = max(width, height)
+    aspect = width / height
+    aspect_bin = min(int(aspect / ASPECT_BIN_WIDTH), int(settings["max_aspect"] / ASPECT_BIN_WIDTH))
+
+    stats["count"] += 1
+    for key, value in (("width_counts", width), ("height_counts", height), ("side_counts", side), ("aspect_counts", aspect_bin)):
+        stats[key][value] = stats[key].get(value, 0) + 1
+
+    _push_top(stats["top_widths"], width, filename, settings["top_k"])
+    _push_top(stats["top_heights"], height, filename, settings["top_k"])
+    _push_top(stats["top_sides"], side, filename, settings["top_k"])
+
+    if aspect > settings["max_aspect"] or aspect < 1 / settings["max_aspect"]:
+        stats["outlier_count"] += 1
+        if len(stats["outliers"]) < settings["max_outliers"]:
+            stats["outliers"].append([filename, width, height])
+
+
+def collect_dimension_stats(folder_path, top_k=10, max_aspect=4.0, max_outliers=100, shard=None):
+    """
+    Computes the dimension statistics of all images in a folder and its subfolders. Only the
+    header of every image is read.
+
+    Parameters:
+        folder_path (str): The path to the root folder.
+        top_k (int): The number of largest images to keep.
+        max_aspect (float): Images with an aspect ratio above max_aspect or below 1/max_aspect are outliers.
+        max_outliers (int): The maximum number of outliers to keep.
+        shard (tuple): Optional. (index, count) returned by parse_shard() to only read the images of one shard.
+
+    Returns:
+        dict: The statistics.
+    """
+    stats = new_dimension_stats(top_k, max_aspect, max_outliers)
+    for image_path in iter_image_files(folder_path):
+        filename = os.path.relpath(image_path, folder_path)
+        if not in_shard(filename, shard):
+            continue
+        try:
+            with Image.open(image_path) as image:
+                width, height = image.size
+        except Exception as e:
+            stats["failed"] += 1
+            print(f"Error: failed to read {image_path}: {e}")
+            continue
+        add_image(stats, filename, width, height)
+    return stats
+
+
+def merge_dimension_stats(stats, other):
+    """
+    Merges the statistics of another set of images into stats, such as the statistics computed
+    by separate jobs over parts of a directory. Both must have been created with the same settings.
+
+    Parameters:
+        stats (dict): The statistics to merge into.
+        other (dict): The statistics to merge.
+
+    Returns:
+        dict: stats, updated.
+    """
+    settings = stats["settings"]
+    stats["count"] += other["count"]
+    stats["failed"] += other["failed"]
+    for key in ("width_counts", "height_counts", "side_counts", "aspect_counts"):
+        for value, count in other[key].items():
+            stats[key][value] = stats[key].get(value, 0) + count
+    for key in ("top_widths", "top_heights", "top_sides"):
+        for value, filename in other[key]:
+            _push_top(stats[key], value, filename, settings["top_k"])
+    stats["outlier_count"] += other["outlier_count"]
+    stats["outliers"].extend(other["outliers"][:settings["max_outliers"] - len(stats["outliers"])])
+    return stats
+
+
+def stats_to_json(stats):
+    """
+    Returns a copy of the statistics that can be saved with json.dump(). JSON object keys are
+    strings, so the count dicts are stored as [value, count] pairs.
+    """
+    result = dict(stats)
+    for key in ("width_counts", "height_counts", "side_counts", "aspect_counts"):
+        result[key] = sorted([value, count] for value, count in stats[key].items())
+    for key in ("top_widths", "top_heights", "top_sides"):
+        result[key] = [list(item) for item in stats[key]]
+    return result
+
+
+def stats_from_json(data):
+    """
+    Returns the statistics saved with stats_to_json().
+    """
+    stats = dict(data)
+    for key in ("width_counts", "height_counts", "side_counts", "aspect_counts"):
+        stats[key] = {value: count for value, count in data[key]}
+    for key in ("top_widths", "top_heights", "top_sides"):
+        stats[key] = [tuple(item) for item in data[key]]
+        heapq.heapify(stats[key])
+    return stats
+
+
+def get_percentiles(counts, percentiles=PERCENTILES):
+    """
+    Returns percentiles of the values counted in a count dict, using the nearest-rank method.
+
+    Parameters:
+        counts (dict): Maps values to the number of images with this value.
+        percentiles (tuple): The percentiles to compute, from 0 to 100.
+
+    Returns:
+        dict: Maps each percentile to its value. Empty if there is no value.
+    """
+    total = sum(counts.values())
+    if not total:
+        return {}
+
+    result = {}
+    values = sorted(counts.items())
+    for percentile in sorted(percentiles):
+        rank = max(1, -(-percentile * total // 100))
+        cumulative = 0
+        for value, count in values:
+            cumulative += count
+            if cumulative >= rank:
+                result[percentile] = value
+                break
+    return result
+
+
+def get_histogram(counts, bin_width):
+    """
+    Groups counted values into bins of a given width.
+
+    Parameters:
+        counts (dict): Maps values to the number of images with this value.
+        bin_width (int): The width of each bin.
+
+    Returns:
+        list: (bin start, count) for every non-empty bin, in ascending order.
+    """
+    bins = {}
+    for value, count in counts.items():
+        start = value // bin_width * bin_width
+        bins[start] = bins.get(start, 0) + count
+    return sorted(bins.items())
+
+
+def print_report(stats, bin_width=32):
+    """
+    Prints the statistics as a readable report.
+    """
+    print(f"Images: {stats['count']}, failed to read: {stats['failed']}")
+    if not stats["count"]:
+        return
+
+    for label, key in (("Width", "width_counts"), ("Height", "height_counts"), ("Larger side", "side_counts")):
+        percentiles = get_percentiles(stats[key])
+        print(f"{label} percentiles: " + ", ".join(f"p{p:g}={v}" for p, v in percentiles.items()))
+
+    for label, key in (("Width", "width_counts"), ("Height", "height_counts")):
+        print(f"\n{label} histogram (bin width {bin_width}):")
+        for start, count in get_histogram(stats[key], bin_width):
+            print(f"  {start:>6}-{start + bin_width - 1:<6} {count}")
+
+    print("\nAspect ratio (width / height) histogram:")
+    last_bin = int(stats["settings"]["max_aspect"] / ASPECT_BIN_WIDTH)
+    for aspect_bin, count in sorted(stats["aspect_counts"].items()):
+        start = aspect_bin * ASPECT_BIN_WIDTH
+        label = f">= {start:.2f}" if aspect_bin == last_bin else f"{start:.2f}-{start + ASPECT_BIN_WIDTH:.2f}"
+        print(f"  {label:<12} {count}")
+
+    for label, key in (("widths", "top_widths"), ("heights", "top_heights"), ("larger sides", "top_sides")):
+        print(f"\nLargest {label}:")
+        for value, filename in sorted(stats[key], reverse=True):
+            print(f"  {value} {filename}")
+
+    print(f"\nOutliers (aspect ratio beyond {stats['settings']['max_aspect']}:1): {stats['outlier_count']}"
+          f", listing {len(stats['outliers'])}")
+    for filename, width, height in stats["outliers"]:
+        print(f"  {width}x{height} {filename}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute dimension statistics of all images in a directory tree.")
+    parser.add_argument("image_dir", help="The root directory of the images.")
+    parser.add_argument("--top", type=int, default=10, help="The number of largest images to report.")
+    parser.add_argument("--bin-width", type=int, default=32, help="The bin width in pixels of the width and height histograms.")
+    parser.add_argument("--max-aspect", type=float, default=4.0, help="Images with an aspect ratio above R or below 1/R are outliers.")
+    parser.add_argument("--max-outliers", type=int, default=100, help="The maximum number of outliers to list.")
+    parser.add_argument("--json", default=None, help="The path of a JSON file to save the statistics to.")
+    parser.add_argument("--shard", default=None, help="Only read the images of one shard: INDEX/COUNT, such as 0/4, or slurm for the SLURM array task.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.image_dir):
+        print(f"Error: Input directory {args.image_dir} not found")
+        sys.exit(1)
+
+    try:
+        shard = parse_shard(args.shard)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    stats = collect_dimension_stats(args.image_dir, args.top, args.max_aspect, args.max_outliers, shard)
+    print_report(stats, args.bin_width)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(stats_to_json(stats), json_file)
+        print(f"\nStatistics saved to {args.json}")
@@ -5,57 +5,235 @@ Steps:
 1. Read a tab separated .tsv file exported from [BCI-AV Easter Characters](https://docs.google.com/spreadsheets/d/1t1x1UFuJC1hpjrxdXKi19Tk_Tv-9GVQWSA4sN2FScv4/edit#gid=138588066).
 that has all the information of Bliss single characters.
 2. Pad the values of the first column to a length of 5, then add ".png" extension to these padded values
-3. find these png files in a directory that has all bliss symbols in PNG format
-4. The found png files are copied to the target directory. If a png file is not found, report an error.
+3. find these png files in a directory that has all bliss symbols in PNG format. The directory is
+listed once and the filenames are matched in memory, so there is no metadata round-trip per row
+on a network filesystem.
+4. The found png files are copied to the target directory in parallel, or hardlinked/reflinked when
+requested. If a png file is not found, report an error. The files are transferred without any
+other metadata access per file: a target file is only checked when it already exists. Only the
+--incremental mode reads the manifest in the target directory and records the symbols in it.
+5. Write a JSON report of the matched, failed and missing IDs. In a sharded run, the report only
+covers the IDs of the shard.
 
-Usage: python script_name.py tsv_file_path all_bliss_symbol_dir target_dir
+Usage: python script_name.py tsv_file_path all_bliss_symbol_dir target_dir [--incremental] [--workers N] [--link METHOD] [--report PATH]
+       [--shard INDEX/COUNT]
 Parameters:
   tsv_file_path: The path to the .tsv file to be read.
   all_bliss_symbol_dir: The path to the directory where all Bliss symbol images are located.
   target_dir: The path to the directory where matched symbol images will be copied to.
+  --incremental: Optional. Skip symbols whose content matches the manifest in the target directory.
+  --workers: Optional. The number of worker processes copying files. Defaults to the number of CPU cores.
+  --link: Optional. How to transfer the files: "copy" (default), "hardlink", "reflink" (copy-on-write
+  clone, falls back to a copy if the filesystem doesn't support it) or "auto" (hardlink when the source and
+  target directories are on the same filesystem, otherwise copy).
+  Hardlinked files share their content with the source, so only use "hardlink" or "auto" when the target
+  files won't be modified in place.
+  --report: Optional. The path of the JSON report. Defaults to extraction_report.json in the target directory, or
+  extraction_report.shard-INDEX-of-COUNT.json in a sharded run.
+  --shard: Optional. Only copy the symbols of one shard: INDEX/COUNT, such as 0/4, or slurm to read it from the
+  SLURM array task. See shard_funcs.py.
 Return: All Bliss single characters are copied into the target directory.
 
 Example: python get_bliss_single_chars.py ~/Downloads/BCI_single_characters.tsv ~/Downloads/h264-0.666-nogrid-transparent-384dpi-bciid ~/Downloads/bliss_single_chars
 '''
 
+import argparse
+import json
 import os
 import shutil
 import sys
+from functools import partial
+from manifest_funcs import process_incrementally
+from parallel_funcs import process_in_parallel
+from shard_funcs import get_shard_suffix, in_shard, parse_shard
 
-# Get the file paths from the command line arguments
-tsv_file_path = sys.argv[1]
-all_bliss_symbol_dir = sys.argv[2]
-target_dir = sys.argv[3]
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where reflinks fall back to a regular copy
+    fcntl = None
 
-# Create the output directory if it doesn't exist
-if not os.path.isdir(target_dir):
-    os.makedirs(target_dir)
+# The ioctl request that clones a file on copy-on-write filesystems such as Btrfs and XFS (Linux only)
+FICLONE = 0x40049409
 
-# Open the .tsv file for reading
-with open(tsv_file_path, 'r') as tsv_file:
-    # Skip the first row (header)
-    next(tsv_file)
+# The buffer size of regular copies
+COPY_BUFFER_SIZE = 1 << 20
 
-    # Iterate over the rows in the .tsv file
-    for row in tsv_file:
-        # Split the row into columns
-        columns = row.strip().split('\t')
+LINK_METHODS = ("copy", "hardlink", "reflink", "auto")
 
-        # Get the value in the first column
-        value = columns[0]
 
-        # Pad the value with "0" to a length of 5
-        padded_value = value.zfill(5)
+def read_single_char_filenames(tsv_file_path):
+    """
+    Reads the BCI IDs of Bliss single characters from a .tsv file and returns their png filenames.
 
-        # Add the ".png" extension to the padded value
-        png_filename = padded_value + ".png"
+    Parameters:
+        tsv_file_path (str): The path to the .tsv file to be read.
 
+    Returns:
+        list: The png filenames, in the order of the rows in the .tsv file.
+    """
+    png_filenames = []
+
+    # Open the .tsv file for reading
+    with open(tsv_file_path, 'r') as tsv_file:
+        # Skip the first row (header)
+        next(tsv_file)
+
+        # Iterate over the rows in the .tsv file
+        for row in tsv_file:
+            # Split the row into columns
+            columns = row.strip().split('\t')
+
+            # Get the value in the first column
+            value = columns[0]
+
+            # Pad the value with "0" to a length of 5
+            padded_value = value.zfill(5)
+
+            # Add the ".png" extension to the padded value
+            png_filenames.append(padded_value + ".png")
+
+    return png_filenames
+
+
+def transfer_file(src_path, dst_path, link="copy"):
+    """
+    Copies, hardlinks or reflinks a file to a path that must not exist yet. A reflink falls back to a
+    regular copy when the filesystem or platform doesn't support it.
+
+    Raises:
+        FileExistsError: If the target path exists.
+    """
+    if link == "hardlink":
+        os.link(src_path, dst_path)
+        return
+    # The target is created exclusively, so an existing file, which may be hardlinked to a source
+    # symbol by a previous run, is never written into
+    with open(src_path, 'rb') as src, open(dst_path, 'xb') as dst:
+        if link == "reflink" and fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+def copy_symbol(png_filename, all_bliss_symbol_dir, target_dir, link="copy"):
+    # Copy the png file to the matched png directory
+    png_file_path = os.path.join(all_bliss_symbol_dir, png_filename)
+    matched_png_file_path = os.path.join(target_dir, png_filename)
+
+    try:
+        transfer_file(png_file_path, matched_png_file_path, link)
+    except FileExistsError:
+        if link == "hardlink" and os.path.samefile(png_file_path, matched_png_file_path):
+            return matched_png_file_path
+        # Replace the file of a previous run
+        os.remove(matched_png_file_path)
+        transfer_file(png_file_path, matched_png_file_path, link)
+    return matched_png_file_path
+
+
+def resolve_link_method(link, all_bliss_symbol_dir, target_dir):
+    """
+    Resolves the "auto" link method: hardlink when the source and target directories are on the
+    same filesystem, otherwise copy.
+    """
+    if link != "auto":
+        return link
+    return "hardlink" if os.stat(all_bliss_symbol_dir).st_dev == os.stat(target_dir).st_dev else "copy"
+
+
+def write_report(report_path, matched_filenames, failures, missing_filenames):
+    """
+    Writes a JSON report of the matched, failed and missing BCI IDs.
+
+    Parameters:
+        report_path (str): The path of the report file.
+        matched_filenames (list): The png filenames found in the symbol directory and in the target directory.
+        failures (list): (png filename, error message) of the files found in the symbol directory that
+            could not be copied.
+        missing_filenames (list): The png filenames not found in the symbol directory.
+
+    Returns:
+        None.
+    """
+    report = {
+        "matched_count": len(matched_filenames),
+        "failed_count": len(failures),
+        "missing_count": len(missing_filenames),
+        "matched": [os.path.splitext(filename)[0] for filename in matched_filenames],
+        "failed": [{"id": os.path.splitext(filename)[0], "error": error} for filename, error in failures],
+        "missing": [os.path.splitext(filename)[0] for filename in missing_filenames]
+    }
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+
+def get_bliss_single_chars(tsv_file_path, all_bliss_symbol_dir, target_dir, incremental=False, workers=None, link="copy", report_path=None, shard=None):
+    # Create the output directory if it doesn't exist
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+
+    # List the symbol directory once instead of checking every row with os.path.exists
+    with os.scandir(all_bliss_symbol_dir) as entries:
+        available_filenames = {entry.name for entry in entries if entry.is_file()}
+
+    found_filenames = []
+    missing_filenames = []
+    for png_filename in read_single_char_filenames(tsv_file_path):
+        # In a sharded run, only the IDs of the shard are copied and reported
+        if not in_shard(png_filename, shard):
+            continue
         # Check if the png file exists in the png directory
-        png_file_path = os.path.join(all_bliss_symbol_dir, png_filename)
-        if os.path.exists(png_file_path):
-            # Copy the png file to the matched png directory
-            matched_png_file_path = os.path.join(target_dir, png_filename)
-            shutil.copy(png_file_path, matched_png_file_path)
+        if png_filename in available_filenames:
+            found_filenames.append(png_filename)
         else:
             # Report an error if the png file is not found
+            missing_filenames.append(png_filename)
             print("Error: {} not found in {}".format(png_filename, all_bliss_symbol_dir))
+
+    link = resolve_link_method(link, all_bliss_symbol_dir, target_dir)
+    task = partial(copy_symbol, all_bliss_symbol_dir=all_bliss_symbol_dir, target_dir=target_dir, link=link)
+    if incremental:
+        params = {"op": "get_bliss_single_chars"}
+        results, failures = process_incrementally(task, found_filenames, all_bliss_symbol_dir, target_dir, params, incremental, workers, shard=shard)
+    else:
+        # The bulk path: copy every matched file, without the manifest
+        if shard is not None:
+            print(f"Shard {shard[0]}/{shard[1]}: {len(found_filenames)} files")
+        results, failures = process_in_parallel(task, found_filenames, workers=workers)
+
+    if report_path is None:
+        # Every shard writes its own report so that concurrent shards don't write to the same file
+        report_path = os.path.join(target_dir, f"extraction_report{get_shard_suffix(shard)}.json")
+    # The matched IDs include the ones skipped as up to date in incremental mode
+    failed_filenames = {filename for filename, _ in failures}
+    matched_filenames = [filename for filename in found_filenames if filename not in failed_filenames]
+    write_report(report_path, matched_filenames, failures, missing_filenames)
+    print(f"Matched {len(matched_filenames)} IDs, {len(failures)} failed, {len(missing_filenames)} missing. Report saved to {report_path}")
+
+    return results, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy all Bliss single characters from a directory with all Bliss symbols.")
+    parser.add_argument("tsv_file_path", help="The path to the .tsv file to be read.")
+    parser.add_argument("all_bliss_symbol_dir", help="The path to the directory where all Bliss symbol images are located.")
+    parser.add_argument("target_dir", help="The path to the directory where matched symbol images will be copied to.")
+    parser.add_argument("--incremental", action="store_true", help="Skip symbols whose content matches the manifest in the target directory.")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes copying files. Defaults to the number of CPU cores.")
+    parser.add_argument("--link", choices=LINK_METHODS, default="copy", help="How to transfer the files to the target directory.")
+    parser.add_argument("--report", default=None, help="The path of the JSON report of matched and missing IDs.")
+    parser.add_argument("--shard", default=None, help="Only copy the symbols of one shard: INDEX/COUNT, such as 0/4, or slurm for the SLURM array task.")
+    args = parser.parse_args()
+
+    try:
+        shard = parse_shard(args.shard)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    get_bliss_single_chars(args.tsv_file_path, args.all_bliss_symbol_dir, args.target_dir, incremental=args.incremental,
+                           workers=args.workers, link=args.link, report_path=args.report, shard=shard)
@@ -1,5 +1,7 @@
+import argparse
 import sys
-from common_funcs import get_max_dimensions
+from common_funcs import get_max_dimensions, get_top_dimensions
+from trim_funcs import TRIM_PADDING, check_trim_padding, get_trimmed_dimensions
 
 """
 This script finds the maximum width and maximum height of all images in a folder,
@@ -7,9 +9,21 @@ along with a list of image filenames that have the maximum width and maximum hei
 It also finds the second maximum width and second maximum height, along with their respective
 lists of image filenames.
 
-Usage: python get_max_dimensions.py [image_directory]
+The image dimensions are cached in a dimension index file (.dimension_index.json) in the image
+directory, so re-running the script only reads the headers of new or changed images.
+
+With --trim, the script reports the maximum width and height of the images once trimmed to their
+ink, and the canvas size of image_size_sync.py --trim. This builds the trim index of the directory
+(see trim_funcs.py), so run it once before a sharded run with --trim, whose shards only read the
+index, or pass the reported canvas size to the shards with --canvas-size.
+
+Usage: python get_max_dimensions.py [image_directory] [--top K] [--no-index] [--trim [PADDING]] [--workers N]
 Parameter:
   image_directory: The path to the directory containing the images.
+  --top: Optional. Report the K largest widths and heights instead of the max and second max.
+  --no-index: Optional. Read the header of every image instead of using the dimension index.
+  --trim: Optional. Report the dimensions of the images once trimmed to their ink plus PADDING pixels (2 by default).
+  --workers: Optional. The number of worker processes finding the ink of the images. Defaults to the number of CPU cores.
 Return: tuple: A tuple containing:
   * the maximum width (int)
   * maximum height (int)
@@ -22,21 +36,43 @@ Return: tuple: A tuple containing:
 Example: python get_max_dimensions.py images/
 """
 
-# Check if the correct number of arguments were provided
-if len(sys.argv) != 2:
-    print(f"Usage: python {sys.argv[0]} image_directory")
-    print(f"Example: python {sys.argv[0]} images/")
-    sys.exit(1)
-
-# Parse the input arguments
-image_dir = sys.argv[1]
-
-results = get_max_dimensions(image_dir)
-print("The max width is: ", results[0])
-print("The list of images with the max width is: ", results[2])
-print("The max height is: ", results[1])
-print("The list of images with the max height is: ", results[3])
-print("The second max width is: ", results[4])
-print("The list of images with the second max width is: ", results[6])
-print("The second max height is: ", results[5])
-print("The list of images with the second max height is: ", results[7])
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the maximum width and height of all images in a directory.")
+    parser.add_argument("image_dir", help="The path to the directory containing the images.")
+    parser.add_argument("--top", type=int, default=None, help="Report the K largest widths and heights.")
+    parser.add_argument("--no-index", action="store_true", help="Read every image instead of using the dimension index.")
+    parser.add_argument("--trim", type=int, nargs='?', const=TRIM_PADDING, default=None, metavar="PADDING",
+                        help=f"Report the dimensions of the images once trimmed to their ink plus PADDING pixels (default {TRIM_PADDING}).")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes finding the ink of the images.")
+    args = parser.parse_args()
+
+    use_index = not args.no_index
+
+    if args.trim is not None:
+        try:
+            check_trim_padding(args.trim)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        dimensions = get_trimmed_dimensions(args.image_dir, args.trim, use_index, args.workers)
+        max_width = max((width for width, _ in dimensions.values()), default=0)
+        max_height = max((height for _, height in dimensions.values()), default=0)
+        print("The max trimmed width is: ", max_width)
+        print("The max trimmed height is: ", max_height)
+        print("The canvas size is: ", max(max_width, max_height))
+    elif args.top:
+        top_widths, top_heights = get_top_dimensions(args.image_dir, args.top, use_index)
+        for rank, (width, filenames) in enumerate(top_widths, 1):
+            print(f"Width #{rank} is {width}, images: {filenames}")
+        for rank, (height, filenames) in enumerate(top_heights, 1):
+            print(f"Height #{rank} is {height}, images: {filenames}")
+    else:
+        results = get_max_dimensions(args.image_dir, use_index)
+        print("The max width is: ", results[0])
+        print("The list of images with the max width is: ", results[2])
+        print("The max height is: ", results[1])
+        print("The list of images with the max height is: ", results[3])
+        print("The second max width is: ", results[4])
+        print("The list of images with the second max width is: ", results[6])
+        print("The second max height is: ", results[5])
+        print("The list of images with the second max height is: ", results[7])
@@ -0,0 +1,293 @@
+import argparse
+import io
+import os
+import sys
+from functools import partial
+from PIL import Image
+from common_funcs import ENCODER_PROFILES, list_image_files, save_image
+from image_size_sync import get_canvas_size, pad_image_to_canvas
+from manifest_funcs import hash_bytes, make_entry, process_incrementally
+from resize_images_to_same_height import resize_to_height
+from scale_down_images import parse_size
+from shard_funcs import parse_shard
+from staged_funcs import process_in_stages
+from trim_funcs import TRIM_PADDING, check_trim_padding, trim_image
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+This script runs a chain of image operations on every JPG and PNG image in a directory. Each
+image is decoded once, all operations are applied to it in memory, and the result is encoded
+once into the output directory. This replaces running image_size_sync.py, then
+scale_down_images.py or resize_images_to_same_height.py one after another, which decodes and
+encodes every image at each step and writes intermediate directories.
+
+Operations are applied in the order given. Supported operations:
+  grayscale: Transform the image to grayscale.
+  trim or trim:PADDING: Crop the image to the bounding box of its ink plus PADDING pixels (2 by
+    default, at least 2), as image_size_sync.py --trim does. See trim_funcs.py.
+  pad:SIZE: Place the image in the center of a square canvas filled with its background
+    color, as image_size_sync.py does. SIZE is the canvas size, or "max" to use the maximum
+    width or height among all the input images, once trimmed if a trim operation comes first.
+  resize:HEIGHT: Resize the image to the given height, as resize_images_to_same_height.py does.
+  thumbnail:WIDTHxHEIGHT: Scale down the image to fit the given size while maintaining its
+    aspect ratio, as scale_down_images.py does.
+
+By default, images are spread over worker processes. With --staged, images are processed in one
+process by a staged pipeline instead: reader threads read and decode images ahead of the
+transform stage, and writer threads encode and save them, so reads, transforms and writes
+overlap. See staged_funcs.py.
+
+Usage: python image_pipeline.py [input_dir] [output_dir] [operation ...] [--workers N] [--incremental]
+       [--encoder-profile PROFILE] [--staged] [--readers N] [--writers N] [--queue-size N]
+       [--shard INDEX/COUNT]
+Parameters:
+  input_dir: The directory where the original images are located.
+  output_dir: The directory where the output images will be saved, with the input filenames.
+  operation: The operations to apply, in order.
+  --workers: Optional. The number of worker processes. Defaults to the number of CPU cores.
+  --incremental: Optional. Skip inputs whose content and parameters match the manifest in the output directory.
+  --encoder-profile: Optional. The encoder settings of the output images: fast, balanced (default) or smallest.
+  --staged: Optional. Use the staged reader/transform/writer pipeline instead of worker processes.
+  --readers: Optional. The number of reader threads of the staged pipeline. Defaults to 4.
+  --writers: Optional. The number of writer threads of the staged pipeline. Defaults to 4.
+  --queue-size: Optional. The maximum number of images waiting between two stages. Defaults to 32.
+  --shard: Optional. Only process the files of one shard: INDEX/COUNT, such as 0/4, or slurm to read it from the
+  SLURM array task. See shard_funcs.py.
+Return: None
+
+Example: python image_pipeline.py images/ output/ grayscale pad:max thumbnail:128x128
+"""
+
+
+def grayscale(img):
+    """
+    Transforms an image to grayscale.
+    """
+    return img.convert('L')
+
+
+def thumbnail(img, width, height):
+    """
+    Scales down an image to fit the given size while maintaining its aspect ratio.
+    """
+    img.thumbnail((width, height))
+    return img
+
+
+def parse_operation(spec, input_dir):
+    """
+    Parses an operation spec into a function that takes an image and returns the transformed image.
+    The returned functions are picklable so they can be sent to worker processes.
+
+    Parameters:
+        spec (str): The operation spec, such as "pad:max" or "thumbnail:128x128".
+        input_dir (str): The directory of the input images, used to resolve "pad:max".
+
+    Returns:
+        callable: The operation.
+
+    Raises:
+        ValueError: If the spec is not a supported operation.
+    """
+    name, _, arg = spec.partition(':')
+    if name == "grayscale" and not arg:
+        return grayscale
+    if name == "trim":
+        padding = int(arg) if arg else TRIM_PADDING
+        check_trim_padding(padding)
+        return partial(trim_image, padding=padding)
+    if name == "pad" and arg:
+        canvas_size = get_canvas_size(input_dir) if arg == "max" else int(arg)
+        return partial(pad_image_to_canvas, canvas_size=canvas_size)
+    if name == "resize" and arg:
+        return partial(resize_to_height, target_height=int(arg))
+    if name == "thumbnail" and arg:
+        width, height = parse_size(arg)
+        return partial(thumbnail, width=width, height=height)
+    raise ValueError(f"Unsupported operation {spec}")
+
+
+def resolve_pad_max(operation_specs, input_dir, workers=None, save_index=True):
+    """
+    Replaces "pad:max" in operation specs with the actual canvas size. When a trim operation
+    comes before it, the canvas size is the maximum dimension of the trimmed images.
+
+    Parameters:
+        operation_specs (list): The operation specs, in order.
+        input_dir (str): The directory of the input images.
+        workers (int): The number of worker processes finding the ink of the images when trimming.
+        save_index (bool): Whether to save the updated trim index when trimming, see get_trimmed_dimensions().
+
+    Returns:
+        list: The operation specs with "pad:max" resolved.
+    """
+    resolved = []
+    trim_padding = None
+    for spec in operation_specs:
+        name, _, arg = spec.partition(':')
+        if name == "trim":
+            trim_padding = int(arg) if arg else TRIM_PADDING
+        if spec == "pad:max":
+            spec = f"pad:{get_canvas_size(input_dir, trim_padding, workers, save_index)}"
+        resolved.append(spec)
+    return resolved
+
+
+def apply_operations(img, operations):
+    """
+    Applies a chain of operations to an image in memory.
+
+    Parameters:
+        img (PIL.Image.Image): The input image.
+        operations (list): The operations returned by parse_operation(), in the order to apply.
+
+    Returns:
+        PIL.Image.Image: The transformed image.
+    """
+    for operation in operations:
+        img = operation(img)
+    return img
+
+
+def process_image(filename, input_dir, output_dir, operations, encoder_profile="balanced"):
+    """
+    Decodes one image, applies the operations and encodes the result into the output directory.
+    This is the per-file task run by the worker processes.
+
+    Parameters:
+        filename (str): The filename of the image in the input directory.
+        input_dir (str): The directory where the original images are located.
+        output_dir (str): The directory where the output images will be saved.
+        operations (list): The operations to apply, in order.
+        encoder_profile (str): The encoder settings of the output images: "fast", "balanced" or "smallest".
+
+    Returns:
+        str: The path of the output image.
+    """
+    output_path = os.path.join(output_dir, filename)
+    with Image.open(os.path.join(input_dir, filename)) as img:
+        img.load()
+        save_image(apply_operations(img, operations), output_path, encoder_profile)
+    return output_path
+
+
+def read_image(filename, input_dir):
+    """
+    Reads and decodes one image for the staged pipeline. The file is read once, for both the
+    decoding and the manifest hash.
+
+    Returns:
+        tuple: The decoded image (PIL.Image.Image) and the hash of the file (str).
+    """
+    with open(os.path.join(input_dir, filename), 'rb') as f:
+        data = f.read()
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img, hash_bytes(data)
+
+
+def transform_image(img_and_hash, operations):
+    """
+    Applies the operations to an image decoded by read_image(), keeping its hash.
+    """
+    img, input_hash = img_and_hash
+    return apply_operations(img, operations), input_hash
+
+
+def write_image(filename, img_and_hash, input_dir, output_dir, params, encoder_profile):
+    """
+    Encodes and saves an image transformed by transform_image().
+
+    Returns:
+        dict: The manifest entry of the image.
+    """
+    img, input_hash = img_and_hash
+    output_path = os.path.join(output_dir, filename)
+    save_image(img, output_path, encoder_profile)
+    return make_entry(os.path.join(input_dir, filename), output_path, params, input_hash)
+
+
+def process_images(input_dir, output_dir, operation_specs, workers=None, incremental=False, encoder_profile="balanced",
+                   staged=False, readers=4, writers=4, queue_size=32, shard=None):
+    """
+    Runs a chain of operations on all JPG and PNG images in a directory.
+
+    Parameters:
+        input_dir (str): The directory where the original images are located.
+        output_dir (str): The directory where the output images will be saved.
+        operation_specs (list): The operation specs, see parse_operation().
+        workers (int): The number of worker processes. None means one per CPU core.
+        incremental (bool): Whether to skip images that are up to date with the manifest of the output directory.
+        encoder_profile (str): The encoder settings of the output images: "fast", "balanced" or "smallest".
+        staged (bool): Whether to use the staged reader/transform/writer pipeline instead of worker processes.
+        readers (int): The number of reader threads of the staged pipeline.
+        writers (int): The number of writer threads of the staged pipeline.
+        queue_size (int): The maximum number of images waiting between two stages.
+        shard (tuple): Optional. (index, count) returned by parse_shard() to only process the files of one shard.
+            pad:max is still computed from all images, so that every shard uses the same canvas size.
+            Shards only read the trim index, so build it before or use pad:SIZE.
+
+    Returns:
+        tuple: The results and failures returned by process_incrementally().
+    """
+    # Resolve "pad:max" first so that the manifest records the actual canvas size
+    operation_specs = resolve_pad_max(operation_specs, input_dir, workers, save_index=shard is None)
+    operations = [parse_operation(spec, input_dir) for spec in operation_specs]
+
+    # Create the output directory if it doesn't exist
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    task = partial(process_image, input_dir=input_dir, output_dir=output_dir, operations=operations, encoder_profile=encoder_profile)
+    params = {"op": "image_pipeline", "operations": operation_specs, "encoder_profile": encoder_profile}
+
+    runner = None
+    if staged:
+        runner = partial(
+            process_in_stages,
+            read=partial(read_image, input_dir=input_dir),
+            transform=partial(transform_image, operations=operations),
+            write=partial(write_image, input_dir=input_dir, output_dir=output_dir, params=params, encoder_profile=encoder_profile),
+            readers=readers, writers=writers, queue_size=queue_size
+        )
+
+    return process_incrementally(task, list_image_files(input_dir), input_dir, output_dir, params, incremental, workers, runner, shard)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a chain of operations on every image in a directory, decoding and encoding each image once.")
+    parser.add_argument("input_dir", help="The directory where the original images are located.")
+    parser.add_argument("output_dir", help="The directory where the output images will be saved.")
+    parser.add_argument("operations", nargs='+', help="The operations to apply, in order: grayscale, trim[:PADDING], pad:SIZE|max, resize:HEIGHT, thumbnail:WIDTHxHEIGHT.")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes. Defaults to the number of CPU cores.")
+    parser.add_argument("--incremental", action="store_true", help="Skip inputs whose content and parameters match the manifest in the output directory.")
+    parser.add_argument("--encoder-profile", choices=ENCODER_PROFILES, default="balanced", help="The encoder settings of the output images.")
+    parser.add_argument("--staged", action="store_true", help="Use the staged reader/transform/writer pipeline instead of worker processes.")
+    parser.add_argument("--readers", type=int, default=4, help="The number of reader threads of the staged pipeline.")
+    parser.add_argument("--writers", type=int, default=4, help="The number of writer threads of the staged pipeline.")
+    parser.add_argument("--queue-size", type=int, default=32, help="The maximum number of images waiting between two stages.")
+    parser.add_argument("--shard", default=None, help="Only process the files of one shard: INDEX/COUNT, such as 0/4, or slurm for the SLURM array task.")
+    args = parser.parse_args()
+
+    # Check if the input directory exists
+    if not os.path.isdir(args.input_dir):
+        print(f"Error: Input directory {args.input_dir} not found")
+        sys.exit(1)
+
+    try:
+        shard = parse_shard(args.shard)
+        process_images(args.input_dir, args.output_dir, args.operations, workers=args.workers, incremental=args.incremental,
+                       encoder_profile=args.encoder_profile, staged=args.staged, readers=args.readers,
+                       writers=args.writers, queue_size=args.queue_size, shard=shard)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
@@ -1,7 +1,16 @@
 from PIL import Image
+import argparse
 import os
 import sys
-from common_funcs import get_max_dimensions
+import time
+from functools import partial
+from batch_canvas import export_image_batch
+from common_funcs import ENCODER_PROFILES, get_max_dimensions, list_image_files, save_image
+from manifest_funcs import process_incrementally
+from packed_dataset import create_packed_dataset, flush_packed_images, write_packed_image, write_packed_index
+from parallel_funcs import get_worker_count, process_in_parallel, report_throughput
+from shard_funcs import parse_shard
+from trim_funcs import TRIM_PADDING, check_trim_padding, get_trimmed_canvas_size, trim_image
 
 """
 This script synchronizes the size of all PNG and JPG files in the input directory.
@@ -15,11 +24,30 @@ the canvas is the background color observed at the previous step;
 input image. This ensures that each output image has the same maximum dimension and is
 centered in the canvas.
 Finally, all output images are saved in the specified output directory.
+With --trim, every image is first cropped to the bounding box of its ink, so the canvas size is
+the maximum dimension of the trimmed images instead of the raw ones.
+Images are processed in parallel, using one worker process per CPU core by default.
+Optionally, all synced images are also packed into one uint8 memory-mapped NumPy array file
+that training jobs can load without opening and decoding every PNG. See packed_dataset.py.
 
-Usage: python image_size_sync.py [input_dir] [output_dir]
+Usage: python image_size_sync.py [input_dir] [output_dir] [--workers N] [--incremental] [--encoder-profile PROFILE] [--export PATH] [--batch-size N]
+       [--trim [PADDING]] [--canvas-size N] [--shard INDEX/COUNT]
 Parameters:
   input_dir: The directory where the original images are located.
   output_dir: The directory where the output images will be saved.
+  --workers: Optional. The number of worker processes. Defaults to the number of CPU cores.
+  --incremental: Optional. Skip inputs whose content and parameters match the manifest in the output directory.
+  --encoder-profile: Optional. The encoder settings of the output images: fast, balanced (default) or smallest.
+  --export: Optional. The path of a .npy file to pack all synced images into. An index sidecar with the
+  filenames and IDs is written next to it, with the .json extension.
+  --batch-size: Optional. Pack the images in batches of N using the batched canvas padding in
+  batch_canvas.py instead of one image at a time.
+  --trim: Optional. Crop every image to the bounding box of its ink plus PADDING pixels (2 by default, at least 2)
+  before syncing, and compute the canvas size from the trimmed images. See trim_funcs.py.
+  --canvas-size: Optional. The size of the square canvas, such as the one reported by get_max_dimensions.py.
+  Defaults to the maximum dimension of all images.
+  --shard: Optional. Only process the files of one shard: INDEX/COUNT, such as 0/4, or slurm to read it from the
+  SLURM array task. See shard_funcs.py.
 Return: None
 
 Example: python image_size_sync.py images/ output/
@@ -27,24 +55,19 @@ Example: python image_size_sync.py images/ output/
 """
 
 
-def fit_image_to_canvas(img_path, canvas_size, output_img_path):
+def pad_image_to_canvas(img, canvas_size):
     """
-    Fits a PNG or JPG file into a larger square canvas with transparent background.
-    The center of the image is placed in the center of the canvas.
-    The output image is saved in the given path.
+    Places an image in the center of a square grayscale canvas filled with the background color
+    of the image. The background color is the grayscale color of the image at the pixel (1, 1).
 
     Parameters:
-        img_path (str): The path to the input image file.
+        img (PIL.Image.Image): The input image.
         canvas_size (int): The desired size of the square canvas.
-        output_img_path (str): The path to the output image file to be saved.
 
     Returns:
-        None.
+        PIL.Image.Image: The canvas with the image pasted in its center.
     """
 
-    # Open the input image
-    img = Image.open(img_path)
-
     # Get the width and height of the input image
     width, height = img.size
 
@@ -68,45 +91,240 @@ def fit_image_to_canvas(img_path, canvas_size, output_img_path):
     # Paste the input image onto the canvas
     canvas.paste(img, (x, y))
 
-    canvas.save(output_img_path)
+    return canvas
+
+
+def fit_image_to_canvas(img_path, canvas_size, output_img_path, encoder_profile="balanced", trim_padding=None):
+    """
+    Fits a PNG or JPG file into a larger square canvas with transparent background.
+    The center of the image is placed in the center of the canvas.
+    The output image is saved in the given path.
+
+    Parameters:
+        img_path (str): The path to the input image file.
+        canvas_size (int): The desired size of the square canvas.
+        output_img_path (str): The path to the output image file to be saved.
+        encoder_profile (str): The encoder settings of the output images: "fast", "balanced" or "smallest".
+        trim_padding (int): Optional. Crop the image to its ink plus this padding first, see trim_funcs.py.
+
+    Returns:
+        None.
+    """
 
+    # Open the input image
+    with Image.open(img_path) as img:
+        if trim_padding is not None:
+            img = trim_image(img, trim_padding)
+        canvas = pad_image_to_canvas(img, canvas_size)
 
-# Check if the correct number of arguments were provided
-if len(sys.argv) != 3:
-    print(f"Usage: python {sys.argv[0]} image_directory output_directory")
-    print(f"Example: python {sys.argv[0]} images/ output/")
-    sys.exit(1)
+    save_image(canvas, output_img_path, encoder_profile)
 
-# Parse the input arguments
-image_dir = sys.argv[1]
-output_dir = sys.argv[2]
 
-# Check if the input directory exists
-if not os.path.isdir(image_dir):
-    print(f"Error: Input directory {image_dir} not found")
-    sys.exit(1)
+def get_canvas_size(image_dir, trim_padding=None, workers=None, save_index=True):
+    """
+    Returns the size of the square canvas that fits every image in a directory, which is the
+    maximum width or height among all the images.
 
-# Create the output directory if it doesn't exist
-if not os.path.isdir(output_dir):
-    os.makedirs(output_dir)
+    Parameters:
+        image_dir (str): The directory where the images are located.
+        trim_padding (int): Optional. Use the dimensions of the images once trimmed with this
+            padding, see trim_funcs.py.
+        workers (int): The number of worker processes finding the ink of the images when trimming.
+        save_index (bool): Whether to save the updated trim index when trimming, see get_trimmed_dimensions().
 
-dimensions = get_max_dimensions(image_dir)
+    Returns:
+        int: The canvas size.
+    """
+    if trim_padding is not None:
+        return get_trimmed_canvas_size(image_dir, trim_padding, workers, save_index)
 
-size_to_fit = dimensions[0] if dimensions[0] > dimensions[1] else dimensions[1]
-print("The size to synchronize for every image: ", size_to_fit)
+    dimensions = get_max_dimensions(image_dir)
+    return dimensions[0] if dimensions[0] > dimensions[1] else dimensions[1]
 
-# Iterate over all files in the input directory
-for filename in os.listdir(image_dir):
-    # Check if the file is an image
-    if not filename.endswith('.jpg') and not filename.endswith('.jpeg') and not filename.endswith('.png'):
-        continue
 
-    # Get the original file name and extension
+def get_output_filename(filename, size_to_fit):
+    """
+    Returns the filename of a synchronized image, which carries the canvas size.
+
+    Parameters:
+        filename (str): The filename of the input image.
+        size_to_fit (int): The size of the square canvas.
+
+    Returns:
+        str: The output filename, such as "12345-256x256.png".
+    """
     file_name, file_ext = os.path.splitext(os.path.basename(filename))
-    input_file = os.path.join(image_dir, filename)
+    return f"{file_name}-{size_to_fit}x{size_to_fit}{file_ext}"
+
+
+def sync_image(filename, image_dir, output_dir, size_to_fit, encoder_profile="balanced", trim_padding=None):
+    """
+    Fits one image of the input directory into the canvas and saves it into the output directory.
+    This is the per-file task run by the worker processes.
+
+    Parameters:
+        filename (str): The filename of the image in the input directory.
+        image_dir (str): The directory where the original images are located.
+        output_dir (str): The directory where the output images will be saved.
+        size_to_fit (int): The size of the square canvas.
+        encoder_profile (str): The encoder settings of the output images: "fast", "balanced" or "smallest".
+        trim_padding (int): Optional. Crop the image to its ink plus this padding first, see trim_funcs.py.
+
+    Returns:
+        str: The path of the output image.
+    """
+    output_path = os.path.join(output_dir, get_output_filename(filename, size_to_fit))
+    fit_image_to_canvas(os.path.join(image_dir, filename), size_to_fit, output_path, encoder_profile, trim_padding)
+    return output_path
+
+
+def export_image(position_and_filename, image_dir, array_path, size_to_fit, trim_padding=None):
+    """
+    Fits one image of the input directory into the canvas and writes it into the packed array.
+    This is the per-file task run by the worker processes.
+
+    Parameters:
+        position_and_filename (tuple): The position in the array and the filename of the image.
+        image_dir (str): The directory where the original images are located.
+        array_path (str): The path to the packed .npy file.
+        size_to_fit (int): The size of the square canvas.
+        trim_padding (int): Optional. Crop the image to its ink plus this padding first, see trim_funcs.py.
+
+    Returns:
+        int: The position of the image in the array.
+    """
+    position, filename = position_and_filename
+    with Image.open(os.path.join(image_dir, filename)) as img:
+        if trim_padding is not None:
+            img = trim_image(img, trim_padding)
+        write_packed_image(array_path, position, pad_image_to_canvas(img, size_to_fit))
+    return position
+
+
+def export_packed_dataset(image_dir, array_path, size_to_fit=None, workers=None, batch_size=None, trim_padding=None):
+    """
+    Fits all images in a directory into the square canvas and packs them into one uint8
+    memory-mapped array file of shape (N, size_to_fit, size_to_fit), with an index sidecar.
+    Images that fail to process are left as zero rows and listed in the index.
+
+    Parameters:
+        image_dir (str): The directory where the original images are located.
+        array_path (str): The path to the .npy file to write.
+        size_to_fit (int): The size of the square canvas. Defaults to the maximum dimension of all images.
+        workers (int): The number of worker processes. None means one per CPU core.
+        batch_size (int): Optional. The number of images each worker pads and writes at a time
+            with the batched path in batch_canvas.py. By default images are processed one at a time.
+        trim_padding (int): Optional. Crop every image to its ink plus this padding first, see trim_funcs.py.
+
+    Returns:
+        tuple: A tuple containing:
+        * the number of packed images (int)
+        * a list of (filename, error message) for the images that failed (list)
+    """
+    if size_to_fit is None:
+        size_to_fit = get_canvas_size(image_dir, trim_padding, workers)
+
+    filenames = list_image_files(image_dir)
+    create_packed_dataset(array_path, filenames, size_to_fit)
+
+    if batch_size:
+        task = partial(export_image_batch, image_dir=image_dir, array_path=array_path, size_to_fit=size_to_fit, trim_padding=trim_padding)
+        batches = [(start, filenames[start:start + batch_size]) for start in range(0, len(filenames), batch_size)]
+        start_time = time.perf_counter()
+        results, batch_failures = process_in_parallel(task, batches, workers=workers, chunksize=1, verbose=False, report=False)
+        failures = [failure for _, batch_result in results for failure in batch_result]
+        for filename, error in failures:
+            print(f"Error: failed to process {filename}: {error}")
+        for (_, batch_filenames), error in batch_failures:
+            failures.extend((filename, error) for filename in batch_filenames)
+        elapsed = time.perf_counter() - start_time
+        report_throughput(len(filenames) - len(failures), len(failures), elapsed, get_worker_count(workers))
+    else:
+        task = partial(export_image, image_dir=image_dir, array_path=array_path, size_to_fit=size_to_fit, trim_padding=trim_padding)
+        _, position_failures = process_in_parallel(task, list(enumerate(filenames)), workers=workers, verbose=False)
+        failures = [(filename, error) for (_, filename), error in position_failures]
+    flush_packed_images()
+
+    packed = len(filenames) - len(failures)
+    write_packed_index(array_path, filenames, size_to_fit, failed=[filename for filename, _ in failures])
+    print(f"Packed {packed} images of {size_to_fit}x{size_to_fit} into {array_path}")
+    return packed, failures
+
+
+def sync_image_sizes(image_dir, output_dir, workers=None, incremental=False, export_path=None, batch_size=None, encoder_profile="balanced",
+                     shard=None, trim_padding=None, size_to_fit=None):
+    """
+    Synchronizes the size of all images in a directory by fitting each image into a square canvas
+    with the maximum dimension of all images.
+
+    Parameters:
+        image_dir (str): The directory where the original images are located.
+        output_dir (str): The directory where the output images will be saved.
+        workers (int): The number of worker processes. None means one per CPU core.
+        incremental (bool): Whether to skip images that are up to date with the manifest of the output directory.
+        export_path (str): Optional. The path of a .npy file to pack all synced images into.
+        batch_size (int): Optional. The batch size of the batched packing, see export_packed_dataset().
+        encoder_profile (str): The encoder settings of the output images: "fast", "balanced" or "smallest".
+        shard (tuple): Optional. (index, count) returned by parse_shard() to only process the files of one shard.
+            The canvas size is still computed from all images, so that every shard uses the same size.
+            Shards only read the trim index, so build it before or pass size_to_fit. Can't be combined
+            with export_path.
+        trim_padding (int): Optional. Crop every image to its ink plus this padding before fitting it into
+            the canvas, and compute the canvas size from the trimmed images. See trim_funcs.py.
+        size_to_fit (int): Optional. The size of the square canvas. Defaults to the maximum dimension of all
+            images, once trimmed if trim_padding is given.
+
+    Returns:
+        tuple: The results and failures returned by process_incrementally().
+    """
+    if shard is not None and export_path:
+        raise ValueError("The packed dataset is written by one process and can't be exported from a shard")
+    if trim_padding is not None:
+        check_trim_padding(trim_padding)
+
+    # Create the output directory if it doesn't exist
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    if size_to_fit is None:
+        size_to_fit = get_canvas_size(image_dir, trim_padding, workers, save_index=shard is None)
+    print("The size to synchronize for every image: ", size_to_fit)
+
+    task = partial(sync_image, image_dir=image_dir, output_dir=output_dir, size_to_fit=size_to_fit, encoder_profile=encoder_profile,
+                   trim_padding=trim_padding)
+    params = {"op": "image_size_sync", "canvas_size": size_to_fit, "encoder_profile": encoder_profile, "trim_padding": trim_padding}
+    results = process_incrementally(task, list_image_files(image_dir), image_dir, output_dir, params, incremental, workers, shard=shard)
+
+    if export_path:
+        export_packed_dataset(image_dir, export_path, size_to_fit, workers, batch_size, trim_padding)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synchronize the size of all PNG and JPG files in a directory.")
+    parser.add_argument("image_dir", help="The directory where the original images are located.")
+    parser.add_argument("output_dir", help="The directory where the output images will be saved.")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes. Defaults to the number of CPU cores.")
+    parser.add_argument("--incremental", action="store_true", help="Skip inputs whose content and parameters match the manifest in the output directory.")
+    parser.add_argument("--encoder-profile", choices=ENCODER_PROFILES, default="balanced", help="The encoder settings of the output images.")
+    parser.add_argument("--export", default=None, help="The path of a .npy file to pack all synced images into.")
+    parser.add_argument("--batch-size", type=int, default=None, help="Pack the images in batches of N with the batched canvas padding.")
+    parser.add_argument("--trim", type=int, nargs='?', const=TRIM_PADDING, default=None, metavar="PADDING",
+                        help=f"Crop every image to its ink plus PADDING pixels (default {TRIM_PADDING}) before syncing.")
+    parser.add_argument("--canvas-size", type=int, default=None, help="The size of the square canvas. Defaults to the maximum dimension of all images.")
+    parser.add_argument("--shard", default=None, help="Only process the files of one shard: INDEX/COUNT, such as 0/4, or slurm for the SLURM array task.")
+    args = parser.parse_args()
 
-    # Save the output image with the appropriate file name and extension
-    output_filename = f"{file_name}-{size_to_fit}x{size_to_fit}{file_ext}"
+    # Check if the input directory exists
+    if not os.path.isdir(args.image_dir):
+        print(f"Error: Input directory {args.image_dir} not found")
+        sys.exit(1)
 
-    fit_image_to_canvas(input_file, size_to_fit, os.path.join(output_dir, output_filename))
-    print("Processed ", input_file)
+    try:
+        shard = parse_shard(args.shard)
+        sync_image_sizes(args.image_dir, args.output_dir, workers=args.workers, incremental=args.incremental, export_path=args.export,
+                         batch_size=args.batch_size, encoder_profile=args.encoder_profile, shard=shard, trim_padding=args.trim, size_to_fit=args.canvas_size)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
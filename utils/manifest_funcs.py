@@ -0,0 +1,278 @@
+import glob
+import hashlib
+import json
+import os
+from functools import partial
+from parallel_funcs import process_in_parallel
+from shard_funcs import get_shard_suffix, select_shard
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+Content manifest for the scripts in this directory that write output images.
+
+Every run writes a manifest file (.manifest.json) to the output directory. It records, for each
+input file, the hash of its content, the parameters of the operation applied to it and the
+output file it produced. In incremental mode, inputs whose hash and parameters match the
+manifest and whose output still exists are skipped, so a re-run only processes new or modified
+symbols.
+
+The hash of an input is only recomputed when its size or modification time differ from the
+manifest, so checking an unchanged directory costs one stat per file. Inputs are only hashed in
+incremental mode, when the manifest is used to skip them: a full run records their size and
+modification time without reading them again, and their outputs are only skipped by a later
+incremental run while those are unchanged. Entries of inputs that no longer exist are dropped
+from the manifest.
+
+A sharded run (see shard_funcs.py) writes its own manifest (.manifest.shard-INDEX-of-COUNT.json)
+so that shards writing to the same output directory don't overwrite each other's entries.
+merge_shard_manifests() combines them into the manifest of the directory.
+"""
+
+# The name of the manifest file written to the output directory
+MANIFEST_FILENAME = ".manifest.json"
+MANIFEST_VERSION = 1
+
+
+def get_manifest_path(output_dir, shard=None):
+    """
+    Returns the path of the manifest of an output directory, or of the manifest of one shard.
+    """
+    name, extension = os.path.splitext(MANIFEST_FILENAME)
+    return os.path.join(output_dir, f"{name}{get_shard_suffix(shard)}{extension}")
+
+
+def hash_file(file_path):
+    """
+    Returns the SHA-256 hex digest of the content of a file.
+
+    Parameters:
+        file_path (str): The path to the file.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_bytes(data):
+    """
+    Returns the SHA-256 hex digest of the content of a file that was already read, which is the
+    same digest as hash_file() returns for the file.
+
+    Parameters:
+        data (bytes): The content of the file.
+
+    Returns:
+        str: The hex digest.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def load_manifest(output_dir, shard=None):
+    """
+    Loads the manifest of an output directory.
+
+    Parameters:
+        output_dir (str): The output directory.
+        shard (tuple): Optional. (index, count) to load the manifest of one shard instead.
+
+    Returns:
+        dict: Maps input filenames to their manifest entries. An empty dict is returned if the
+        manifest doesn't exist, can't be read or has another version.
+    """
+    try:
+        with open(get_manifest_path(output_dir, shard), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("entries", {})
+
+
+def save_manifest(output_dir, entries, shard=None):
+    """
+    Saves the manifest of an output directory. The manifest is written to a temporary file first
+    and then moved into place so that an interrupted run never leaves a truncated manifest behind.
+
+    Parameters:
+        output_dir (str): The output directory.
+        entries (dict): Maps input filenames to their manifest entries.
+        shard (tuple): Optional. (index, count) to save the manifest of one shard instead.
+
+    Returns:
+        None.
+    """
+    manifest_path = get_manifest_path(output_dir, shard)
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, 'w') as manifest_file:
+        json.dump({"version": MANIFEST_VERSION, "entries": entries}, manifest_file, indent=1, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def make_entry(input_path, output_path, params, input_hash=None, output_dir=None):
+    """
+    Returns the manifest entry of an input file.
+
+    Parameters:
+        input_path (str): The path to the input file.
+        output_path (str): The path to the output file produced from the input.
+        params (dict): The parameters of the operation applied to the input.
+        input_hash (str): The hash of the input, or None if it was not computed. Without it, the
+            output is only up to date while the size and modification time of the input are unchanged.
+        output_dir (str): The output directory. When given, the output is recorded by its path
+            relative to it, so outputs in subdirectories can be checked. Otherwise by its filename.
+
+    Returns:
+        dict: The manifest entry.
+    """
+    stat = os.stat(input_path)
+    return {
+        "input_hash": input_hash,
+        "input_size": stat.st_size,
+        "input_mtime_ns": stat.st_mtime_ns,
+        "params": params,
+        "output": os.path.relpath(output_path, output_dir) if output_dir else os.path.basename(output_path)
+    }
+
+
+def is_up_to_date(entry, input_path, output_dir, params):
+    """
+    Returns whether the output of an input file is up to date with its manifest entry. The entry's
+    size and modification time are refreshed when the input was touched without changing its content.
+
+    Parameters:
+        entry (dict): The manifest entry of the input, or None.
+        input_path (str): The path to the input file.
+        output_dir (str): The output directory.
+        params (dict): The parameters of the operation to apply.
+
+    Returns:
+        bool: True if the input can be skipped.
+    """
+    if not entry or entry.get("params") != params:
+        return False
+    if not os.path.exists(os.path.join(output_dir, entry["output"])):
+        return False
+
+    stat = os.stat(input_path)
+    if stat.st_size == entry["input_size"] and stat.st_mtime_ns == entry["input_mtime_ns"]:
+        return True
+    if stat.st_size == entry["input_size"] and entry.get("input_hash") and hash_file(input_path) == entry["input_hash"]:
+        entry["input_mtime_ns"] = stat.st_mtime_ns
+        return True
+    return False
+
+
+def _process_and_record(filename, func, input_dir, output_dir, params, hash_input):
+    # Runs in a worker process, so the input is hashed in parallel with the other files
+    output_path = func(filename)
+    input_path = os.path.join(input_dir, filename)
+    return make_entry(input_path, output_path, params, hash_file(input_path) if hash_input else None, output_dir)
+
+
+def merge_shard_manifests(output_dir):
+    """
+    Merges the manifests written by the shards of a sharded run into the manifest of the output
+    directory, then removes them. Entries of the shard manifests replace the entries of the
+    directory manifest for the same input.
+
+    Parameters:
+        output_dir (str): The output directory.
+
+    Returns:
+        int: The number of merged shard manifests.
+    """
+    name, extension = os.path.splitext(MANIFEST_FILENAME)
+    shard_paths = sorted(glob.glob(os.path.join(glob.escape(output_dir), f"{name}.shard-*-of-*{extension}")))
+
+    entries = load_manifest(output_dir)
+    for shard_path in shard_paths:
+        with open(shard_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"{shard_path} has version {manifest.get('version')}, expected {MANIFEST_VERSION}")
+        entries.update(manifest["entries"])
+    save_manifest(output_dir, entries)
+
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+    return len(shard_paths)
+
+
+def process_incrementally(func, filenames, input_dir, output_dir, params, incremental=False, workers=None, runner=None, shard=None,
+                          initializer=None, initargs=()):
+    """
+    Processes files with process_in_parallel(), or with a custom runner, and records them in the
+    manifest of the output directory. In incremental mode, files that are up to date with the
+    manifest are skipped.
+
+    In a sharded run, only the files of the shard are processed and they are recorded in the
+    manifest of the shard. The manifest of the directory, such as the one merged after a previous
+    sharded run, is still used to skip files in incremental mode.
+
+    Parameters:
+        func (callable): A picklable function that takes a filename in the input directory, writes
+            the output file, or files, and returns the path of the one to record in the manifest.
+        filenames (list): The filenames to process.
+        input_dir (str): The directory where the input files are located.
+        output_dir (str): The directory where the output files are saved and the manifest is written.
+        params (dict): The parameters of the operation. Changing them invalidates the manifest entries.
+        incremental (bool): Whether to skip files that are up to date with the manifest.
+        workers (int): The number of worker processes. None means one per CPU core.
+        runner (callable): Optional. Takes the filenames to process and returns the results and
+            failures like process_in_parallel() does, with make_entry() as the result of every
+            file, such as with the hash of the bytes it read. When given, func and workers are not used.
+        shard (tuple): Optional. (index, count) returned by shard_funcs.parse_shard() to only
+            process the files of one shard.
+        initializer (callable): Optional. Called with initargs in every worker process, see process_in_parallel().
+        initargs (tuple): The arguments of initializer.
+
+    Returns:
+        tuple: The results and failures of the run. Skipped files are not included.
+    """
+    entries = load_manifest(output_dir)
+    if shard is not None:
+        filenames = select_shard(filenames, shard)
+        entries.update(load_manifest(output_dir, shard))
+        print(f"Shard {shard[0]}/{shard[1]}: {len(filenames)} files")
+
+    if incremental:
+        to_process = [
+            filename for filename in filenames
+            if not is_up_to_date(entries.get(filename), os.path.join(input_dir, filename), output_dir, params)
+        ]
+        print(f"Skipped {len(filenames) - len(to_process)} unchanged files")
+    else:
+        to_process = list(filenames)
+
+    if runner is None:
+        task = partial(_process_and_record, func=func, input_dir=input_dir, output_dir=output_dir, params=params, hash_input=incremental)
+        results, failures = process_in_parallel(task, to_process, workers=workers, initializer=initializer, initargs=initargs)
+    else:
+        results, failures = runner(to_process)
+
+    for filename, entry in results:
+        entries[filename] = entry
+    if shard is None:
+        # Drop the entries of the inputs that no longer exist
+        filename_set = set(filenames)
+        save_manifest(output_dir, {filename: entry for filename, entry in entries.items() if filename in filename_set})
+    else:
+        save_manifest(output_dir, {filename: entries[filename] for filename in filenames if filename in entries}, shard)
+
+    return [(filename, os.path.join(output_dir, entry["output"])) for filename, entry in results], failures
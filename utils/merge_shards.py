@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import sys
+from dedup_images import save_dedup_result
+from dimension_stats import merge_dimension_stats, print_report, stats_from_json, stats_to_json
+from manifest_funcs import merge_shard_manifests
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+This script combines the outputs of a sharded run (see shard_funcs.py) once all shards are done.
+
+Commands:
+* manifests: Merges the per-shard manifests (.manifest.shard-INDEX-of-COUNT.json) written to an
+output directory into its manifest (.manifest.json), so that a later run, sharded or not, can
+skip the processed files in incremental mode. The shard manifests are removed.
+* stats: Merges the dimension statistics saved by the shards of dimension_stats.py with --json
+into one JSON file, and prints the report of the merged statistics.
+* dedup: Merges the hashes saved by the shards of dedup_images.py and finds the duplicates among all
+images, as an unsharded run of dedup_images.py does.
+
+Usage: python merge_shards.py manifests [output_dir ...]
+       python merge_shards.py stats [merged_json] [shard_json ...] [--bin-width N]
+       python merge_shards.py dedup [merged_json] [shard_json ...]
+Parameters:
+  output_dir: The output directories of the sharded run.
+  merged_json: The path of the merged statistics or dedup result.
+  shard_json: The paths of the statistics or hashes of the shards.
+  --bin-width: Optional. The bin width in pixels of the width and height histograms of the report. Defaults to 32.
+Return: None
+
+Example: python merge_shards.py manifests ~/Downloads/bliss_single_chars_synced
+         python merge_shards.py stats stats.json stats.shard-*.json
+         python merge_shards.py dedup dedup.json ~/Downloads/bliss_single_chars/dedup.shard-*.json
+"""
+
+
+def merge_manifests(output_dirs):
+    """
+    Merges the per-shard manifests of every output directory.
+
+    Parameters:
+        output_dirs (list): The output directories.
+
+    Returns:
+        None.
+    """
+    for output_dir in output_dirs:
+        count = merge_shard_manifests(output_dir)
+        print(f"Merged {count} shard manifests in {output_dir}")
+
+
+def merge_stats(merged_path, shard_paths):
+    """
+    Merges the dimension statistics of the shards and saves them.
+
+    Parameters:
+        merged_path (str): The path of the merged statistics.
+        shard_paths (list): The paths of the statistics of the shards.
+
+    Returns:
+        dict: The merged statistics.
+    """
+    merged = None
+    for shard_path in shard_paths:
+        with open(shard_path, 'r') as shard_file:
+            stats = stats_from_json(json.load(shard_file))
+        if merged is None:
+            merged = stats
+        elif stats["settings"] != merged["settings"]:
+            raise ValueError(f"{shard_path} was computed with other settings: {stats['settings']}, expected {merged['settings']}")
+        else:
+            merge_dimension_stats(merged, stats)
+
+    with open(merged_path, 'w') as merged_file:
+        json.dump(stats_to_json(merged), merged_file)
+    print(f"Merged the statistics of {len(shard_paths)} shards into {merged_path}\n")
+    return merged
+
+
+def merge_dedup(merged_path, shard_paths):
+    """
+    Merges the hashes of the shards of dedup_images.py, finds the duplicates among all images and saves the result.
+
+    Parameters:
+        merged_path (str): The path of the dedup result.
+        shard_paths (list): The paths of the hashes of the shards.
+
+    Returns:
+        tuple: The canonical filenames and the duplicate map returned by find_duplicates().
+    """
+    threshold = None
+    hashes = {}
+    failures = []
+    for shard_path in shard_paths:
+        with open(shard_path, 'r') as shard_file:
+            shard_hashes = json.load(shard_file)
+        if threshold is None:
+            threshold = shard_hashes["threshold"]
+        elif shard_hashes["threshold"] != threshold:
+            raise ValueError(f"{shard_path} was computed with the threshold {shard_hashes['threshold']}, expected {threshold}")
+        hashes.update((filename, int(hash_value, 16)) for filename, hash_value in shard_hashes["hashes"].items())
+        failures.extend((failure["filename"], failure["error"]) for failure in shard_hashes["failed"])
+
+    # The earlier images in filename order become the canonical ones, as in an unsharded run
+    print(f"Merged the hashes of {len(shard_paths)} shards")
+    return save_dedup_result(merged_path, threshold, sorted(hashes.items()), sorted(failures))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Combine the outputs of a sharded run.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    manifests_parser = subparsers.add_parser("manifests", help="Merge the per-shard manifests of output directories.")
+    manifests_parser.add_argument("output_dirs", nargs='+', help="The output directories of the sharded run.")
+
+    stats_parser = subparsers.add_parser("stats", help="Merge the dimension statistics of the shards.")
+    stats_parser.add_argument("merged_json", help="The path of the merged statistics.")
+    stats_parser.add_argument("shard_jsons", nargs='+', help="The paths of the statistics of the shards.")
+    stats_parser.add_argument("--bin-width", type=int, default=32, help="The bin width in pixels of the width and height histograms of the report.")
+
+    dedup_parser = subparsers.add_parser("dedup", help="Merge the hashes of the shards of dedup_images.py and find the duplicates.")
+    dedup_parser.add_argument("merged_json", help="The path of the dedup result.")
+    dedup_parser.add_argument("shard_jsons", nargs='+', help="The paths of the hashes of the shards.")
+    args = parser.parse_args()
+
+    if args.command == "manifests":
+        for output_dir in args.output_dirs:
+            if not os.path.isdir(output_dir):
+                print(f"Error: Output directory {output_dir} not found")
+                sys.exit(1)
+        merge_manifests(args.output_dirs)
+    elif args.command == "dedup":
+        try:
+            merge_dedup(args.merged_json, args.shard_jsons)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+    else:
+        try:
+            stats = merge_stats(args.merged_json, args.shard_jsons)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print_report(stats, args.bin_width)
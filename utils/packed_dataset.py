@@ -0,0 +1,175 @@
+import json
+import os
+import numpy as np
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+Packed dataset of prepared Bliss images.
+
+All images are stored in one uint8 NumPy array file (.npy) of shape (N, size, size), along with
+an index sidecar (.json) that lists the filename and BCI ID of every image in the array order.
+The array is opened as a memory map, so reading an image is a page-cache lookup instead of a
+file open and a PNG decode, and images and batches are zero-copy views into the file.
+
+Example:
+    images, filenames = load_packed_dataset("bliss.npy")
+    first_image = images[0]
+    for batch in iter_batches(images, 64):
+        ...
+"""
+
+PACKED_INDEX_VERSION = 1
+
+# Memory maps opened by open_packed_array(), cached per process
+_open_arrays = {}
+
+
+def get_index_path(array_path):
+    """
+    Returns the path of the index sidecar of a packed array file, such as "bliss.json" for "bliss.npy".
+    """
+    return f"{os.path.splitext(array_path)[0]}.json"
+
+
+def create_packed_dataset(array_path, filenames, size):
+    """
+    Creates a zero-filled packed array file for the given images and writes its index sidecar.
+
+    Parameters:
+        array_path (str): The path to the .npy file to create.
+        filenames (list): The filenames of the images, in the order of the array.
+        size (int): The width and height of every image.
+
+    Returns:
+        None.
+    """
+    images = np.lib.format.open_memmap(array_path, mode='w+', dtype=np.uint8, shape=(len(filenames), size, size))
+    del images
+    write_packed_index(array_path, filenames, size)
+
+
+def write_packed_index(array_path, filenames, size, failed=None):
+    """
+    Writes the index sidecar of a packed array file.
+
+    Parameters:
+        array_path (str): The path to the .npy file.
+        filenames (list): The filenames of the images, in the order of the array.
+        size (int): The width and height of every image.
+        failed (list): The filenames of the images that couldn't be written. Their rows are zero.
+
+    Returns:
+        None.
+    """
+    index = {
+        "version": PACKED_INDEX_VERSION,
+        "size": size,
+        "filenames": list(filenames),
+        "ids": [os.path.splitext(filename)[0] for filename in filenames],
+        "failed": list(failed or [])
+    }
+    with open(get_index_path(array_path), 'w') as index_file:
+        json.dump(index, index_file)
+
+
+def open_packed_array(array_path):
+    """
+    Returns a writable memory map of a packed array file created by create_packed_dataset().
+    The memory map is cached, so a worker process maps the file only once.
+
+    Parameters:
+        array_path (str): The path to the .npy file.
+
+    Returns:
+        numpy.memmap: The writable array of shape (N, size, size).
+    """
+    images = _open_arrays.get(array_path)
+    if images is None:
+        images = np.load(array_path, mmap_mode='r+')
+        _open_arrays[array_path] = images
+    return images
+
+
+def write_packed_image(array_path, position, image):
+    """
+    Writes one image into a packed array file created by create_packed_dataset(). It can be
+    called from worker processes, each writing a different position.
+
+    Parameters:
+        array_path (str): The path to the .npy file.
+        position (int): The position of the image in the array.
+        image (PIL.Image.Image): A grayscale image of the size of the packed images.
+
+    Returns:
+        None.
+    """
+    open_packed_array(array_path)[position] = np.asarray(image, dtype=np.uint8)
+
+
+def flush_packed_images():
+    """
+    Flushes and closes the memory maps opened by open_packed_array() in this process.
+    """
+    for images in _open_arrays.values():
+        images.flush()
+    _open_arrays.clear()
+
+
+def load_packed_dataset(array_path):
+    """
+    Opens a packed dataset for reading.
+
+    Parameters:
+        array_path (str): The path to the .npy file.
+
+    Returns:
+        tuple: A tuple containing:
+        * the read-only memory-mapped array of shape (N, size, size) (numpy.memmap)
+        * the filenames of the images, in the order of the array (list)
+    """
+    images = np.load(array_path, mmap_mode='r')
+    with open(get_index_path(array_path), 'r') as index_file:
+        index = json.load(index_file)
+    return images, index["filenames"]
+
+
+def get_position_by_id(filenames):
+    """
+    Returns a dict that maps both the filename and the BCI ID of every image to its position in
+    the array, so an image can be looked up with images[positions["12345"]].
+
+    Parameters:
+        filenames (list): The filenames returned by load_packed_dataset().
+
+    Returns:
+        dict: Maps filenames and IDs to array positions.
+    """
+    positions = {}
+    for position, filename in enumerate(filenames):
+        positions[filename] = position
+        positions[os.path.splitext(filename)[0]] = position
+    return positions
+
+
+def iter_batches(images, batch_size):
+    """
+    Yields consecutive batches of a packed array. Each batch is a view, no pixel data is copied.
+
+    Parameters:
+        images (numpy.ndarray): The array returned by load_packed_dataset().
+        batch_size (int): The number of images per batch. The last batch may be smaller.
+
+    Returns:
+        generator: Arrays of shape (batch_size, size, size).
+    """
+    for start in range(0, len(images), batch_size):
+        yield images[start:start + batch_size]
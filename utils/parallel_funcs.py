@@ -0,0 +1,174 @@
+import os
+import time
+from multiprocessing import Pool
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+Shared parallel execution layer for the image processing scripts in this directory.
+
+A script plugs in by defining a module level function that processes one file, then passing
+that function (usually wrapped with functools.partial to bind the directories and sizes) along
+with the list of files to process_in_parallel(). Files are dispatched to a pool of worker
+processes in chunks. Results are reported in the same order as the input list, and an exception
+raised while processing one file is reported without stopping the rest of the run.
+
+Scripts using this module must guard their command line handling with
+`if __name__ == "__main__":` so worker processes can import them safely.
+"""
+
+
+def get_worker_count(workers=None):
+    """
+    Returns the number of worker processes to use.
+
+    Parameters:
+        workers (int): The requested number of workers. None or 0 means one worker per CPU core.
+
+    Returns:
+        int: The number of worker processes, at least 1.
+    """
+    if not workers or workers < 1:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def _run_task(func_and_task):
+    """
+    Runs one task in a worker process and captures any exception so that a failing file
+    does not abort the whole run.
+
+    Parameters:
+        func_and_task (tuple): The function to call and the task to call it with.
+
+    Returns:
+        tuple: (task, result, error). error is None when the task succeeds, otherwise a
+        string describing the exception.
+    """
+    func, task = func_and_task
+    try:
+        return task, func(task), None
+    except Exception as e:
+        return task, None, f"{type(e).__name__}: {e}"
+
+
+def process_in_parallel(func, tasks, workers=None, chunksize=None, verbose=True, report=True, initializer=None, initargs=()):
+    """
+    Applies a function to every task using a pool of worker processes.
+
+    Parameters:
+        func (callable): A picklable function that takes one task, typically a filename.
+        tasks (iterable): The tasks to process.
+        workers (int): The number of worker processes. None or 0 means one per CPU core.
+            With 1 worker, tasks are processed in the current process.
+        chunksize (int): The number of tasks sent to a worker at a time. By default the tasks
+            are split into about 4 chunks per worker.
+        verbose (bool): Whether to print a line per processed task.
+        report (bool): Whether to print the throughput summary at the end of the run. Callers whose
+            tasks cover several images each turn it off and call report_throughput() themselves.
+        initializer (callable): Optional. Called with initargs in every worker process before its
+            first task, such as to share a semaphore with the workers.
+        initargs (tuple): The arguments of initializer.
+
+    Returns:
+        tuple: A tuple containing:
+        * a list of (task, result) for the tasks that succeeded, in input order (list)
+        * a list of (task, error message) for the tasks that failed, in input order (list)
+    """
+    tasks = list(tasks)
+    workers = min(get_worker_count(workers), max(len(tasks), 1))
+
+    results = []
+    failures = []
+    start_time = time.perf_counter()
+    collect_outcomes(iter_in_parallel(func, tasks, workers, chunksize, initializer, initargs), results, failures, verbose)
+
+    elapsed = time.perf_counter() - start_time
+    if report:
+        report_throughput(len(results), len(failures), elapsed, workers)
+
+    return results, failures
+
+
+def iter_in_parallel(func, tasks, workers=None, chunksize=None, initializer=None, initargs=()):
+    """
+    Applies a function to every task using a pool of worker processes, and yields the outcome of
+    every task as soon as it is available. Callers that can't hold every result in memory, such as
+    the ones writing results into an archive, consume the outcomes one at a time with this instead
+    of process_in_parallel().
+
+    Parameters:
+        func (callable): A picklable function that takes one task, typically a filename.
+        tasks (iterable): The tasks to process.
+        workers (int): The number of worker processes. See process_in_parallel().
+        chunksize (int): The number of tasks sent to a worker at a time. See process_in_parallel().
+        initializer (callable): Optional. Called with initargs in every worker process. See process_in_parallel().
+        initargs (tuple): The arguments of initializer.
+
+    Returns:
+        generator: (task, result, error) of every task, in input order. error is None on success,
+        otherwise a string describing the exception.
+    """
+    tasks = list(tasks)
+    workers = min(get_worker_count(workers), max(len(tasks), 1))
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (workers * 4))
+
+    if workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(_run_task, ((func, task) for task in tasks))
+    else:
+        with Pool(workers, initializer, initargs) as pool:
+            yield from pool.imap(_run_task, ((func, task) for task in tasks), chunksize)
+
+
+def collect_outcomes(outcomes, results, failures, verbose=True):
+    """
+    Sorts task outcomes into results and failures and prints a line per task. The outcomes are
+    expected in input order, so the progress output is ordered too.
+
+    Parameters:
+        outcomes (iterable): (task, result, error) of every task. error is None on success.
+        results (list): The list to append (task, result) of the succeeded tasks to.
+        failures (list): The list to append (task, error message) of the failed tasks to.
+        verbose (bool): Whether to print a line per succeeded task. Failures are always printed.
+
+    Returns:
+        None.
+    """
+    for task, result, error in outcomes:
+        if error is None:
+            results.append((task, result))
+            if verbose:
+                print(f"Processed {task}")
+        else:
+            failures.append((task, error))
+            print(f"Error: failed to process {task}: {error}")
+
+
+def report_throughput(processed, failed, elapsed, workers):
+    """
+    Prints the summary of a run: the number of processed and failed files, the wall time and
+    the throughput overall and per core.
+
+    Parameters:
+        processed (int): The number of files that were processed successfully.
+        failed (int): The number of files that failed.
+        elapsed (float): The wall time of the run in seconds.
+        workers (int): The number of worker processes used.
+
+    Returns:
+        None.
+    """
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {processed} files, {failed} failed, in {elapsed:.2f}s with {workers} worker(s)")
+    print(f"Throughput: {rate:.1f} images/sec, {rate / workers:.1f} images/sec per core")
@@ -1,51 +1,93 @@
 from PIL import Image
+import argparse
 import os
 import sys
+from functools import partial
+from common_funcs import ENCODER_PROFILES, list_image_files, save_image
+from decode_funcs import DECODE_STRATEGIES, create_large_image_limit, decode_resize, init_large_image_limit, large_image_slot
+from manifest_funcs import process_incrementally
+from shard_funcs import parse_shard
 
 '''
 This script resizes all images in a directory to the same height. The resized images are saved into a target directory.
+Images are processed in parallel, using one worker process per CPU core by default.
 
-Usage: python resize_images_to_same_height.py <image_dir> <target_height> <target_dir>
+Usage: python resize_images_to_same_height.py <image_dir> <target_height> <target_dir> [--workers N] [--incremental] [--encoder-profile PROFILE]
+       [--shard INDEX/COUNT] [--decode STRATEGY] [--max-large-images N]
 Parameters:
   image_dir: The directory with all images
   target_height: The target height to resize all images to
   target_dir: The target directory to save resized images
+  --workers: Optional. The number of worker processes. Defaults to the number of CPU cores.
+  --incremental: Optional. Skip inputs whose content and parameters match the manifest in the output directory.
+  --encoder-profile: Optional. The encoder settings of the output images: fast, balanced (default) or smallest.
+  --shard: Optional. Only process the files of one shard: INDEX/COUNT, such as 0/4, or slurm to read it from the
+  SLURM array task. See shard_funcs.py.
+  --decode: Optional. The decode strategy: reduce (default) decodes large images near the target size, full decodes
+  them at native resolution. See decode_funcs.py.
+  --max-large-images: Optional. The maximum number of large images decoded at the same time by all worker processes.
+  Defaults to no limit.
 Return: None
 
 Example: python resize_images_to_same_height.py ~/Downloads/bliss_single_chars 216 ~/Downloads/bliss_single_chars_in_height_216
 '''
 
 
-def resize_images(source_dir, target_height, target_dir):
-    # Create target directory if it doesn't exist
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
+def resize_to_height(img, target_height, strategy="reduce"):
+    # Get current width and height
+    width, height = img.size
+
+    # Calculate new width based on target height
+    ratio = target_height / height
+    new_width = int(width * ratio)
+
+    # Resize image
+    return decode_resize(img, (new_width, target_height), strategy)
 
-    # Loop through all files in source directory
-    for filename in os.listdir(source_dir):
-        # Check if file is an image
-        if filename.endswith(".jpg") or filename.endswith(".jpeg") or filename.endswith(".png"):
 
-            # Open image file
-            with Image.open(os.path.join(source_dir, filename)) as img:
-                # Get current width and height
-                width, height = img.size
+def resize_image(filename, source_dir, target_height, target_dir, encoder_profile="balanced", decode="reduce"):
+    # Open image file, waiting for a slot if it is large
+    with Image.open(os.path.join(source_dir, filename)) as img, large_image_slot(img):
+        resized_img = resize_to_height(img, target_height, decode)
 
-                # Calculate new width based on target height
-                ratio = target_height / height
-                new_width = int(width * ratio)
+        # Save resized image to target directory
+        output_path = os.path.join(target_dir, filename)
+        save_image(resized_img, output_path, encoder_profile)
+        return output_path
 
-                # Resize image
-                resized_img = img.resize((new_width, target_height))
 
-                # Save resized image to target directory
-                resized_img.save(os.path.join(target_dir, filename))
-                print(f"{filename} has been resized and saved to {target_dir}")
+def resize_images(source_dir, target_height, target_dir, workers=None, incremental=False, encoder_profile="balanced", shard=None,
+                  decode="reduce", max_large_images=None):
+    # Create target directory if it doesn't exist
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    # Resize all images in source directory, spreading the files over the worker processes
+    task = partial(resize_image, source_dir=source_dir, target_height=target_height, target_dir=target_dir, encoder_profile=encoder_profile,
+                   decode=decode)
+    params = {"op": "resize_images_to_same_height", "target_height": target_height, "encoder_profile": encoder_profile, "decode": decode}
+    return process_incrementally(task, list_image_files(source_dir), source_dir, target_dir, params, incremental, workers, shard=shard,
+                                 initializer=init_large_image_limit, initargs=(create_large_image_limit(max_large_images),))
 
 
 if __name__ == "__main__":
-    image_dir = sys.argv[1]
-    target_height = int(sys.argv[2])
-    target_dir = sys.argv[3]
+    parser = argparse.ArgumentParser(description="Resize all images in a directory to the same height.")
+    parser.add_argument("image_dir", help="The directory with all images")
+    parser.add_argument("target_height", type=int, help="The target height to resize all images to")
+    parser.add_argument("target_dir", help="The target directory to save resized images")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes. Defaults to the number of CPU cores.")
+    parser.add_argument("--incremental", action="store_true", help="Skip inputs whose content and parameters match the manifest in the output directory.")
+    parser.add_argument("--encoder-profile", choices=ENCODER_PROFILES, default="balanced", help="The encoder settings of the output images.")
+    parser.add_argument("--shard", default=None, help="Only process the files of one shard: INDEX/COUNT, such as 0/4, or slurm for the SLURM array task.")
+    parser.add_argument("--decode", choices=DECODE_STRATEGIES, default="reduce", help="The decode strategy of the source images.")
+    parser.add_argument("--max-large-images", type=int, default=None, help="The maximum number of large images decoded at the same time.")
+    args = parser.parse_args()
+
+    try:
+        shard = parse_shard(args.shard)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
 
-    resize_images(image_dir, target_height, target_dir)
+    resize_images(args.image_dir, args.target_height, args.target_dir, workers=args.workers, incremental=args.incremental, encoder_profile=args.encoder_profile,
+                  shard=shard, decode=args.decode, max_large_images=args.max_large_images)
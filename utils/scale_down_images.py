@@ -1,6 +1,16 @@
+import argparse
+import math
 import os
 import sys
+import time
+import zipfile
+from functools import partial
 from PIL import Image
+from common_funcs import ENCODER_PROFILES, encode_image, list_image_files, save_image
+from decode_funcs import DECODE_STRATEGIES, create_large_image_limit, decode_thumbnail, init_large_image_limit, large_image_slot
+from manifest_funcs import process_incrementally
+from parallel_funcs import collect_outcomes, get_worker_count, iter_in_parallel, report_throughput
+from shard_funcs import parse_shard
 
 """
 Copyright (c) 2023-2024, Inclusive Design Institute
@@ -16,60 +26,346 @@ https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
 This script scales down JPG and PNG images in a directory to a specified size
 while maintaining their aspect ratios. The output images are saved in a new
 directory. If the output directory doesn't exist, it will be created.
+Images are processed in parallel, using one worker process per CPU core by default.
 
-Usage: python scale_down_images.py [input_dir] [output_dir] [new_size]
+Pyramid mode: when several sizes are given, such as 512x512,256x256,128x128,64x64, every image
+is decoded once and scaled down to each size in turn, from the largest to the smallest, every
+level being reduced from the previous one instead of from the original. Each level is saved into
+its own subdirectory of the output directory, named after its size, or with --archive into its own
+uncompressed zip archive, such as 128x128.zip, that can be used as a StyleGAN dataset.
+
+Usage: python scale_down_images.py [input_dir] [output_dir] [new_size] [--workers N] [--incremental] [--encoder-profile PROFILE]
+       [--shard INDEX/COUNT] [--archive] [--decode STRATEGY] [--max-large-images N]
 Parameters:
   input_dir: The directory where the original images are located.
   output_dir: The directory where the output images will be saved.
-  new_size: The desired size of the scaled down images, in the format "widthxheight".
+  new_size: The desired size of the scaled down images, in the format "widthxheight", or several comma-separated
+  sizes for the pyramid mode. The sizes of the pyramid must not grow from one level to the next.
+  --workers: Optional. The number of worker processes. Defaults to the number of CPU cores.
+  --incremental: Optional. Skip inputs whose content and parameters match the manifest in the output directory.
+  --encoder-profile: Optional. The encoder settings of the output images: fast, balanced (default) or smallest.
+  --shard: Optional. Only process the files of one shard: INDEX/COUNT, such as 0/4, or slurm to read it from the
+  SLURM array task. See shard_funcs.py.
+  --archive: Optional. In pyramid mode, write every level into a zip archive instead of a subdirectory. Can't be
+  combined with --incremental or --shard.
+  --decode: Optional. The decode strategy: reduce (default) decodes large images near the target size, full decodes
+  them at native resolution. See decode_funcs.py.
+  --max-large-images: Optional. The maximum number of large images decoded at the same time by all worker processes.
+  Defaults to no limit.
 Return: None
 
 Example: python scale_down_images.py images/ scaled_down_images/ 128x128
+         python scale_down_images.py images/ pyramid/ 512x512,256x256,128x128,64x64 --archive
 """
 
-# Check if the correct number of arguments were provided
-if len(sys.argv) != 4:
-    print(f"Usage: python {sys.argv[0]} input_directory output_directory size")
-    print(f"Example: python {sys.argv[0]} images/ scaled_down_images/ 128x128")
-    sys.exit(1)
 
-# Parse the input arguments
-input_dir = sys.argv[1]
-output_dir = sys.argv[2]
-size_str = sys.argv[3]
+def parse_size(size_str):
+    """
+    Parses a size string in the format "widthxheight".
 
-# Check if the input directory exists
-if not os.path.isdir(input_dir):
-    print(f"Error: Input directory {input_dir} not found")
-    sys.exit(1)
+    Parameters:
+        size_str (str): The size string, such as "128x128".
 
-# Create the output directory if it doesn't exist
-if not os.path.isdir(output_dir):
-    os.makedirs(output_dir)
+    Returns:
+        tuple: The width and height (int, int).
 
-# Parse the size string into width and height
-try:
+    Raises:
+        ValueError: If the size string is not in the format "widthxheight".
+    """
     width, height = map(int, size_str.split('x'))
-except ValueError:
-    print(f"Error: Invalid size string {size_str}. Must be in the format 'widthxheight'")
-    sys.exit(1)
+    return width, height
+
+
+def parse_sizes(sizes_str):
+    """
+    Parses comma-separated size strings in the format "widthxheight" into the levels of a pyramid,
+    from the largest to the smallest.
+
+    Parameters:
+        sizes_str (str): The size strings, such as "256x256,128x128".
+
+    Returns:
+        list: (width, height) of every level.
+
+    Raises:
+        ValueError: If a size is invalid or larger than the previous one in either dimension.
+    """
+    levels = sorted((parse_size(size_str) for size_str in sizes_str.split(',')), key=lambda size: size[0] * size[1], reverse=True)
+    for (width, height), (next_width, next_height) in zip(levels, levels[1:]):
+        if next_width > width or next_height > height:
+            raise ValueError(f"Level {next_width}x{next_height} can't be reduced from level {width}x{height}")
+    return levels
 
-# Iterate over all files in the input directory
-for filename in os.listdir(input_dir):
-    # Check if the file is an image
-    if not filename.endswith('.jpg') and not filename.endswith('.jpeg') and not filename.endswith('.png'):
-        continue
 
-    # Open the image file
+def get_output_filename(filename, width, height):
+    """
+    Returns the filename of a scaled down image, which carries the size, such as "12345_128x128.png".
+    """
+    file_name, file_ext = os.path.splitext(filename)
+    return f"{file_name}_{width}x{height}{file_ext}"
+
+
+def scale_down_image(filename, input_dir, output_dir, width, height, encoder_profile="balanced", decode="reduce"):
+    """
+    Scales down one image while maintaining its aspect ratio and saves it into the output directory.
+    This is the per-file task run by the worker processes.
+
+    Parameters:
+        filename (str): The filename of the image in the input directory.
+        input_dir (str): The directory where the original images are located.
+        output_dir (str): The directory where the output images will be saved.
+        width (int): The maximum width of the scaled down image.
+        height (int): The maximum height of the scaled down image.
+        encoder_profile (str): The encoder settings of the output images: "fast", "balanced" or "smallest".
+        decode (str): The decode strategy: "reduce" or "full". See decode_funcs.py.
+
+    Returns:
+        str: The path of the output image.
+    """
+    # Open the image file, waiting for a slot if it is large
     filepath = os.path.join(input_dir, filename)
-    with Image.open(filepath) as img:
+    with Image.open(filepath) as img, large_image_slot(img):
         # Scale down the image while maintaining its aspect ratio
-        img.thumbnail((width, height))
+        decode_thumbnail(img, (width, height), decode)
 
         # Construct the output filename and path
-        output_filename = f"{os.path.splitext(filename)[0]}_{width}x{height}{os.path.splitext(filename)[1]}"
-        output_filepath = os.path.join(output_dir, output_filename)
+        output_filepath = os.path.join(output_dir, get_output_filename(filename, width, height))
 
         # Save the output image to the output directory
-        img.save(output_filepath)
-        print(f"Scaled down {filename} to {output_filename}")
+        save_image(img, output_filepath, encoder_profile)
+        return output_filepath
+
+
+def scale_down_images(input_dir, output_dir, width, height, workers=None, incremental=False, encoder_profile="balanced", shard=None,
+                      decode="reduce", max_large_images=None):
+    """
+    Scales down all JPG and PNG images in a directory to a specified size.
+
+    Parameters:
+        input_dir (str): The directory where the original images are located.
+        output_dir (str): The directory where the output images will be saved.
+        width (int): The maximum width of the scaled down images.
+        height (int): The maximum height of the scaled down images.
+        workers (int): The number of worker processes. None means one per CPU core.
+        incremental (bool): Whether to skip images that are up to date with the manifest of the output directory.
+        encoder_profile (str): The encoder settings of the output images: "fast", "balanced" or "smallest".
+        shard (tuple): Optional. (index, count) returned by parse_shard() to only process the files of one shard.
+        decode (str): The decode strategy: "reduce" or "full". See decode_funcs.py.
+        max_large_images (int): The maximum number of large images decoded at the same time. None means no limit.
+
+    Returns:
+        tuple: The results and failures returned by process_incrementally().
+    """
+    # Create the output directory if it doesn't exist
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    task = partial(scale_down_image, input_dir=input_dir, output_dir=output_dir, width=width, height=height, encoder_profile=encoder_profile,
+                   decode=decode)
+    params = {"op": "scale_down_images", "width": width, "height": height, "encoder_profile": encoder_profile, "decode": decode}
+    return process_incrementally(task, list_image_files(input_dir), input_dir, output_dir, params, incremental, workers, shard=shard,
+                                 initializer=init_large_image_limit, initargs=(create_large_image_limit(max_large_images),))
+
+
+def get_thumbnail_size(size, max_size):
+    """
+    Returns the size Image.thumbnail() scales an image down to: the largest size that fits in
+    max_size with the aspect ratio of the image, or the size of the image if it already fits.
+
+    Parameters:
+        size (tuple): (width, height) of the image.
+        max_size (tuple): (width, height) to fit in.
+
+    Returns:
+        tuple: (width, height) of the thumbnail.
+    """
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    width, height = size
+    x, y = max_size
+    if x >= width and y >= height:
+        return size
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+def iter_pyramid(img, levels, decode="reduce"):
+    """
+    Scales down an image to every level of a pyramid in turn. The first level is scaled down from
+    the image with decode_thumbnail(), and every next level is reduced from the previous one. The
+    size of every level is computed from the size of the original image, so it is the same as
+    scaling down the original image to the level.
+
+    Parameters:
+        img (PIL.Image.Image): The decoded image. It is modified in place.
+        levels (list): (width, height) of every level, from the largest to the smallest.
+        decode (str): The decode strategy of the first level: "reduce" or "full". See decode_funcs.py.
+
+    Returns:
+        generator: (width, height, image) of every level.
+    """
+    original_size = img.size
+    for position, (width, height) in enumerate(levels):
+        if position == 0:
+            decode_thumbnail(img, (width, height), decode)
+        else:
+            level_size = get_thumbnail_size(original_size, (width, height))
+            if img.size != level_size:
+                img = img.resize(level_size, Image.BICUBIC, reducing_gap=2.0)
+        yield width, height, img
+
+
+def scale_down_pyramid_image(filename, input_dir, output_dir, levels, encoder_profile="balanced", decode="reduce"):
+    """
+    Decodes one image once and saves it at every level of a pyramid, into the subdirectory of
+    the output directory named after the level. This is the per-file task run by the worker processes.
+
+    Parameters:
+        filename (str): The filename of the image in the input directory.
+        input_dir (str): The directory where the original images are located.
+        output_dir (str): The directory with the subdirectories of the levels.
+        levels (list): (width, height) of every level, from the largest to the smallest.
+        encoder_profile (str): The encoder settings of the output images: "fast", "balanced" or "smallest".
+        decode (str): The decode strategy: "reduce" or "full". See decode_funcs.py.
+
+    Returns:
+        str: The path of the output image of the smallest level, which is saved last.
+    """
+    with Image.open(os.path.join(input_dir, filename)) as img, large_image_slot(img):
+        for width, height, level_img in iter_pyramid(img, levels, decode):
+            output_filepath = os.path.join(output_dir, f"{width}x{height}", get_output_filename(filename, width, height))
+            save_image(level_img, output_filepath, encoder_profile)
+        return output_filepath
+
+
+def encode_pyramid_image(filename, input_dir, levels, encoder_profile="balanced", decode="reduce"):
+    """
+    Decodes one image once and encodes it in memory at every level of a pyramid. This is the
+    per-file task run by the worker processes in archive mode.
+
+    Returns:
+        list: The encoded image of every level (bytes), in the order of the levels.
+    """
+    with Image.open(os.path.join(input_dir, filename)) as img, large_image_slot(img):
+        return [
+            encode_image(level_img, filename, encoder_profile)
+            for width, height, level_img in iter_pyramid(img, levels, decode)
+        ]
+
+
+def scale_down_pyramid(input_dir, output_dir, levels, workers=None, incremental=False, encoder_profile="balanced", shard=None, archive=False,
+                       decode="reduce", max_large_images=None):
+    """
+    Scales down all JPG and PNG images in a directory to every level of a pyramid, decoding every
+    image once.
+
+    Parameters:
+        input_dir (str): The directory where the original images are located.
+        output_dir (str): The directory where the levels will be saved.
+        levels (list): (width, height) of every level returned by parse_sizes().
+        workers (int): The number of worker processes. None means one per CPU core.
+        incremental (bool): Whether to skip images that are up to date with the manifest of the output directory.
+        encoder_profile (str): The encoder settings of the output images: "fast", "balanced" or "smallest".
+        shard (tuple): Optional. (index, count) returned by parse_shard() to only process the files of one shard.
+        archive (bool): Whether to write every level into a zip archive instead of a subdirectory.
+        decode (str): The decode strategy: "reduce" or "full". See decode_funcs.py.
+        max_large_images (int): The maximum number of large images decoded at the same time. None means no limit.
+
+    Returns:
+        tuple: The results and failures returned by process_incrementally(), or in archive mode,
+        (filename, None) of the images written and (filename, error message) of the images that failed.
+    """
+    if archive and (incremental or shard is not None):
+        raise ValueError("The archives are written by one process and can't be updated incrementally or by a shard")
+
+    for width, height in levels:
+        os.makedirs(output_dir if archive else os.path.join(output_dir, f"{width}x{height}"), exist_ok=True)
+
+    initargs = (create_large_image_limit(max_large_images),)
+    if not archive:
+        task = partial(scale_down_pyramid_image, input_dir=input_dir, output_dir=output_dir, levels=levels, encoder_profile=encoder_profile,
+                       decode=decode)
+        params = {"op": "scale_down_pyramid", "levels": [list(level) for level in levels], "encoder_profile": encoder_profile, "decode": decode}
+        return process_incrementally(task, list_image_files(input_dir), input_dir, output_dir, params, incremental, workers, shard=shard,
+                                     initializer=init_large_image_limit, initargs=initargs)
+
+    # The encoded levels are written into the archives as they arrive, in filename order, so
+    # they are never all held in memory
+    filenames = list_image_files(input_dir)
+    archive_paths = [os.path.join(output_dir, f"{width}x{height}.zip") for width, height in levels]
+    archives = [zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_STORED) for archive_path in archive_paths]
+
+    def write_outcomes(outcomes):
+        for filename, encoded_levels, error in outcomes:
+            if error is None:
+                for (width, height), zip_file, data in zip(levels, archives, encoded_levels):
+                    zip_file.writestr(get_output_filename(filename, width, height), data)
+            yield filename, None, error
+
+    results = []
+    failures = []
+    start_time = time.perf_counter()
+    try:
+        task = partial(encode_pyramid_image, input_dir=input_dir, levels=levels, encoder_profile=encoder_profile, decode=decode)
+        outcomes = iter_in_parallel(task, filenames, workers, initializer=init_large_image_limit, initargs=initargs)
+        collect_outcomes(write_outcomes(outcomes), results, failures)
+    finally:
+        for zip_file in archives:
+            zip_file.close()
+    report_throughput(len(results), len(failures), time.perf_counter() - start_time, min(get_worker_count(workers), max(len(filenames), 1)))
+
+    for archive_path in archive_paths:
+        print(f"Saved {archive_path}")
+    return results, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scale down JPG and PNG images in a directory to a specified size.")
+    parser.add_argument("input_dir", help="The directory where the original images are located.")
+    parser.add_argument("output_dir", help="The directory where the output images will be saved.")
+    parser.add_argument("size", help="The desired size of the scaled down images, in the format 'widthxheight', or comma-separated sizes for a pyramid.")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes. Defaults to the number of CPU cores.")
+    parser.add_argument("--incremental", action="store_true", help="Skip inputs whose content and parameters match the manifest in the output directory.")
+    parser.add_argument("--encoder-profile", choices=ENCODER_PROFILES, default="balanced", help="The encoder settings of the output images.")
+    parser.add_argument("--shard", default=None, help="Only process the files of one shard: INDEX/COUNT, such as 0/4, or slurm for the SLURM array task.")
+    parser.add_argument("--archive", action="store_true", help="In pyramid mode, write every level into a zip archive instead of a subdirectory.")
+    parser.add_argument("--decode", choices=DECODE_STRATEGIES, default="reduce", help="The decode strategy of the source images.")
+    parser.add_argument("--max-large-images", type=int, default=None, help="The maximum number of large images decoded at the same time.")
+    args = parser.parse_args()
+
+    # Check if the input directory exists
+    if not os.path.isdir(args.input_dir):
+        print(f"Error: Input directory {args.input_dir} not found")
+        sys.exit(1)
+
+    # Parse the size string into width and height, or into the levels of a pyramid
+    try:
+        levels = parse_sizes(args.size)
+    except ValueError as e:
+        print(f"Error: Invalid size string {args.size}. Must be in the format 'widthxheight', or comma-separated sizes: {e}")
+        sys.exit(1)
+
+    try:
+        shard = parse_shard(args.shard)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    if len(levels) > 1 or args.archive:
+        try:
+            scale_down_pyramid(args.input_dir, args.output_dir, levels, workers=args.workers, incremental=args.incremental,
+                               encoder_profile=args.encoder_profile, shard=shard, archive=args.archive, decode=args.decode,
+                               max_large_images=args.max_large_images)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+    else:
+        width, height = levels[0]
+        scale_down_images(args.input_dir, args.output_dir, width, height, workers=args.workers, incremental=args.incremental,
+                          encoder_profile=args.encoder_profile, shard=shard, decode=args.decode, max_large_images=args.max_large_images)
@@ -0,0 +1,111 @@
+import os
+import zlib
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+Sharding for the scripts in this directory, so that a large symbol set can be prepared by
+several processes or nodes, such as the tasks of a SLURM array job.
+
+A shard is given as "INDEX/COUNT" with INDEX from 0 to COUNT - 1, or as "slurm" to read it from
+the environment of a SLURM array task. Every file is assigned to one shard by a hash of its
+filename. The assignment doesn't depend on the other files in the directory, so every shard
+selects the same files on every run, and adding new symbols doesn't move existing ones to
+another shard. Within a shard, files keep their sorted order.
+
+Sharded runs write per-shard manifests and statistics. Merge them with merge_shards.py once all
+shards are done.
+"""
+
+
+def parse_shard(spec):
+    """
+    Parses a shard specification.
+
+    Parameters:
+        spec (str): "INDEX/COUNT", such as "0/4", or "slurm" to read the shard from the
+            SLURM_ARRAY_TASK_ID, SLURM_ARRAY_TASK_MIN, SLURM_ARRAY_TASK_STEP and
+            SLURM_ARRAY_TASK_COUNT environment variables. None means no sharding.
+
+    Returns:
+        tuple: (index, count), or None if spec is None.
+
+    Raises:
+        ValueError: If the specification is invalid or the SLURM variables are not set.
+    """
+    if spec is None:
+        return None
+
+    if spec == "slurm":
+        try:
+            task_id = int(os.environ["SLURM_ARRAY_TASK_ID"])
+            task_min = int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0))
+            task_step = int(os.environ.get("SLURM_ARRAY_TASK_STEP", 1))
+            count = int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+        except (KeyError, ValueError):
+            raise ValueError("Not running in a SLURM array task: SLURM_ARRAY_TASK_ID and SLURM_ARRAY_TASK_COUNT must be set")
+        index = (task_id - task_min) // task_step
+    else:
+        try:
+            index, count = (int(value) for value in spec.split('/'))
+        except ValueError:
+            raise ValueError(f"Invalid shard {spec}. Must be in the format INDEX/COUNT, such as 0/4, or slurm")
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {index}/{count}. The index must be between 0 and {count - 1}")
+    return index, count
+
+
+def in_shard(filename, shard):
+    """
+    Returns whether a file belongs to a shard.
+
+    Parameters:
+        filename (str): The filename, or the path relative to the root of a directory tree.
+        shard (tuple): (index, count) returned by parse_shard(), or None for no sharding.
+
+    Returns:
+        bool: True if the file belongs to the shard. Always True when shard is None.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(filename.encode('utf-8')) % count == index
+
+
+def select_shard(filenames, shard):
+    """
+    Returns the files of a list that belong to a shard, in their original order.
+
+    Parameters:
+        filenames (list): The filenames, usually sorted with list_image_files().
+        shard (tuple): (index, count) returned by parse_shard(), or None for no sharding.
+
+    Returns:
+        list: The filenames of the shard.
+    """
+    return [filename for filename in filenames if in_shard(filename, shard)]
+
+
+def get_shard_suffix(shard):
+    """
+    Returns the suffix that distinguishes the files written by a shard, such as ".shard-0-of-4".
+
+    Parameters:
+        shard (tuple): (index, count) returned by parse_shard(), or None for no sharding.
+
+    Returns:
+        str: The suffix, or an empty string when shard is None.
+    """
+    if shard is None:
+        return ""
+    index, count = shard
+    return f".shard-{index}-of-{count}"
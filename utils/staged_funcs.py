@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+from parallel_funcs import collect_outcomes, report_throughput
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+Staged producer/consumer execution for the image processing scripts in this directory.
+
+Each file goes through three stages connected by bounded queues:
+1. read: a pool of reader threads reads and decodes the files ahead of the transform stage;
+2. transform: the calling thread transforms the decoded images one at a time;
+3. write: a pool of writer threads encodes and saves the transformed images.
+
+Pillow releases the GIL while decoding, resizing and encoding, so reading, transforming and
+writing different files overlap in one process. The bounded queues cap the number of decoded
+images held in memory. A file that fails in any stage is reported without stopping the rest of
+the run, and progress is reported in input order once all files are done.
+"""
+
+# Marks the end of the items put on a queue by one thread
+_DONE = object()
+
+
+def process_in_stages(tasks, read, transform, write, readers=4, writers=4, queue_size=32, verbose=True):
+    """
+    Runs every task through the read, transform and write stages.
+
+    Parameters:
+        tasks (iterable): The tasks to process, typically filenames.
+        read (callable): Takes a task and returns the decoded data. Runs in the reader threads.
+        transform (callable): Takes the decoded data and returns the transformed data. Runs in
+            the calling thread.
+        write (callable): Takes a task and its transformed data, saves it and returns the result
+            of the task. Runs in the writer threads.
+        readers (int): The number of reader threads.
+        writers (int): The number of writer threads.
+        queue_size (int): The maximum number of items waiting between two stages.
+        verbose (bool): Whether to print a line per processed task.
+
+    Returns:
+        tuple: A tuple containing:
+        * a list of (task, result) for the tasks that succeeded, in input order (list)
+        * a list of (task, error message) for the tasks that failed, in input order (list)
+    """
+    tasks = list(tasks)
+    outcomes = [None] * len(tasks)
+    task_queue = queue.Queue()
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+
+    for position, task in enumerate(tasks):
+        task_queue.put((position, task))
+
+    def run_reader():
+        while True:
+            try:
+                position, task = task_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                read_queue.put((position, task, read(task)))
+            except Exception as e:
+                outcomes[position] = (task, None, f"{type(e).__name__}: {e}")
+        read_queue.put(_DONE)
+
+    def run_writer():
+        while True:
+            item = write_queue.get()
+            if item is _DONE:
+                break
+            position, task, data = item
+            try:
+                outcomes[position] = (task, write(task, data), None)
+            except Exception as e:
+                outcomes[position] = (task, None, f"{type(e).__name__}: {e}")
+
+    start_time = time.perf_counter()
+    reader_threads = [threading.Thread(target=run_reader, daemon=True) for _ in range(max(1, readers))]
+    writer_threads = [threading.Thread(target=run_writer, daemon=True) for _ in range(max(1, writers))]
+    for thread in reader_threads + writer_threads:
+        thread.start()
+
+    # Transform stage, until every reader has finished
+    running_readers = len(reader_threads)
+    while running_readers:
+        item = read_queue.get()
+        if item is _DONE:
+            running_readers -= 1
+            continue
+        position, task, data = item
+        try:
+            write_queue.put((position, task, transform(data)))
+        except Exception as e:
+            outcomes[position] = (task, None, f"{type(e).__name__}: {e}")
+
+    for _ in writer_threads:
+        write_queue.put(_DONE)
+    for thread in reader_threads + writer_threads:
+        thread.join()
+
+    results = []
+    failures = []
+    collect_outcomes(outcomes, results, failures, verbose)
+    report_throughput(len(results), len(failures), time.perf_counter() - start_time, 1)
+    return results, failures
@@ -0,0 +1,219 @@
+import os
+from functools import partial
+import numpy as np
+from PIL import Image
+from common_funcs import list_image_files, load_dimension_index, save_dimension_index
+from parallel_funcs import process_in_parallel
+
+"""
+Copyright (c) 2024, Inclusive Design Institute
+
+Licensed under the BSD 3-Clause License. You may not use this file except
+in compliance with this License.
+
+You may obtain a copy of the BSD 3-Clause License at
+https://github.com/inclusive-design/baby-bliss-bot/blob/main/LICENSE
+"""
+
+"""
+Auto-trim for the image processing scripts in this directory.
+
+The background color of an image is the color at the pixel (1, 1), as in pad_image_to_canvas()
+of image_size_sync.py. Every pixel whose grayscale value, or alpha value for transparent images,
+differs from the background by more than TRIM_TOLERANCE is ink. The bounding box of the ink is
+found with NumPy by reducing the ink mask along its rows and columns, and the image is cropped to
+the box plus a padding. Trimming the background margins before syncing lets the canvas size be
+the largest glyph instead of the largest raw image.
+
+The padding is at least MIN_TRIM_PADDING pixels, so that the pixel (1, 1) of a trimmed image is
+still background when it is padded onto a canvas.
+
+The trimmed dimensions of a folder are cached in a trim index (.trim_index.json) in the folder,
+which works like the dimension index of common_funcs.py. The shards of a sharded run only read the
+trim index, so build it once before, such as with get_max_dimensions.py --trim, or pass the canvas
+size to the shards.
+"""
+
+# The maximum difference from the background color of a pixel that is still background
+TRIM_TOLERANCE = 8
+
+# The default and minimum padding around the ink bounding box, in pixels
+TRIM_PADDING = 2
+MIN_TRIM_PADDING = 2
+
+# The name of the file that caches the ink bounding boxes of the images in a folder
+TRIM_INDEX_FILENAME = ".trim_index.json"
+
+
+def check_trim_padding(padding):
+    """
+    Raises a ValueError if a trim padding is below MIN_TRIM_PADDING.
+    """
+    if padding < MIN_TRIM_PADDING:
+        raise ValueError(f"Invalid trim padding {padding}. Must be at least {MIN_TRIM_PADDING} so the background color can still be read at (1, 1)")
+
+
+def get_ink_box(img, tolerance=TRIM_TOLERANCE):
+    """
+    Returns the bounding box of the ink of an image.
+
+    Parameters:
+        img (PIL.Image.Image): The image.
+        tolerance (int): The maximum difference from the background color of a pixel that is still background.
+
+    Returns:
+        tuple: (left, upper, right, lower) of the ink, or None if the image has no ink.
+    """
+    gray = np.asarray(img.convert('L'), dtype=np.int16)
+    ink = np.abs(gray - gray[1, 1]) > tolerance
+
+    # Transparent images may draw the ink and the background with the same color
+    if 'A' in img.getbands() or (img.mode == 'P' and 'transparency' in img.info):
+        alpha = np.asarray(img.convert('RGBA').getchannel('A'), dtype=np.int16)
+        ink |= np.abs(alpha - alpha[1, 1]) > tolerance
+
+    rows = np.flatnonzero(ink.any(axis=1))
+    if not rows.size:
+        return None
+    columns = np.flatnonzero(ink.any(axis=0))
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+def get_trim_box(img, padding=TRIM_PADDING):
+    """
+    Returns the box to crop an image to: the bounding box of its ink plus a padding, clipped to
+    the image. An image without ink is not cropped.
+
+    Parameters:
+        img (PIL.Image.Image): The image.
+        padding (int): The padding around the ink, in pixels.
+
+    Returns:
+        tuple: (left, upper, right, lower) of the box.
+    """
+    return pad_box(get_ink_box(img), img.size, padding)
+
+
+def pad_box(ink_box, size, padding):
+    """
+    Adds a padding around an ink bounding box and clips it to the image.
+
+    Parameters:
+        ink_box (tuple): (left, upper, right, lower) returned by get_ink_box(), or None.
+        size (tuple): (width, height) of the image.
+        padding (int): The padding around the ink, in pixels.
+
+    Returns:
+        tuple: (left, upper, right, lower) of the padded box, or of the whole image if ink_box is None.
+    """
+    width, height = size
+    if ink_box is None:
+        return 0, 0, width, height
+
+    left, upper, right, lower = ink_box
+    return max(left - padding, 0), max(upper - padding, 0), min(right + padding, width), min(lower + padding, height)
+
+
+def trim_image(img, padding=TRIM_PADDING):
+    """
+    Crops an image to the bounding box of its ink plus a padding.
+
+    Parameters:
+        img (PIL.Image.Image): The image.
+        padding (int): The padding around the ink, in pixels.
+
+    Returns:
+        PIL.Image.Image: The cropped image.
+    """
+    return img.crop(get_trim_box(img, padding))
+
+
+def read_ink_box(filename, folder_path):
+    """
+    Returns the size and the ink bounding box of one image of a folder. This is the per-file task
+    run by the worker processes.
+
+    Returns:
+        tuple: (width, height, ink box). The ink box is None if the image has no ink.
+    """
+    with Image.open(os.path.join(folder_path, filename)) as img:
+        return img.size[0], img.size[1], get_ink_box(img)
+
+
+def get_trimmed_dimensions(folder_path, padding=TRIM_PADDING, use_index=True, workers=None, save_index=True):
+    """
+    Returns the width and height of all images in a folder once trimmed.
+
+    Every image has to be decoded to find its ink, so the ink bounding boxes are computed in
+    parallel and cached in a trim index (.trim_index.json) in the folder. Each entry records the
+    file size and modification time, so only new or changed images are decoded again. Images that
+    can't be read are cached too, so they are not decoded again until they change. The padding is
+    applied to the cached boxes, so changing it doesn't decode the images again.
+
+    Parameters:
+        folder_path (str): The path to the folder containing the images.
+        padding (int): The padding around the ink, in pixels.
+        use_index (bool): Whether to read the trim index.
+        workers (int): The number of worker processes. None means one per CPU core.
+        save_index (bool): Whether to save the updated trim index. The shards of a sharded run only
+            read it, so that they don't all write the same file.
+
+    Returns:
+        dict: Maps image filenames to their trimmed (width, height). Images that can't be read are left out.
+    """
+    index_path = os.path.join(folder_path, TRIM_INDEX_FILENAME)
+    index = load_dimension_index(index_path) if use_index else {}
+    filenames = list_image_files(folder_path)
+
+    # Entries are [file size, modification time in ns, width, height, ink box or None], with a width
+    # and height of None for the images that can't be read
+    entries = {}
+    to_read = []
+    for filename in filenames:
+        stat = os.stat(os.path.join(folder_path, filename))
+        cached = index.get(filename)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            entries[filename] = cached
+        else:
+            entries[filename] = [stat.st_size, stat.st_mtime_ns]
+            to_read.append(filename)
+
+    if to_read:
+        if not save_index:
+            print(f"Warning: {len(to_read)} images are not in the trim index {index_path}. Build it once with get_max_dimensions.py --trim")
+        print(f"Finding the ink of {len(to_read)} images")
+        task = partial(read_ink_box, folder_path=folder_path)
+        results, failures = process_in_parallel(task, to_read, workers=workers, verbose=False)
+        for filename, (width, height, ink_box) in results:
+            entries[filename].extend([width, height, ink_box])
+        for filename, _ in failures:
+            entries[filename].extend([None, None, None])
+
+    if use_index and save_index and (to_read or set(index) - set(entries)):
+        save_dimension_index(index_path, entries)
+
+    dimensions = {}
+    for filename, (_, _, width, height, ink_box) in entries.items():
+        if width is None:
+            continue
+        left, upper, right, lower = pad_box(ink_box, (width, height), padding)
+        dimensions[filename] = (right - left, lower - upper)
+    return dimensions
+
+
+def get_trimmed_canvas_size(folder_path, padding=TRIM_PADDING, workers=None, save_index=True):
+    """
+    Returns the size of the square canvas that fits every trimmed image in a folder, which is the
+    maximum trimmed width or height.
+
+    Parameters:
+        folder_path (str): The path to the folder containing the images.
+        padding (int): The padding around the ink, in pixels.
+        workers (int): The number of worker processes. None means one per CPU core.
+        save_index (bool): Whether to save the updated trim index, see get_trimmed_dimensions().
+
+    Returns:
+        int: The canvas size.
+    """
+    dimensions = get_trimmed_dimensions(folder_path, padding, workers=workers, save_index=save_index)
+    return max((max(width, height) for width, height in dimensions.values()), default=0)